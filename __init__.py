@@ -0,0 +1,13 @@
+"""
+ClearOne XAP controller.  The platforms, media_player and sensor, do the work; the integration only keeps the Home
+Assistant config, which the media_player platform passes on when it loads the sensor platform through discovery.
+"""
+
+DOMAIN = 'xap_controller'
+DATA_HASS_CONFIG = 'hass_config'
+
+
+async def async_setup(hass, config):
+    """Keep the whole Home Assistant config, set up before any platform of the integration"""
+    hass.data.setdefault(DOMAIN, {})[DATA_HASS_CONFIG] = config
+    return True
@@ -0,0 +1,246 @@
+"""
+Benchmark of the serial cost of the platform, run against the emulator.
+
+Each scenario generates a config with a given number of zones, sources, channels per zone and units, sets up the
+platform on an emulated link throttled to the configured baud rate, and then runs every zone and source operation a
+number of times, including turning every zone off and back on at once.  For startup and each operation it reports
+the number of commands the emulated units received and the wall clock latency (mean, p50 and p99).  Results are
+written as JSON; given a baseline file from an earlier run, any scenario or operation that now sends more commands
+is reported and the exit status is 1, so regressions in command count can be caught:
+
+    python -m xap_controller.benchmark --output bench.json
+    python -m xap_controller.benchmark --baseline bench.json
+
+Needs Home Assistant installed, as the platform and its entities are used as they are in Home Assistant.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers import entity_platform  # loaded before the media_player component, as HA does
+from homeassistant.components.media_player import SCAN_INTERVAL
+
+from . import media_player
+from .emulator import XAPEmulator
+from .routing import MATRIX_GEOMETRY
+from .transport import INPUT_GROUP_CHANNELS
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_LATENCY = 0.005  # seconds a unit takes to process a command
+DEFAULT_BAUD = 38400
+DEFAULT_REPEAT = 5
+
+# (zones, sources, channels per zone, units)
+SCENARIOS = [
+    (2, 2, 2, 1),
+    (6, 4, 2, 1),
+    (12, 6, 2, 2),
+    (4, 3, 6, 2),
+    (12, 6, 6, 2),
+    (8, 4, 2, 4),
+]
+
+
+def scenario_config(zones, sources, channels, units, XAPType="XAP800"):
+    """Platform config for a scenario; sources use the expansion bus so every zone can reach them"""
+    geometry = MATRIX_GEOMETRY[XAPType]
+    buses = itertools.cycle(INPUT_GROUP_CHANNELS['E'])
+    config_sources = {}
+    for src in range(sources):
+        unit = src % units
+        config_sources['Source {}'.format(src + 1)] = [
+            "{}:{}:{}:E".format(unit, (src * channels + chan) % geometry + 1, next(buses))
+            for chan in range(channels)]
+    config_zones = {}
+    for zone in range(zones):
+        unit = zone % units
+        config_zones['Zone {}'.format(zone + 1)] = [
+            "{}:{}".format(unit, ((zone // units) * channels + chan) % geometry + 1)
+            for chan in range(channels)]
+    return {
+        media_player.CONF_PATH: None,
+        media_player.CONF_TYPE: XAPType,
+        media_player.CONF_ZONES: config_zones,
+        media_player.CONF_SOURCES: config_sources,
+        media_player.CONF_POLL_MAX_INTERVAL: 0,  # background polling would add to the counts
+    }
+
+
+def percentile(values, pct):
+    """Nearest rank percentile"""
+    values = sorted(values)
+    if not values:
+        return 0
+    rank = max(int(round(pct / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class Recorder:
+    """
+    Commands and latency of each run of each operation
+    """
+
+    def __init__(self, emulator):
+        self._emulator = emulator
+        self.runs = {}  # operation: [(commands, seconds)]
+
+    async def measure(self, operation, coroutine):
+        before = sum(self._emulator.commands.values())
+        start = time.monotonic()
+        await coroutine
+        elapsed = time.monotonic() - start
+        self.runs.setdefault(operation, []).append((sum(self._emulator.commands.values()) - before, elapsed))
+
+    def summary(self):
+        result = {}
+        for operation, runs in self.runs.items():
+            commands = [cmds for cmds, _elapsed in runs]
+            latency = [elapsed * 1000 for _cmds, elapsed in runs]
+            result[operation] = {
+                'runs': len(runs),
+                'commands': round(sum(commands) / len(runs), 2),
+                'max_commands': max(commands),
+                'mean_ms': round(sum(latency) / len(runs), 2),
+                'p50_ms': round(percentile(latency, 50), 2),
+                'p99_ms': round(percentile(latency, 99), 2),
+            }
+        return result
+
+
+async def run_scenario(zones, sources, channels, units, repeat=DEFAULT_REPEAT, latency=DEFAULT_LATENCY,
+                       baud=DEFAULT_BAUD, XAPType="XAP800", tcp=False):
+    """Set up the platform for a scenario and measure every operation, with tcp through a TCP port as on a gateway"""
+    config = scenario_config(zones, sources, channels, units, XAPType)
+    emulator = XAPEmulator(units=range(units), XAPType=XAPType, latency=latency, baud=baud)
+    config[media_player.CONF_PATH] = await (emulator.start_tcp() if tcp else emulator.start())
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = HomeAssistant(config_dir)
+        hass.config.components.add('sensor')  # the diagnostic sensors are not part of the benchmark
+        entity_platform.current_platform.set(entity_platform.EntityPlatform(
+            hass=hass, logger=_LOGGER, domain='media_player', platform_name=media_player.DOMAIN, platform=None,
+            scan_interval=SCAN_INTERVAL, entity_namespace=None))
+        entities = []
+        start = time.monotonic()
+        await media_player.async_setup_platform(hass, media_player.PLATFORM_SCHEMA(
+            dict(config, platform=media_player.DOMAIN)), entities.extend)
+        await asyncio.gather(*[entity.async_hydrate() for entity in entities])  # as added to HA, until all are shown
+        startup = time.monotonic() - start
+        startup_commands = sum(emulator.commands.values())
+
+        recorder = Recorder(emulator)
+        zone_objs = [ent for ent in entities if isinstance(ent, media_player.XAPZone)]
+        source_objs = [ent for ent in entities if isinstance(ent, media_player.XAPSource)]
+        source_names = list(config[media_player.CONF_SOURCES])
+        for run in range(repeat):
+            volume = 0.3 + 0.1 * (run % 4)
+            for idx, zone in enumerate(zone_objs):
+                await recorder.measure('zone.select_source', zone.async_select_source(
+                    source_names[(idx + run + 1) % len(source_names)]))
+                await recorder.measure('zone.set_volume_level', zone.async_set_volume_level(volume))
+                await recorder.measure('zone.mute_volume', zone.async_mute_volume(True))
+                await recorder.measure('zone.mute_volume', zone.async_mute_volume(False))
+                await recorder.measure('zone.turn_off', zone.async_turn_off())
+                await recorder.measure('zone.turn_on', zone.async_turn_on())
+                await recorder.measure('zone.setDefaultLevel', zone.async_setDefaultLevel())
+                await recorder.measure('zone.fade', zone.async_fade(volume / 2, 1.0))
+            for source in source_objs:
+                await recorder.measure('source.set_volume_level', source.async_set_volume_level(volume))
+                await recorder.measure('source.mute_volume', source.async_mute_volume(True))
+                await recorder.measure('source.turn_off', source.async_turn_off())
+                await recorder.measure('source.turn_on', source.async_turn_on())
+            # the whole house off and back on at once, as an automation would, clearing every zone's matrix column
+            await recorder.measure('all_zones.turn_off',
+                                   asyncio.gather(*[zone.async_turn_off() for zone in zone_objs]))
+            await recorder.measure('all_zones.turn_on',
+                                   asyncio.gather(*[zone.async_turn_on() for zone in zone_objs]))
+            scene = {zone._name: {'source': source_names[(idx + run) % len(source_names)], 'volume': volume}
+                     for idx, zone in enumerate(zone_objs)}
+            await recorder.measure('scene', hass.services.async_call(
+                media_player.DOMAIN, media_player.SERVICE_APPLY_SCENE, {'zones': scene}, blocking=True))
+            trims = {zone._name: {source_names[(idx + run) % len(source_names)]: -float(run % 3) * 3}
+                     for idx, zone in enumerate(zone_objs)}
+            await recorder.measure('trims', hass.services.async_call(
+                media_player.DOMAIN, media_player.SERVICE_APPLY_TRIMS, {'trims': trims}, blocking=True))
+
+        await hass.async_stop(force=True)
+    await emulator.stop()
+    return {
+        'name': "{}z-{}s-{}c-{}u".format(zones, sources, channels, units),
+        'zones': zones, 'sources': sources, 'channels': channels, 'units': units,
+        'startup_s': round(startup, 3),
+        'startup_commands': startup_commands,
+        'operations': recorder.summary(),
+    }
+
+
+def regressions(results, baseline):
+    """Scenarios and operations that send more commands than in the baseline"""
+    found = []
+    previous = {scenario['name']: scenario for scenario in baseline.get('scenarios', [])}
+    for scenario in results['scenarios']:
+        before = previous.get(scenario['name'])
+        if before is None:
+            continue
+        if scenario['startup_commands'] > before['startup_commands']:
+            found.append("{} startup: {} -> {} commands".format(
+                scenario['name'], before['startup_commands'], scenario['startup_commands']))
+        for operation, stats in scenario['operations'].items():
+            old = before['operations'].get(operation)
+            if old is not None and stats['commands'] > old['commands']:
+                found.append("{} {}: {} -> {} commands".format(
+                    scenario['name'], operation, old['commands'], stats['commands']))
+    return found
+
+
+async def run(args):
+    scenarios = SCENARIOS
+    if args.scenario:
+        scenarios = [tuple(int(part) for part in spec.split(',')) for spec in args.scenario]
+    results = {'latency': args.latency, 'baud': args.baud, 'repeat': args.repeat, 'tcp': args.tcp, 'scenarios': []}
+    for zones, sources, channels, units in scenarios:
+        scenario = await run_scenario(zones, sources, channels, units, repeat=args.repeat,
+                                      latency=args.latency, baud=args.baud, tcp=args.tcp)
+        print("{name}: startup {startup_s}s, {startup_commands} commands".format(**scenario), file=sys.stderr)
+        results['scenarios'].append(scenario)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenario', action='append',
+                        help='zones,sources,channels,units; can be repeated, default runs the built in set')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='runs of each operation per zone')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY, help='seconds per command on the unit')
+    parser.add_argument('--baud', type=int, default=DEFAULT_BAUD)
+    parser.add_argument('--tcp', action='store_true', help='serve the emulator on a TCP port, as a gateway would')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare command counts with')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as previous:
+            found = regressions(results, json.load(previous))
+        for regression in found:
+            print("REGRESSION " + regression, file=sys.stderr)
+        sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+"""
+Emulator of XAP800 / XAP400 units speaking the serial protocol, as a stand-in for the hardware.
+
+The emulator keeps the gain and mute of every input and output, and the routing and level of every crosspoint, for
+each emulated unit, and answers the commands the platform uses: GAIN, MUTE, MTRX (including "*" column queries),
+MTRXLVL, RAMP, LVL (including "*" group queries) and VER.  A RAMP moves the gain towards its target as time passes,
+until the target or a GAIN write; with ramps=False the units answer RAMP with an error, as units without it do.
+Inputs can be addressed as I channels, or as expansion bus (E, O..Z) and processing (P, A..H) channels, so multi unit
+setups with expansion buses can be exercised.  Commands for a unit that is not emulated get no reply, as on a real
+link.  Every channel's level meter reads silence until set_signal() gives it a level, with random jitter if wanted.
+change() makes a change as another controller would, and sends it to the client unasked, as units reporting changes
+do.
+
+It is served on a pty, so XAPConnection talks to it exactly as it would to a serial port, or with start_tcp() on a
+TCP port, as a serial-over-IP gateway would serve the units.  Each command can be given a processing latency, and the
+link can be throttled to a baud rate, so timing measurements are realistic:
+
+    emulator = XAPEmulator(units=(0, 1), latency=0.005, baud=38400)
+    path = await emulator.start()
+    ...
+    await emulator.stop()
+
+Like a gateway, the TCP port serves one client at a time, and drop() closes its connection, to exercise reconnecting.
+
+It can also be run on its own, printing the pty path or tcp:// address to point the platform at:
+
+    python -m xap_controller.emulator --units 0 1 --latency 0.005 --baud 38400
+    python -m xap_controller.emulator --units 0 1 --tcp 7000
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import pty
+import random
+import time
+import tty
+from collections import Counter
+
+from .routing import MATRIX_GEOMETRY
+from .transport import (
+    DEVICE_TYPE, GAIN_RANGE, INPUT_GROUP_CHANNELS, MATRIX_LEVEL_RANGE, METER_RANGE, RAMP_RATE_RANGE, parse_channel)
+
+_LOGGER = logging.getLogger(__name__)
+
+VERSION = '1.0'
+BITS_PER_BYTE = 10  # 8N1: start bit, 8 data bits, stop bit
+
+
+class EmulatedUnit:
+    """
+    State of one emulated unit
+    """
+
+    def __init__(self, unitCode, XAPType="XAP800"):
+        self.unitCode = unitCode
+        self.matrixGeo = MATRIX_GEOMETRY[XAPType]
+        self.gain = {}     # (channel, group): dB
+        self.mute = {}     # (channel, group): 0/1
+        self.routing = {}  # (inChannel, inGroup, outChannel): routing value
+        self.level = {}    # (inChannel, inGroup, outChannel): dB
+        self.ramps = {}    # (channel, group): (start dB, target dB, dB per second, time started)
+        self.signal = {}   # (channel, group): (dB the level meter reads, +/- dB of random jitter)
+
+    def current_gain(self, channel, group):
+        """Gain of a channel in dB, following a ramp on it"""
+        if (channel, group) in self.ramps:
+            start, target, rate, started = self.ramps[(channel, group)]
+            moved = rate * (time.monotonic() - started)
+            if moved >= abs(target - start):
+                del self.ramps[(channel, group)]
+                self.gain[(channel, group)] = target
+            else:
+                self.gain[(channel, group)] = start + moved * (1 if target > start else -1)
+        return self.gain.get((channel, group), 0.0)
+
+    def meter(self, channel, group):
+        """Level a channel's meter reads in dB"""
+        level, jitter = self.signal.get((channel, group), (METER_RANGE[0], 0.0))
+        return min(max(level + random.uniform(-jitter, jitter), METER_RANGE[0]), METER_RANGE[1])
+
+    def channels(self, group):
+        """Valid channels of a group"""
+        if group in ('I', 'O'):
+            return tuple(range(1, self.matrixGeo + 1))
+        return INPUT_GROUP_CHANNELS.get(group, ())
+
+
+class XAPEmulator:
+    """
+    One or more emulated units on a shared link
+    """
+
+    def __init__(self, units=(0,), XAPType="XAP800", latency=0.0, baud=None, command_latency=None, echo=True,
+                 ramps=True):
+        """latency is the processing time of every command in seconds, command_latency overrides it per command,
+        baud throttles the link to that rate, None for no throttling, echo sends changes made with change(),
+        ramps=False rejects RAMP"""
+        self.XAPType = XAPType
+        self.units = {int(unitCode): EmulatedUnit(int(unitCode), XAPType) for unitCode in units}
+        self.latency = latency
+        self.command_latency = dict(command_latency or {})
+        self.baud = baud
+        self.echo = echo
+        self.ramps = ramps
+        self.commands = Counter()  # commands received, by command name
+        self.received = []         # every line received, in order
+        self._device = DEVICE_TYPE[XAPType]
+        self._master = None
+        self._slave = None
+        self._server = None  # TCP server, when served with start_tcp
+        self._client = None  # StreamWriter of the connected TCP client
+        self._handlers = set()  # tasks reading from TCP clients
+        self._buffer = bytearray()
+        self._lines = None
+        self._worker = None
+
+    def _transfer_time(self, nbytes):
+        return nbytes * BITS_PER_BYTE / self.baud if self.baud else 0
+
+    def _feed(self, data):
+        """Queue the complete command lines in data"""
+        self._buffer.extend(data)
+        while b'\r' in self._buffer:
+            end = self._buffer.index(b'\r')
+            self._lines.put_nowait(bytes(self._buffer[:end]))
+            del self._buffer[:end + 1]
+
+    async def start(self):
+        """Open a pty and start answering on it, returns the path to connect to"""
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self._lines = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+
+        def readable():
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            self._feed(data)
+
+        loop.add_reader(self._master, readable)
+        self._worker = loop.create_task(self._serve())
+        path = os.ttyname(self._slave)
+        _LOGGER.debug("Emulating {} units {} on {}".format(self.XAPType, sorted(self.units), path))
+        return path
+
+    async def start_tcp(self, host='127.0.0.1', port=0):
+        """Listen on a TCP port and answer the client connected to it, returns the tcp:// path to connect to,
+        port 0 picks a free port"""
+        self._lines = asyncio.Queue()
+        self._server = await asyncio.start_server(self._serve_client, host, port)
+        self._worker = asyncio.get_running_loop().create_task(self._serve())
+        host, port = self._server.sockets[0].getsockname()[:2]
+        path = "tcp://{}:{}".format(host, port)
+        _LOGGER.debug("Emulating {} units {} on {}".format(self.XAPType, sorted(self.units), path))
+        return path
+
+    async def _serve_client(self, reader, writer):
+        """Read commands from a TCP client, a new client replaces the one connected, as on a gateway port"""
+        if self._client is not None:
+            self._client.close()
+        self._client = writer
+        self._buffer.clear()
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                self._feed(data)
+        except OSError:
+            pass
+        finally:
+            if self._client is writer:
+                self._client = None
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+
+    def drop(self):
+        """Close the connection of the TCP client, as a gateway restarting would"""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def stop(self):
+        """Stop answering and close the pty or TCP port"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._master is not None:
+            asyncio.get_running_loop().remove_reader(self._master)
+            os.close(self._master)
+            os.close(self._slave)
+            self._master = self._slave = None
+        if self._server is not None:
+            self.drop()
+            await asyncio.gather(*self._handlers)  # they end as their connection is closed
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self):
+        while True:
+            line = await self._lines.get()
+            text = line.decode('ascii', 'replace').strip()
+            if not text:
+                continue
+            fields = text.split()
+            command = fields[1].upper() if len(fields) > 1 else ''
+            await asyncio.sleep(self._transfer_time(len(line) + 1)
+                                + self.command_latency.get(command, self.latency))
+            replies = self.handle(text)
+            if replies:
+                data = "".join(reply + "\r\n" for reply in replies).encode('ascii')
+                await asyncio.sleep(self._transfer_time(len(data)))
+                self.write(data)
+
+    def write(self, data):
+        """Send raw bytes to the connected client"""
+        if self._client is not None:
+            self._client.write(data)
+        elif self._master is not None:
+            os.write(self._master, data)
+
+    def change(self, text):
+        """Process a command as if it came from another controller or the front panel, sending the change to the
+        client unasked if echo is on, returns the reply lines"""
+        replies = self._apply(text, count=False)
+        if self.echo and replies and (self._master is not None or self._client is not None):
+            self.write("".join(reply + "\r\n" for reply in replies).encode('ascii'))
+        return replies
+
+    def set_signal(self, unitCode, channel, group, level, jitter=0.0):
+        """Set the level in dB a channel's meter reads, varying by up to jitter dB either way"""
+        self.units[int(unitCode)].signal[(channel, group)] = (float(level), float(jitter))
+
+    def handle(self, text):
+        """Process one command line, returns the reply lines"""
+        self.received.append(text)
+        return self._apply(text)
+
+    def _apply(self, text, count=True):
+        fields = text.split()
+        if len(fields) < 2 or not fields[0].startswith('#') or len(fields[0]) < 3:
+            return ["ERROR {}".format(text)]
+        device, unitCode, command, args = fields[0][1], fields[0][2:], fields[1].upper(), fields[2:]
+        if device != self._device or not unitCode.isdigit() or int(unitCode) not in self.units:
+            return []  # not addressed to an emulated unit, nobody answers
+        unit = self.units[int(unitCode)]
+        if count:
+            self.commands[command] += 1
+        handler = getattr(self, '_cmd_' + command, None)
+        try:
+            if handler is None:
+                raise ValueError('unknown command')
+            replies = handler(unit, args)
+        except (ValueError, IndexError, KeyError):
+            return ["ERROR {}".format(text)]
+        return ["{} {} {}".format(fields[0], command, reply) for reply in replies]
+
+    @staticmethod
+    def _channel(unit, channel, group):
+        channel = parse_channel(channel)
+        if channel not in unit.channels(group):
+            raise ValueError('invalid channel')
+        return channel
+
+    @staticmethod
+    def _ranged(value, mode, current, limits):
+        value = float(value) + (current if mode == 'R' else 0)
+        return min(max(value, limits[0]), limits[1])
+
+    @staticmethod
+    def _switch(value, current, choices):
+        value = int(value)
+        if value == 2:  # toggle
+            return 0 if current else 1
+        if value not in choices:
+            raise ValueError('invalid value')
+        return value
+
+    def _cmd_VER(self, unit, args):
+        return [VERSION]
+
+    def _cmd_GAIN(self, unit, args):
+        channel, group = self._channel(unit, args[0], args[1]), args[1]
+        current = unit.current_gain(channel, group)
+        if len(args) > 2:
+            mode = args[3] if len(args) > 3 else 'A'
+            unit.ramps.pop((channel, group), None)
+            current = unit.gain[(channel, group)] = self._ranged(args[2], mode, current, GAIN_RANGE)
+        return ["{} {} {:.2f} A".format(args[0], group, current)]
+
+    def _cmd_RAMP(self, unit, args):
+        if not self.ramps:
+            raise ValueError('unknown command')
+        channel, group = self._channel(unit, args[0], args[1]), args[1]
+        rate = float(args[2])
+        if not RAMP_RATE_RANGE[0] <= rate <= RAMP_RATE_RANGE[1]:
+            raise ValueError('invalid rate')
+        target = self._ranged(args[3], 'A', 0.0, GAIN_RANGE)
+        unit.ramps[(channel, group)] = (unit.current_gain(channel, group), target, rate, time.monotonic())
+        return ["{} {} {:.2f} {:.2f}".format(args[0], group, rate, target)]
+
+    def _cmd_MUTE(self, unit, args):
+        channel, group = self._channel(unit, args[0], args[1]), args[1]
+        current = unit.mute.get((channel, group), 0)
+        if len(args) > 2:
+            current = unit.mute[(channel, group)] = self._switch(args[2], current, (0, 1))
+        return ["{} {} {}".format(args[0], group, current)]
+
+    def _cmd_MTRX(self, unit, args):
+        inGroup, outGroup = args[1], args[3]
+        outChannel = self._channel(unit, args[2], outGroup)
+        if args[0] == '*' and len(args) == 4:
+            return ["{} {} {} {} {}".format(inChannel, inGroup, args[2], outGroup,
+                                             unit.routing.get((inChannel, inGroup, outChannel), 0))
+                    for inChannel in unit.channels(inGroup)]
+        inChannel = self._channel(unit, args[0], inGroup)
+        current = unit.routing.get((inChannel, inGroup, outChannel), 0)
+        if len(args) > 4:
+            current = unit.routing[(inChannel, inGroup, outChannel)] = self._switch(args[4], current, (0, 1, 3))
+        return ["{} {}".format(" ".join(args[:4]), current)]
+
+    def _cmd_MTRXLVL(self, unit, args):
+        inGroup, outGroup = args[1], args[3]
+        inChannel, outChannel = self._channel(unit, args[0], inGroup), self._channel(unit, args[2], outGroup)
+        current = unit.level.get((inChannel, inGroup, outChannel), 0.0)
+        if len(args) > 4:
+            mode = args[5] if len(args) > 5 else 'A'
+            current = unit.level[(inChannel, inGroup, outChannel)] = self._ranged(
+                args[4], mode, current, MATRIX_LEVEL_RANGE)
+        return ["{} {:.2f} A".format(" ".join(args[:4]), current)]
+
+    def _cmd_LVL(self, unit, args):
+        group, kind = args[1], args[2]
+        channels = unit.channels(group) if args[0] == '*' else (self._channel(unit, args[0], group),)
+        return ["{} {} {} {:.2f}".format(channel, group, kind, unit.meter(channel, group)) for channel in channels]
+
+
+def main():
+    """Serve an emulator on a pty until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--type', default='XAP800', choices=sorted(MATRIX_GEOMETRY))
+    parser.add_argument('--units', type=int, nargs='+', default=[0])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to process each command')
+    parser.add_argument('--baud', type=int, default=None, help='throttle the link to this baud rate')
+    parser.add_argument('--no-ramps', action='store_true', help='reject RAMP, as units without it do')
+    parser.add_argument('--tcp', type=int, default=None, metavar='PORT',
+                        help='serve on this TCP port, as a serial-over-IP gateway, instead of a pty')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on with --tcp')
+    args = parser.parse_args()
+
+    async def serve():
+        emulator = XAPEmulator(units=args.units, XAPType=args.type, latency=args.latency, baud=args.baud,
+                               ramps=not args.no_ramps)
+        if args.tcp is not None:
+            print(await emulator.start_tcp(args.host, args.tcp), flush=True)
+        else:
+            print(await emulator.start(), flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await emulator.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
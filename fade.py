@@ -0,0 +1,87 @@
+"""
+Fades: move the gain of several channels to a new volume over a number of seconds.
+
+Where the unit supports it, each physical channel is sent one RAMP command and the unit moves the gain itself, so a
+fade costs one command per channel however long it lasts, and a fade of every zone in the house a handful.  Channels
+on units that reject RAMP are stepped from here instead.  A stepped fade claims its channels' gain writes from the
+link budget of the connection's statistics, see stats.py, and spaces its steps by the budget interval, so stepped
+fades and whatever else draws on the budget, such as the meters, together take at most stats.LINK_SHARE of the link,
+which leaves the rest to everything else and keeps a long fade from flooding the queue.  Fades of several zones
+started together share that budget, so each gets steps further apart.  Each step is queued for all the channels of a
+fade at once.
+"""
+
+import asyncio
+import logging
+
+from .transport import RAMP_RATE_RANGE, XAPUnsupported, prop_to_gain
+
+_LOGGER = logging.getLogger(__name__)
+
+MIN_STEP_INTERVAL = 0.25  # seconds between host side steps, at least
+
+
+def ramp_rate(current, volume, duration):
+    """dB per second that moves the gain from current to volume (0..1) in duration seconds, the fastest for 0"""
+    if duration <= 0:
+        return RAMP_RATE_RANGE[1]
+    return abs(prop_to_gain(volume) - prop_to_gain(current)) / duration
+
+
+def step_interval(xapstate):
+    """Seconds between host side steps, so the link budget of the connection is kept"""
+    return max(MIN_STEP_INTERVAL, xapstate.stats.budget_interval())
+
+
+async def async_fade_channels(xapstate, channels, volume, duration=None, rate=None):
+    """Fade channels (routing.Channel) of one state model to volume (0..1), over duration seconds or at rate dB
+    per second, returns the number of channels the units ramped themselves"""
+    current = {channel: xapstate.cachedPropGain(channel.channel, group=channel.group, unitCode=channel.unit)
+               for channel in channels}
+    ramps = []
+    for channel in channels:
+        gain = volume if current[channel] is None else current[channel]
+        channel_rate = rate if rate is not None else ramp_rate(gain, volume, duration)
+        ramps.append(xapstate.rampGain(channel.channel, volume, channel_rate, group=channel.group,
+                                       unitCode=channel.unit))
+    results = await asyncio.gather(*ramps, return_exceptions=True)
+    stepped = []
+    for channel, result in zip(channels, results):
+        if isinstance(result, XAPUnsupported):
+            stepped.append(channel)
+        elif isinstance(result, Exception):
+            raise result
+    if stepped:
+        if duration is None:
+            # as long as the slowest channel would have taken to ramp at rate
+            duration = max(abs(prop_to_gain(volume) - prop_to_gain(volume if current[channel] is None
+                                                                   else current[channel])) / rate
+                           for channel in stepped)
+        await async_step_fade(xapstate, stepped, volume, duration)
+    return len(channels) - len(stepped)
+
+
+async def async_step_fade(xapstate, channels, volume, duration):
+    """Fade channels to volume over duration seconds with gain writes from here"""
+    loop = asyncio.get_running_loop()
+    begin = {channel: xapstate.cachedPropGain(channel.channel, group=channel.group, unitCode=channel.unit)
+             for channel in channels}
+    start = loop.time()
+    steps = 0
+    claimant = object()  # this fade
+    xapstate.stats.claim(claimant, len(channels), 'GAIN', set(channel.unit for channel in channels))
+    try:
+        done = 0.0
+        while done < 1.0:
+            # the interval is worked out again for every step, as other fades start and end
+            await asyncio.sleep(min(step_interval(xapstate), max(0.0, start + duration - loop.time())))
+            done = min(1.0, (loop.time() - start) / duration) if duration > 0 else 1.0
+            await asyncio.gather(*[
+                xapstate.setPropGain(channel.channel, volume if gain is None else gain + (volume - gain) * done,
+                                     group=channel.group, unitCode=channel.unit)
+                for channel, gain in begin.items()])
+            steps += 1
+    finally:
+        xapstate.stats.release(claimant)
+    _LOGGER.debug("Stepped {} channels to {} in {} steps, took {:.2f}s".format(
+        len(channels), volume, steps, loop.time() - start))
@@ -106,14 +106,34 @@ media_player:
    "<unit#>:<input#>:<bus letter>:<bus type>. 
    Bus and Bus type are optional, but are needed if using more than 1 unit and you want a source to be available 
    on outputs in other units.
-* path: serial device path (can be a virtual serial port, using socat for example)
+* path: serial device path, or "tcp://<host>:<port>" of a serial-over-IP gateway such as ser2net
 * name: the name of the platform instance
 * stereo: 1=stereo, 0=mono  If stereo=1, each action will be performed twice on the input (output) and input+1 (output)+1
-* baud: baud rate of serial port, 38400 (default), 9600, 19200, 57600
+* baud: baud rate of serial port, 38400 (default), 9600, 19200, 57600, set on the gateway for a tcp:// path
+* links: unit code: path of the serial port or gateway of a unit that has its own, units not listed use path.
+   Commands for units on different links are sent in parallel.
+* sync: true to make all the channels of each source and zone match the first one at startup, false (default).
+   The sync service does the same for the sources and zones it targets.
+* trims: zone name: source name: crosspoint level in dB (-60..12) of the source in that zone, set at startup.
+   Sources not listed keep the level they have.
+* record: file in the config directory to record every line sent to and received from the units to, replaced at
+   each start, compressed if it ends in .gz.  A path of "replay://<file>" replays such a recording instead.
+* meter_rate: levels per second shown by the level sensors of the sources and zones, up to 2, 0 (default) for no
+  meters.
+* meter_threshold: dB a level has to change by for its sensor to be updated, 3 (default).
+* live_level: dB above which a source or zone is live, -50 (default).  Crossing it always updates the sensor.
 * XAPType: XAP unit type, eithr XAP800 (default) or XAP400
+* min_interval: minimum seconds between two gain or mute writes to the same channel, 0.05 (default).  Writes that
+   arrive faster, such as from dragging a volume slider, are merged so only the latest value is sent.
+* poll_min_interval, poll_max_interval: seconds between background sweeps that pick up changes made outside
+   HomeAssistant, 5 and 60 (default).  Sweeps are frequent after activity and back off to the max when idle.
+   poll_max_interval: 0 disables polling.
 
 """
 
+import asyncio
+import functools
+import json
 import time
 import logging
 import voluptuous as vol
@@ -127,17 +147,29 @@ from homeassistant.components.media_player.const import (
     SUPPORT_VOLUME_SET, SUPPORT_SELECT_SOURCE, MEDIA_TYPE_MUSIC)
 
 from homeassistant.const import (
-    STATE_OFF, STATE_ON, CONF_NAME)
+    STATE_OFF, STATE_ON, CONF_NAME, EVENT_HOMEASSISTANT_STOP)
 
 import homeassistant.helpers.config_validation as cv
-
-REQUIREMENTS = [
-   'https://github.com/jslove/XAPX00/archive/0.2.8.2.zip'
-   '#XAPX00==0.2.8.2' ]
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers import discovery, entity_platform
+from homeassistant.helpers.storage import Store
+from homeassistant.util import slugify
+
+from . import DATA_HASS_CONFIG, DOMAIN
+from .fade import async_fade_channels
+from .meter import XAPMeters, DEFAULT_LIVE_LEVEL, DEFAULT_METER_THRESHOLD
+from .reconcile import XAPReconciler, DEFAULT_POLL_MIN_INTERVAL, DEFAULT_POLL_MAX_INTERVAL
+from .routing import RoutingError, RoutingTable, input_channels, output_channels
+from .scene import async_apply_scene
+from .scheduler import XAPScheduler, DEFAULT_MIN_INTERVAL
+from .session import SessionRecorder  # also adds replay:// links
+from .state import XAPState
+from .transport import (
+    XAPLinks, XAPError, DEFAULT_BAUD, MATRIX_LEVEL_RANGE, PRIORITY_AUTOMATION, PRIORITY_INTERACTIVE,
+    RAMP_RATE_RANGE, command_priority, request_priority)
 
 testing = 0
 
-DOMAIN = 'xap_controller'
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -147,9 +179,41 @@ CONF_PATH     = 'path'
 CONF_STEREO   = 'stereo'
 CONF_BAUD     = 'baud'
 CONF_TYPE     = 'XAPType'
+CONF_MIN_INTERVAL = 'min_interval'
+CONF_POLL_MIN_INTERVAL = 'poll_min_interval'
+CONF_POLL_MAX_INTERVAL = 'poll_max_interval'
+CONF_LINKS    = 'links'
+CONF_SYNC     = 'sync'
+CONF_TRIMS    = 'trims'
+CONF_RECORD   = 'record'
+CONF_METER_RATE = 'meter_rate'
+CONF_METER_THRESHOLD = 'meter_threshold'
+CONF_LIVE_LEVEL = 'live_level'
 
 SRC_OFF = 'Off'
 
+SERVICE_APPLY_SCENE = 'apply_scene'
+SERVICE_DUMP_DIAGNOSTICS = 'dump_diagnostics'
+SERVICE_FADE = 'fade'
+SERVICE_RAMP = 'ramp'
+SERVICE_SYNC = 'sync'
+SERVICE_SET_TRIM = 'set_trim'
+SERVICE_APPLY_TRIMS = 'apply_trims'
+DIAGNOSTICS_FILE = 'xap_controller_diagnostics.json'
+STORAGE_VERSION = 1
+STORAGE_KEY = DOMAIN + '.{}'  # one store per serial port, holding its state model
+SAVE_DELAY = 10  # seconds to gather changes to the state model before saving it
+ATTR_ZONES  = 'zones'
+ATTR_CONNECTIONS = 'connections'
+ATTR_SOURCE = 'source'
+ATTR_VOLUME = 'volume'
+ATTR_MUTE   = 'mute'
+ATTR_DURATION = 'duration'
+ATTR_RATE   = 'rate'
+ATTR_TRIMS  = 'trims'
+ATTR_LEVEL  = 'level'
+DEFAULT_TRIM = 0.0  # dB, crosspoint level of sources not trimmed
+
 SUPPORT_XAP_ZONE = \
                    SUPPORT_VOLUME_MUTE | SUPPORT_VOLUME_SET | \
                    SUPPORT_TURN_ON | SUPPORT_TURN_OFF | \
@@ -167,6 +231,41 @@ ZONE_SOURCE_SCHEMA = vol.Schema({
     cv.string: vol.All(cv.ensure_list, [vol.Any(int,str)])
 })
 
+SCENE_SCHEMA = vol.Schema({
+    vol.Required(ATTR_ZONES): vol.Schema({
+        cv.string: vol.Schema({
+            vol.Optional(ATTR_SOURCE): cv.string,
+            vol.Optional(ATTR_VOLUME): vol.All(vol.Coerce(float), vol.Range(min=0, max=1)),
+            vol.Optional(ATTR_MUTE): cv.boolean,
+        })
+    })
+})
+
+LEVEL_SCHEMA = vol.All(vol.Coerce(float), vol.Range(min=MATRIX_LEVEL_RANGE[0], max=MATRIX_LEVEL_RANGE[1]))
+
+TRIMS_SCHEMA = vol.Schema({
+    cv.string: vol.Schema({cv.string: LEVEL_SCHEMA})
+})
+
+APPLY_TRIMS_SCHEMA = vol.Schema({
+    vol.Required(ATTR_TRIMS): TRIMS_SCHEMA,
+})
+
+SET_TRIM_SCHEMA = {
+    vol.Required(ATTR_SOURCE): cv.string,
+    vol.Required(ATTR_LEVEL): LEVEL_SCHEMA,
+}
+
+FADE_SCHEMA = {
+    vol.Required(ATTR_VOLUME): vol.All(vol.Coerce(float), vol.Range(min=0, max=1)),
+    vol.Required(ATTR_DURATION): vol.All(vol.Coerce(float), vol.Range(min=0)),
+}
+
+RAMP_SCHEMA = {
+    vol.Required(ATTR_VOLUME): vol.All(vol.Coerce(float), vol.Range(min=0, max=1)),
+    vol.Required(ATTR_RATE): vol.All(vol.Coerce(float), vol.Range(min=RAMP_RATE_RANGE[0], max=RAMP_RATE_RANGE[1])),
+}
+
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Required(CONF_PATH): cv.string,
     vol.Required(CONF_ZONES): ZONE_SOURCE_SCHEMA,
@@ -175,9 +274,21 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_NAME): cv.string,
     vol.Optional(CONF_STEREO): cv.boolean,
     vol.Optional(CONF_BAUD): int,
+    vol.Optional(CONF_MIN_INTERVAL, default=DEFAULT_MIN_INTERVAL): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_POLL_MIN_INTERVAL, default=DEFAULT_POLL_MIN_INTERVAL):
+        vol.All(vol.Coerce(float), vol.Range(min=1)),
+    vol.Optional(CONF_POLL_MAX_INTERVAL, default=DEFAULT_POLL_MAX_INTERVAL):
+        vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_LINKS, default={}): vol.Schema({vol.Coerce(int): cv.string}),
+    vol.Optional(CONF_SYNC, default=False): cv.boolean,
+    vol.Optional(CONF_TRIMS, default={}): TRIMS_SCHEMA,
+    vol.Optional(CONF_RECORD): cv.string,
+    vol.Optional(CONF_METER_RATE, default=0): vol.All(vol.Coerce(float), vol.Range(min=0, max=2)),
+    vol.Optional(CONF_METER_THRESHOLD, default=DEFAULT_METER_THRESHOLD): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_LIVE_LEVEL, default=DEFAULT_LIVE_LEVEL): vol.Coerce(float),
 })
 
-def setup_platform(hass, config, add_devices, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Setup the XAPX00 platform."""
     path = config.get(CONF_PATH)
 
@@ -188,39 +299,261 @@ def setup_platform(hass, config, add_devices, discovery_info=None):
 
     sources = config[CONF_SOURCES]
     _LOGGER.debug("Conf file sources: {}".format(sources))
-    
+    try:
+        routing = RoutingTable(sources, config[CONF_ZONES], config.get(CONF_TYPE))
+    except RoutingError as err:
+        _LOGGER.error("Invalid config: %s", err)
+        return False
+    for zone_name, zone_trims in config.get(CONF_TRIMS, {}).items():
+        if zone_name not in routing.outputs:
+            _LOGGER.error("Invalid config: trims of unknown zone %s", zone_name)
+            return False
+        unknown = [name for name in zone_trims if name not in routing.zone_routes(zone_name)]
+        if unknown:
+            _LOGGER.error("Invalid config: trims of %s name sources %s that are unknown or can't reach it",
+                          zone_name, unknown)
+            return False
 
-    from XAPX00 import XAPX00
-    _LOGGER.debug('XAPX00 version: {}'.format(XAPX00.__version__))
     _LOGGER.debug('XAP Type: {}'.format(config.get(CONF_TYPE)))
-    xapconn = XAPX00.XAPX00(path, XAPType=config.get(CONF_TYPE))
+    xapconn = XAPLinks(path, config.get(CONF_LINKS), baud=config.get(CONF_BAUD, DEFAULT_BAUD),
+                       XAPType=config.get(CONF_TYPE))
 
     if config.get(CONF_STEREO, 0) == 0:
         xapconn.stereo = 0
     else:
         xapconn.stereo = 1
 
-    xapconn.baud = config.get(CONF_BAUD, 38400)
-
-    xapconn.convertDb = 1
-    if not xapconn.test_connection():
-        _LOGGER.error('Not connected to %s', path)
+    recorder = None
+    if config.get(CONF_RECORD):
+        recorder = SessionRecorder(hass.config.path(config[CONF_RECORD]))
+        try:
+            await recorder.open()
+        except OSError as err:
+            _LOGGER.error('Unable to record the session to %s: %s', recorder.filename, err)
+            return
+        xapconn.recorder = recorder
+
+    try:
+        await xapconn.connect()
+    except (OSError, ValueError) as err:
+        _LOGGER.error('Unable to open %s: %s', xapconn, err)
+        if recorder is not None:
+            await recorder.close()
+        return
+    unanswered = await xapconn.test_links(routing.units())
+    if unanswered:
+        _LOGGER.error('Not connected to %s', ", ".join(unanswered))
+        await xapconn.close()
+        if recorder is not None:
+            await recorder.close()
         return
 
-    source_objs=[]
-    zonesources = {}
-    for source_name, source_input in sources.items():
-        sourceobj = XAPSource(
-            hass, xapconn, source_name, source_input)
-        add_devices([sourceobj])
-        source_objs.append(sourceobj)
-        zonesources[source_name] = sourceobj
-
-    zonesources[SRC_OFF] = 0
-
-    for zone_name, outputs in config[CONF_ZONES].items():
-        add_devices([XAPZone(
-            hass, xapconn, zonesources, zone_name, outputs)])
+    # set up every entity from the state saved at the last shutdown, checked against the device once they are
+    # up, or if nothing usable was saved read the device state in the background, each entity shown once the
+    # units it uses are read
+    scheduler = XAPScheduler(xapconn, config.get(CONF_MIN_INTERVAL, DEFAULT_MIN_INTERVAL))
+    xapstate = XAPState(scheduler)
+    store = Store(hass, STORAGE_VERSION, STORAGE_KEY.format(slugify(path)))
+    trimmed = set((xpt.unit, xpt.input, xpt.inGroup, xpt.output)
+                  for zone_name, zone_trims in config.get(CONF_TRIMS, {}).items()
+                  for source_name in zone_trims for xpt in routing.zone_routes(zone_name)[source_name])
+    restored = xapstate.load(await store.async_load(), routing.channels(), routing.crosspoints(), trimmed)
+    if not restored:
+        xapstate.start_loading(routing.channels(), routing.crosspoints(), trimmed)
+    xapstate.add_observer(lambda: store.async_delay_save(xapstate.as_dict, SAVE_DELAY))
+    xapconn.add_listener(xapstate.notified)
+    reconciler = XAPReconciler(xapstate, routing.channels(), routing.crosspoints(),
+                               config.get(CONF_POLL_MIN_INTERVAL, DEFAULT_POLL_MIN_INTERVAL),
+                               config.get(CONF_POLL_MAX_INTERVAL, DEFAULT_POLL_MAX_INTERVAL))
+    xapconn.add_reconnect_listener(reconciler.verify)  # read back whatever changed while the link was down
+    meters = None
+    if config.get(CONF_METER_RATE):
+        meters = XAPMeters(xapconn, routing.channels(), config[CONF_METER_RATE],
+                           config.get(CONF_METER_THRESHOLD, DEFAULT_METER_THRESHOLD),
+                           config.get(CONF_LIVE_LEVEL, DEFAULT_LIVE_LEVEL))
+        xapconn.add_listener(meters.notified)
+
+    async def async_close(event):
+        await reconciler.stop()
+        if meters is not None:
+            await meters.stop()
+        await xapstate.stop_loading()
+        await scheduler.close()
+        await xapconn.close()
+        if recorder is not None:
+            await recorder.close()
+        await store.async_save(xapstate.as_dict())
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_close)
+
+    data = hass.data.setdefault(DOMAIN, {})
+    data.setdefault(ATTR_CONNECTIONS, {})[path] = {
+        'name': config.get(CONF_NAME, 'XAP'),
+        'xapstate': xapstate,
+        'routing': routing,
+        'reconciler': reconciler,
+        'restored': restored,
+        'units': routing.units(),
+        'links': xapconn.links(routing.units()),
+        'meters': meters,
+    }
+    hass.async_create_task(discovery.async_load_platform(hass, 'sensor', DOMAIN, {CONF_PATH: path},
+                                                         data.get(DATA_HASS_CONFIG, {})))
+
+    # entities are built without touching the device and added at once, they read their state in
+    # async_added_to_hass
+    entities = [XAPSource(hass, xapstate, source_name, routing.inputs[source_name]) for source_name in sources]
+    zones = data.setdefault(ATTR_ZONES, {})
+    for zone_name in config[CONF_ZONES]:
+        zones[zone_name] = XAPZone(hass, xapstate, zone_name, routing.outputs[zone_name],
+                                   routing.zone_routes(zone_name), trims=config.get(CONF_TRIMS, {}).get(zone_name))
+        entities.append(zones[zone_name])
+    for entity in entities:
+        xapstate.listen(entity.watched_keys(), entity.external_change)
+    async_add_entities(entities)
+    reconciler.start(verify=restored)
+    if meters is not None:
+        meters.start()
+    if config.get(CONF_SYNC):
+        hass.async_create_task(async_sync_entities(entities))
+    if config.get(CONF_TRIMS):
+        # only the configured trims, crosspoints of sources not listed keep the level they have.  All are sent, as
+        # the levels in the model may have been restored and not verified yet
+        hass.async_create_task(async_apply_trims([(zones[zone_name], zone_trims)
+                                                  for zone_name, zone_trims in config[CONF_TRIMS].items()],
+                                                 force=True))
+
+    async def async_handle_scene(call):
+        """Set several zones at once, zones are looked up by their configured name"""
+        zone_settings = []
+        for zone_name, settings in call.data[ATTR_ZONES].items():
+            if zone_name not in zones:
+                raise HomeAssistantError("Scene zone {} not in set up zones".format(zone_name))
+            zone = zones[zone_name]
+            if settings.get(ATTR_SOURCE, SRC_OFF) not in zone.source_list:
+                raise HomeAssistantError("Requested source {} not in set up sources".format(settings[ATTR_SOURCE]))
+            zone_settings.append((zone, settings))
+        with request_priority(call_priority(call.context)):
+            await async_apply_scene(zone_settings)
+
+    if not hass.services.has_service(DOMAIN, SERVICE_APPLY_SCENE):
+        hass.services.async_register(DOMAIN, SERVICE_APPLY_SCENE, async_handle_scene, schema=SCENE_SCHEMA)
+
+    async def async_handle_apply_trims(call):
+        """Set the crosspoint levels of sources in several zones at once, zones are looked up by their configured
+        name"""
+        zone_trims = []
+        for zone_name, trims in call.data[ATTR_TRIMS].items():
+            if zone_name not in zones:
+                raise HomeAssistantError("Trimmed zone {} not in set up zones".format(zone_name))
+            zone_trims.append((zones[zone_name], trims))
+        with request_priority(call_priority(call.context)):
+            await async_apply_trims(zone_trims)
+
+    if not hass.services.has_service(DOMAIN, SERVICE_APPLY_TRIMS):
+        hass.services.async_register(DOMAIN, SERVICE_APPLY_TRIMS, async_handle_apply_trims,
+                                     schema=APPLY_TRIMS_SCHEMA)
+
+    async def async_handle_dump_diagnostics(call):
+        """Write the statistics and state model of every connection to a JSON file in the config directory"""
+        dump = {conn_path: diagnostics(connection)
+                for conn_path, connection in hass.data[DOMAIN][ATTR_CONNECTIONS].items()}
+        filename = hass.config.path(DIAGNOSTICS_FILE)
+
+        def write():
+            with open(filename, 'w') as out:
+                json.dump(dump, out, indent=2, default=str)
+        await hass.async_add_executor_job(write)
+        _LOGGER.info("Wrote diagnostics of %s to %s", list(dump), filename)
+
+    if not hass.services.has_service(DOMAIN, SERVICE_DUMP_DIAGNOSTICS):
+        hass.services.async_register(DOMAIN, SERVICE_DUMP_DIAGNOSTICS, async_handle_dump_diagnostics)
+
+    platform = entity_platform.async_get_current_platform()
+    platform.async_register_entity_service(SERVICE_FADE, FADE_SCHEMA, 'async_fade')
+    platform.async_register_entity_service(SERVICE_RAMP, RAMP_SCHEMA, 'async_ramp')
+    platform.async_register_entity_service(SERVICE_SYNC, {}, 'async_sync')
+    platform.async_register_entity_service(SERVICE_SET_TRIM, SET_TRIM_SCHEMA, 'async_set_trim')
+
+
+async def async_sync_entities(entities):
+    """Make the channels of every source and zone match their first one, all at once"""
+    start = time.monotonic()
+    with request_priority(PRIORITY_AUTOMATION):
+        results = await asyncio.gather(*[entity.async_sync() for entity in entities], return_exceptions=True)
+    for entity, result in zip(entities, results):
+        if isinstance(result, Exception):
+            _LOGGER.warning("Unable to sync %s: %s", entity, result)
+    _LOGGER.info("Synced %d sources and zones in %.2fs", len(entities), time.monotonic() - start)
+
+
+async def async_apply_trims(zone_trims, force=False):
+    """Set the crosspoint levels of sources in several zones, zone_trims is a list of (zone, {source name: dB})
+
+    Every zone's trims are checked before any is set.  The levels of all zones on one state model are merged and set
+    as one batch, sending only the crosspoints not already at their level, or all of them with force."""
+    start = time.monotonic()
+    for zone, trims in zone_trims:
+        zone.check_trims(trims)
+    for zone, trims in zone_trims:
+        zone.set_trims(trims)
+    batches = {}
+    for zone, trims in zone_trims:
+        batches.setdefault(zone.xapstate, {}).update(zone.trim_levels(list(trims)))
+    sent = await asyncio.gather(*[xapstate.setMatrixLevels(levels, force=force)
+                                  for xapstate, levels in batches.items()])
+    for zone, _trims in zone_trims:
+        if zone.hass is not None:
+            zone.async_write_ha_state()
+    _LOGGER.info("Trims of %d zones took %.3fs: %d crosspoints, %d sent", len(zone_trims), time.monotonic() - start,
+                 sum(len(levels) for levels in batches.values()), sum(sent))
+
+
+def call_priority(context):
+    """Interactive for a call a user made directly, automation for calls from automations, scripts and the rest"""
+    if context is not None and context.user_id is not None and context.parent_id is None:
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_AUTOMATION
+
+
+def prioritized(method):
+    """Send the commands of an entity service method with the priority of the call that started it: the priority
+    already set with request_priority, by a service handler or the entity method calling this one, or else that of
+    the context HomeAssistant sets on the entity right before calling the method for an entity service call"""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        priority = command_priority.get(None)
+        if priority is None:
+            priority = call_priority(self._context)
+        with request_priority(priority):
+            return await method(self, *args, **kwargs)
+    return wrapper
+
+
+def diagnostics(connection):
+    """Statistics of the link and summary of the state model of one connection"""
+    xapstate = connection['xapstate']
+    return {
+        'name': connection['name'],
+        'type': xapstate.XAPType,
+        'baud': xapstate.baud,
+        'min_interval': xapstate.min_interval,
+        'coalesced_writes': xapstate.coalesced,
+        'skipped_writes': xapstate.skipped,
+        'column_queries': xapstate.columns,
+        'replaced_writes': xapstate.replaced,
+        'shared_queries': xapstate.shared,
+        'poll_interval': connection['reconciler'].interval,
+        'poll_sweeps': connection['reconciler'].sweeps,
+        'external_changes': connection['reconciler'].changes,
+        'restored_state': connection['restored'],
+        'links': connection['links'],
+        'connected': xapstate.connected,
+        'reconnects': xapstate.reconnects,
+        'meter_readings': connection['meters'].readings if connection['meters'] is not None else None,
+        'meter_reports': connection['meters'].reports if connection['meters'] is not None else None,
+        'state': [repr(unit) for _unitCode, unit in sorted(xapstate.units.items())],
+        'stats': xapstate.stats.as_dict(connection['routing'].channel_names()),
+    }
 
 
 class XAPSource(MediaPlayerEntity):
@@ -228,72 +561,63 @@ class XAPSource(MediaPlayerEntity):
     Represents one source
     """
 
-    def __init__(self, hass, xapconn, source_name, source_inputs, unitCode=0):
+    def __init__(self, hass, xapstate, source_name, source_inputs, unitCode=0):
         """Initialise the XAPX00 source pseudo-device"""
         _LOGGER.debug("Setting Up Source %s" % source_name)
         self._name = source_name
-        self._xapx00 = xapconn
+        self._xapx00 = xapstate  # all device access goes through the state model
         self._state = STATE_ON
         self.xunit = 0
         self.xinput = None
         self.xgroup = "I"
         self.xbus = None
         self.xbusgroup = None
-        self._inputs = []
-        self.parse_source(source_inputs)
+        self._inputs = source_inputs  # compiled routing.Input tuples
+        self._channels = input_channels(source_inputs)  # physical inputs, each once, for gain and mute
         self.numChannels = len(self._inputs)
-        self._volume = self.get_volume_level()
-        self.set_volume_level(self._volume) # make sure synced
-        self.get_mute_status()
-        if self._isMuted:
-            self._state = STATE_OFF
-        self.mute_volume(self._isMuted) # sync
+        self._volume = None
+        self._isMuted = None  # the state is read from the model once the inputs' units are read
         _LOGGER.info("source {} set up".format(self.__str__()))
 
+    def units(self):
+        """Unit codes of the source's inputs"""
+        return set(s.unit for s in self._channels)
+
+    async def async_added_to_hass(self):
+        """Show the state of the inputs once their units are read, without holding up the other entities"""
+        self.hass.async_create_task(self.async_hydrate())
+
+    async def async_hydrate(self):
+        """Wait for the inputs' units to be read and show their state"""
+        try:
+            await self._xapx00.loaded(self.units())
+        except XAPError as err:
+            _LOGGER.warning("State of source {} not read: {}".format(self, err))
+        self.external_change()
+
+    @property
+    def available(self):
+        """False until the state of the inputs is known"""
+        first = self._inputs[0]
+        return self._xapx00.cachedPropGain(first.channel, group="I", unitCode = first.unit) is not None
+
+    @prioritized
+    async def async_sync(self):
+        """Make all inputs of the source match the state read from the first one"""
+        await self._xapx00.loaded(self.units())
+        self.get_volume_level()
+        self.get_mute_status()
+        await self.async_set_volume_level(self._volume) # make sure synced
+        await self.async_mute_volume(self._isMuted) # sync
+        if self.hass is not None:
+            self.async_write_ha_state()
+
     def __str__(self):
         return self._name
 
     def __repr__(self):
         return "{} ({})".format(self._name, self._inputs)
 
-    def parse_source(self, srcs):
-        "Split into input unit, input #, expansion bus, expansion bus group"
-        for src in srcs:
-            inpdict={'UNIT':0,'CHAN':None,'BUS':None, 'BUSGRP':'E', 'INPGRP':'I'} 
-            if issubclass(type(src), int):
-                inpdict['CHAN'] = src
-            elif issubclass(type(src), str):
-                if ":" in src:
-                    comps = src.count(':')
-                    if comps == 1:
-                        inpdict['UNIT'], inpdict['CHAN']  =  src.split(":")
-                    elif comps == 2:
-                        inpdict['UNIT'], inpdict['CHAN'], inpdict['BUS'] = src.split(":")
-                        XBUSGRP = 'E' # default to E
-                    elif comps == 3:
-                        inpdict['UNIT'], inpdict['CHAN'], inpdict['BUS'], inpdict['BUSGRP'] = src.split(":")
-                    inpdict['CHAN'] = int(inpdict['CHAN'])
-                    inpdict['UNIT'] = int(inpdict['UNIT'])
-                elif src.isdigit():
-                    inpdict['CHAN'] = int(src)
-                else:
-                    raise Exception('Invalid Input String')
-            else:
-                # shouldn't be able to get here
-                raise Exception('Invalid Source Input config format')
-            self._inputs.append(inpdict)
-        return
-
-    def getSource(self, outUnit, srcNum=0):
-        outUnit = int(outUnit)
-        srcNum = srcNum % self.numChannels  # wrap if request is greater than number of sources
-        if outUnit == self._inputs[srcNum]['UNIT']:
-            return  self._inputs[srcNum]['CHAN'],  self._inputs[srcNum]['INPGRP']
-        else:
-            if self._inputs[srcNum]['BUS'] is None:
-                raise Exception("Different unit but No Expansion Bus Defined")
-            return self._inputs[srcNum]['BUS'], self._inputs[srcNum]['BUSGRP']
-    
     def source_for_zones(self):
         raise Exception("Not Implemented")
         if self.xbus is not None:
@@ -333,134 +657,239 @@ class XAPSource(MediaPlayerEntity):
     def get_volume_level(self):
         """Volume level of the media player (0..1)."""
         vinp = self._inputs[0]
-        gain = self._xapx00.getPropGain(vinp['CHAN'], group="I", unitCode = vinp['UNIT'])
+        gain = self._xapx00.cachedPropGain(vinp.channel, group="I", unitCode = vinp.unit)
         self._volume = gain
         return self._volume
 
-    def set_volume_level(self, volume):
+    @prioritized
+    async def async_set_volume_level(self, volume):
         """Set volume level, range 0..1."""
-        for s in self._inputs:
-            volume = self._xapx00.setPropGain(s['CHAN'], volume,
-                                              isAbsolute=1, group="I", unitCode = s['UNIT'])
+        for s in self._channels:
+            volume = await self._xapx00.setPropGain(s.channel, volume,
+                                              isAbsolute=1, group=s.group, unitCode = s.unit)
         self._volume = volume
 
-    def turn_on(self):
+    @prioritized
+    async def async_turn_on(self):
         """Turn the media player on."""
-        self.mute_volume(mute=0)
+        await self.async_mute_volume(mute=0)
         self._state = STATE_ON
 
-    def turn_off(self):
+    @prioritized
+    async def async_turn_off(self):
         """Turn off media player."""
-        self.mute_volume(mute=1)
+        await self.async_mute_volume(mute=1)
         self._state = STATE_OFF
 
-    def mute_volume(self, mute=2):
+    @prioritized
+    async def async_mute_volume(self, mute=2):
         """Toggle mute"""
-        self._isMuted = self._xapx00.setMute(self._inputs[0]['CHAN'], group="I", isMuted=int(mute), unitCode = self._inputs[0]['UNIT'])
-        for s in self._inputs[1:]:
-            self._isMuted = self._xapx00.setMute(s['CHAN'], group="I", isMuted=self._isMuted, unitCode = s['UNIT'])            
+        first = self._channels[0]
+        self._isMuted = await self._xapx00.setMute(first.channel, group=first.group, isMuted=int(mute), unitCode = first.unit)
+        for s in self._channels[1:]:
+            self._isMuted = await self._xapx00.setMute(s.channel, group=s.group, isMuted=self._isMuted, unitCode = s.unit)
 
     def get_mute_status(self):
-        self._isMuted = self._xapx00.getMute(self._inputs[0]['CHAN'], group="I", unitCode = self._inputs[0]['UNIT'])
+        self._isMuted = self._xapx00.cachedMute(self._inputs[0].channel, group="I", unitCode = self._inputs[0].unit)
         return self._isMuted
 
+    @prioritized
+    async def async_fade(self, volume, duration):
+        """Fade to volume (0..1) over duration seconds"""
+        await async_fade_channels(self._xapx00, self._channels, volume, duration=duration)
+        self.get_volume_level()
+        if self.hass is not None:
+            self.async_write_ha_state()
+
+    @prioritized
+    async def async_ramp(self, volume, rate):
+        """Fade to volume (0..1) at rate dB per second"""
+        await async_fade_channels(self._xapx00, self._channels, volume, rate=rate)
+        self.get_volume_level()
+        if self.hass is not None:
+            self.async_write_ha_state()
+
+    async def async_set_trim(self, source, level):
+        """Trims are set per zone, xap_controller.set_trim targeting a source is an error"""
+        raise HomeAssistantError("{} is a source, trims can only be set on zones".format(self._name))
+
+    def watched_keys(self):
+        """State model keys that this source shows, to be told when they change outside HA"""
+        vinp = self._inputs[0]
+        return [('gain', vinp.unit, vinp.channel, 'I'), ('mute', vinp.unit, vinp.channel, 'I')]
+
+    def external_change(self):
+        """The inputs changed outside HA, show the new state from the model"""
+        self.get_volume_level()
+        self.get_mute_status()
+        self._state = STATE_OFF if self._isMuted else STATE_ON
+        if self.hass is not None:
+            self.async_write_ha_state()
+
 
 class XAPZone(MediaPlayerEntity):
     """
     Represents one or more XAP outputs, either mono or stereo
     """
-    def __init__(self, hass, xapconn, sources, zone_name, outputs, unitCode=0):
+    def __init__(self, hass, xapstate, zone_name, outputs, routes, unitCode=0, trims=None):
         """Initialise the XAPX00 zone pseudo-device"""
         self._name = zone_name
-        self._xapx00 = xapconn
+        self._xapx00 = xapstate  # all device access goes through the state model
         self._unitCode = unitCode
-        self._sources = sources #dict of source name:source obj
-        self._outputs = outputs
-        # outputs is a list of outputs, each element can be a single int or
-        # a string of "int:int" (unit:output)
-        self._volume = 0
-        self._defaultMatrixLevel = 1
-        self._isMuted = self.get_mute_status()
+        self._routes = routes # dict of source name: crosspoints to route it to this zone
+        self._outputs = outputs # compiled routing.Output tuples of (unit, output)
+        self._channels = output_channels(outputs)  # physical outputs, each once, for gain and mute
+        self._volume = None
+        self._defaultMatrixLevel = DEFAULT_TRIM
+        self._trims = {}  # source name: crosspoint level in dB, for sources not at the default
+        self.set_trims(trims or {})
+        self._isMuted = None  # the state is read from the model once the outputs' units are read
         self._active_source = SRC_OFF
-        self._active_source = self.get_source()
         self._poweroff_source = self._active_source
-        # make sure sources synced across outputs
-        self.select_source(self._active_source)
-        self.get_volume_level()
-        self._sync_volume_level()
-        self._state = STATE_ON if self._active_source != SRC_OFF else STATE_OFF
+        self._state = STATE_OFF
+        # held while the routing is changed, so each change is worked out from where the last one left it
+        self.routing_lock = asyncio.Lock()
         _LOGGER.info("zone {} set up".format(self.__str__()))
 
+    def units(self):
+        """Unit codes of the zone's outputs, where its crosspoints are too"""
+        return set(XUNIT for XUNIT, _XOUT, _group in self._channels)
+
+    async def async_added_to_hass(self):
+        """Show the state of the outputs once their units are read, without holding up the other entities"""
+        self.hass.async_create_task(self.async_hydrate())
+
+    async def async_hydrate(self):
+        """Wait for the outputs' units to be read and show their state"""
+        try:
+            await self._xapx00.loaded(self.units())
+        except XAPError as err:
+            _LOGGER.warning("State of zone {} not read: {}".format(self, err))
+        self.external_change()
+
+    @property
+    def available(self):
+        """False until the state of the outputs is known"""
+        XUNIT, XOUT = self._outputs[0]
+        return self._xapx00.cachedPropGain(XOUT, group="O", unitCode = XUNIT) is not None
+
+    @prioritized
+    async def async_sync(self):
+        """Make all outputs of the zone match the state read from the first one"""
+        await self._xapx00.loaded(self.units())
+        self.external_change()
+        # make sure sources synced across outputs
+        await self.async_select_source(self._active_source)
+        await self._async_sync_volume_level()
+        if self.hass is not None:
+            self.async_write_ha_state()
+
     def __str__(self):
         return self._name
-        
-    def parse_output(self, output):
-        "Returns (unit,output) "
-        if issubclass(type(output), int):
-            XUNIT = 0
-            XOUT = output
-        elif issubclass(type(output), str):
-            if ":" in output:
-                XUNIT, XOUT =  output.split(":")
-            elif output.isdigit():
-                XOUT = int(output)
-            else:
-                raise Exception('Invalid Output String')
-        else:
-            # shouldn't be able to get here
-            raise Exception('Invalid Output config format')
-        return int(XUNIT), int(XOUT)
-            
-    def update(self):
+
+    async def async_update(self):
 #        self.get_mute_status()
 #        self.get_volume_level()
-        pass  # can't be exchanged except by us, so can track state without calls
+        pass  # changes made outside HA are pushed from the state model, so no calls here
     
-    def select_source(self, source):
-        """Set the input source"""
+    @prioritized
+    async def async_select_source(self, source):
+        """Set the input source, only changing the crosspoints that differ between the two sources"""
+        async with self.routing_lock:
+            await self._async_select_source(source)
+
+    async def _async_select_source(self, source):
+        """Set the input source, with routing_lock held"""
         actsrc = self._active_source  # a string
-        _LOGGER.debug('select_source for zone={}: source={}, actsrc={}, self._sources={}'.format(
-            self._name, source, actsrc, self._sources.keys()))
-        if source not in self._sources:
+        _LOGGER.debug('select_source for zone={}: source={}, actsrc={}, sources={}'.format(
+            self._name, source, actsrc, self.source_list))
+        if source not in self.source_list:
             raise Exception("Requested source {} not in set up sources".format(source))
-        cnt=0
-        for xOut in self._outputs:
-            XUNIT, XOUT = self.parse_output(xOut)
-            if actsrc != SRC_OFF and actsrc != source:
-                XIN, XINGRP = self._sources[actsrc].getSource(XUNIT,cnt)
-                self._xapx00.setMatrixRouting(XIN, XOUT, 0, inGroup = XINGRP, unitCode = XUNIT) #turn current off
-                _LOGGER.debug('Turned off actsrc: {}'.format(actsrc))
-            if source != SRC_OFF: #and source in self._sources:
-                XIN, XINGRP = self._sources[source].getSource(XUNIT, cnt)
-                ON = 3 if (issubclass(type(XIN), int) and XIN <= (self._xapx00.matrixGeo-4)) else 1
-                # if a mike input on=3, if line on=1, last 4 inputs are line
-                self._xapx00.setMatrixRouting(XIN, XOUT, ON, inGroup = XINGRP, unitCode = XUNIT)
-                self._poweroff_source = source # in case turn_on called without calling turn_off
-            cnt += 1
+        # reselecting the active source resends every crosspoint, to make sure they are synced
+        before = self._crosspoints(actsrc) if actsrc != source else {}
+        after = self._crosspoints(source)
+        # each step queued at once, so crosspoints on units with their own link are switched in parallel
+        await asyncio.gather(*[
+            self._xapx00.setMatrixRouting(XIN, XOUT, 0, inGroup = XINGRP, unitCode = XUNIT) #turn current off
+            for (XUNIT, XIN, XINGRP, XOUT) in before if (XUNIT, XIN, XINGRP, XOUT) not in after])
+        await asyncio.gather(*[
+            self._xapx00.setMatrixRouting(XIN, XOUT, ON, inGroup = XINGRP, unitCode = XUNIT)
+            for (XUNIT, XIN, XINGRP, XOUT), ON in after.items() if before.get((XUNIT, XIN, XINGRP, XOUT)) != ON])
+        _LOGGER.debug('Switched {} from {} to {}: {} crosspoints off, {} on'.format(
+            self._name, actsrc, source, len(before.keys() - after.keys()), len(after.keys() - before.keys())))
+        if source != SRC_OFF:
+            self._poweroff_source = source # in case turn_on called without calling turn_off
         self._active_source = source
- 
+
+    def _crosspoints(self, source):
+        """Crosspoints that carry source to this zone, as {(unit, input, input group, output): ON value}
+        Each crosspoint is listed once, even if channels are repeated in the source or zone"""
+        if source == SRC_OFF:
+            return {}
+        return {(xpt.unit, xpt.input, xpt.inGroup, xpt.output): xpt.on for xpt in self._routes[source]}
+
+    @property
+    def xapstate(self):
+        """State model the zone's outputs belong to"""
+        return self._xapx00
+
+    def scene_commands(self, source=None, volume=None, mute=None):
+        """Crosspoints, gains and mutes that would put the zone in the given state, for merging into a scene"""
+        routing, gains, mutes = {}, {}, {}
+        if source is not None and source != self._active_source:
+            before = self._crosspoints(self._active_source)
+            after = self._crosspoints(source)
+            for xpt in before:
+                if xpt not in after:
+                    routing[xpt] = 0
+            for xpt, ON in after.items():
+                if before.get(xpt) != ON:
+                    routing[xpt] = ON
+        for XUNIT, XOUT, _group in self._channels:
+            if volume is not None:
+                gains[(XUNIT, XOUT)] = volume
+            if mute is not None:
+                mutes[(XUNIT, XOUT)] = int(mute)
+        return routing, gains, mutes
+
+    def scene_applied(self, source=None, volume=None, mute=None):
+        """Update the zone after a scene including it was sent"""
+        if source is not None:
+            if source != SRC_OFF:
+                self._poweroff_source = source
+            self._active_source = source
+            self._state = STATE_ON if source != SRC_OFF else STATE_OFF
+        if volume is not None:
+            self.get_volume_level()
+        if mute is not None:
+            self.get_mute_status()
+        if self.hass is not None:
+            self.async_write_ha_state()
+
     def get_source(self):
-        """Get first active source for outputs in this zone
-           Since an input can be part of multiple sources, need to make this more sophisticated,
-           need to for all channels being on.
+        """Get the active source for outputs in this zone from the matrix read at startup
+           A source is active when all of its crosspoints to the zone are on.  Since an input can be part
+           of multiple sources, a source with only some crosspoints on is only used if no source has all
+           of them on, picking the one with the most.
         """
         _LOGGER.debug("In get_source for {}".format(self))
-        _LOGGER.debug("  Checking: {}".format(self._sources))
-        for xIn in self._sources.values():
-            if xIn != self._sources[SRC_OFF]:
-                XUNIT, XOUT = self.parse_output(self._outputs[0])
-                XIN, XINGRP = xIn.getSource(XUNIT)
-                z_state = int(self._xapx00.getMatrixRouting(XIN,
-                                                            XOUT,
-                                                            inGroup = XINGRP,
-                                                            unitCode = XUNIT))
-                _LOGGER.debug("matrix routing for {}={}". format(xIn, z_state))
-                if z_state > 0:
-                    self._active_source = xIn.__str__()
-                    break
+        _LOGGER.debug("  Checking: {}".format(list(self._routes)))
+        best, best_on = None, 0
+        for source_name, crosspoints in self._routes.items():
+            on = sum(1 for xpt in crosspoints
+                     if self._xapx00.cachedMatrixRouting(xpt.input, xpt.output,
+                                                         inGroup = xpt.inGroup, unitCode = xpt.unit))
+            _LOGGER.debug("matrix routing for {}: {} of {} on". format(source_name, on, len(crosspoints)))
+            if on == len(crosspoints):
+                best = source_name
+                break
+            if on > best_on:
+                best, best_on = source_name, on
+        if best is not None:
+            self._active_source = best
         _LOGGER.debug("get_source for %s = %s" % (self._name, self._active_source))
         return self._active_source
-        
+
     @property
     def name(self):
         """Return the name of the zone."""
@@ -495,90 +924,161 @@ class XAPZone(MediaPlayerEntity):
         """ return mute status"""
         return bool(self._isMuted)
 
-    def setDefaultLevel(self):
-        """  set all crosspoint levels to default """
-        cnt = 0
-        for xOut in self._outputs:
-            XUNIT, XOUT = self.parse_output(xOut)
-            for xIn in self._sources.values():
-                XIN, XINGRP = xIn.getSource(XUNIT,cnt)
-                self._xapx00.setMatrixLevel(XIN, XOUT,
-                                            self._defaultMatrixLevel,
-                                            inGroup =  XINGRP,
-                                            unitCode = XUNIT)
-            cnt += 1
+    def check_trims(self, trims):
+        """Raise if any source of trims, as for set_trims, can't be trimmed in this zone"""
+        unknown = [source for source in trims if source not in self._routes]
+        if unknown:
+            raise HomeAssistantError("Trimmed sources {} not in the sources set up for {}".format(
+                unknown, self._name))
+
+    def set_trims(self, trims):
+        """Set the crosspoint level in dB of some sources, as {source name: dB}, without sending anything"""
+        self.check_trims(trims)
+        for source, level in trims.items():
+            self._trims[source] = float(level)
+
+    def trim_levels(self, sources=None):
+        """Level of the crosspoints of the given sources, all by default, as {(unit, input, input group, output): dB},
+        the trim of the source or the default.  A crosspoint carrying several sources gets the trim set for one of
+        them."""
+        levels = {}
+        for source in (self._routes if sources is None else sources):
+            for xpt in self._routes[source]:
+                level = self._trims.get(source)
+                if level is not None or (xpt.unit, xpt.input, xpt.inGroup, xpt.output) not in levels:
+                    levels[(xpt.unit, xpt.input, xpt.inGroup, xpt.output)] = (
+                        self._defaultMatrixLevel if level is None else level)
+        return levels
+
+    @property
+    def extra_state_attributes(self):
+        """Crosspoint level in dB of each source"""
+        return {ATTR_TRIMS: {source: self._trims.get(source, self._defaultMatrixLevel) for source in self._routes}}
+
+    @prioritized
+    async def async_set_trim(self, source, level):
+        """Set the crosspoint level in dB of a source in this zone"""
+        self.set_trims({source: level})
+        await self._xapx00.setMatrixLevels(self.trim_levels([source]))
+        if self.hass is not None:
+            self.async_write_ha_state()
+
+    @prioritized
+    async def async_setDefaultLevel(self):
+        """Set every crosspoint of the zone to the trim of its source, or the default, sending only the ones
+        not already at that level"""
+        await self._xapx00.setMatrixLevels(self.trim_levels())
 
 #   not used
-    def clear_matrix(self):
+    async def async_clear_matrix(self):
         """ set all crosspoints to off"""
-        for xOut in self._outputs:
-            XUNIT, XOUT = self.parse_output(xOut)
+        for XUNIT, XOUT, _group in self._channels:
             for xIn in self._xapx00.input_range:
-                self._xapx00.setMatrixRouting(xIn, xOut, 0, unitCode=XUNIT)
+                await self._xapx00.setMatrixRouting(xIn, XOUT, 0, unitCode=XUNIT)
             for xIn in list(ascii_uppercase[ascii_uppercase.find('O'):]):
-                self._xapx00.setMatrixRouting(xIn, xOut, 0, inGroup='E', unitCode=XUNIT)
+                await self._xapx00.setMatrixRouting(xIn, XOUT, 0, inGroup='E', unitCode=XUNIT)
 
-    def _sync_volume_level(self):
+    async def _async_sync_volume_level(self):
         """set all level of all outputs in zone to the same
         level as the first one in zone"""
         if self._active_source != SRC_OFF:
-            XUNIT, XOUT = self.parse_output(self._outputs[0])
-            volume = self._xapx00.getPropGain(XOUT, group="O",
-                                              unitCode = XUNIT)
-            self.set_volume_level(volume)
+            XUNIT, XOUT = self._outputs[0]
+            volume = await self._xapx00.getPropGain(XOUT, group="O",
+                                                    unitCode = XUNIT)
+            await self.async_set_volume_level(volume)
 
-    def set_volume_level(self, volume):
+    @prioritized
+    async def async_set_volume_level(self, volume):
         """Set volume level, range 0..1."""
         _LOGGER.debug("set_volume_level: {}:{}".format(self, volume))
-        for output in self._outputs:
-            XUNIT, XOUT = self.parse_output(output)
-            _LOGGER.debug("Set Volume for output {} to {}".format(output, volume))
-            volume = self._xapx00.setPropGain(XOUT, volume, group="O",
+        for XUNIT, XOUT, _group in self._channels:
+            _LOGGER.debug("Set Volume for output {}:{} to {}".format(XUNIT, XOUT, volume))
+            volume = await self._xapx00.setPropGain(XOUT, volume, group="O",
                                               unitCode = XUNIT)
         self._volume = volume
 
     def get_volume_level(self):
         """Volume level of the media player (0..1)."""
-        XUNIT, XOUT = self.parse_output(self._outputs[0])
-        gain = self._xapx00.getPropGain(XOUT, group="O", unitCode = XUNIT)
+        XUNIT, XOUT = self._outputs[0]
+        gain = self._xapx00.cachedPropGain(XOUT, group="O", unitCode = XUNIT)
         self._volume = gain
         return self._volume
 
-    def turn_on(self):
+    @prioritized
+    async def async_turn_on(self):
         """Turn zone on"""
         _LOGGER.debug("turn_on {}".format(self))
-        self.select_source(self._poweroff_source)
-        self.mute_volume(0)
-        self._state = STATE_ON
+        async with self.routing_lock:
+            await self._async_select_source(self._poweroff_source)
+            await self.async_mute_volume(0)
+            self._state = STATE_ON
 
-    def turn_off(self):
+    @prioritized
+    async def async_turn_off(self):
         """Turn off zone"""
         _LOGGER.debug("turn_off {}".format(self))
-        self._state = STATE_OFF
-        self._poweroff_source = self._active_source
-        self.select_source(SRC_OFF)
-        self.mute_volume(1)
+        async with self.routing_lock:
+            self._state = STATE_OFF
+            self._poweroff_source = self._active_source
+            await self._async_select_source(SRC_OFF)
+            await self.async_mute_volume(1)
 
-    def mute_volume(self, mute=2):
+    @prioritized
+    async def async_mute_volume(self, mute=2):
         """Send mute command, mute is bool from hass, default is 2 (toggle)"""
-        XUNIT, XOUT = self.parse_output(self._outputs[0])
-        muted = self._xapx00.setMute(XOUT, group="O", isMuted=int(mute),
-                                     unitCode = XUNIT)
-        for output in self._outputs[1:]:
-            XUNIT, XOUT = self.parse_output(output)
-            muted = self._xapx00.setMute(XOUT, group="O", isMuted=int(muted),
-                                         unitCode = XUNIT)
+        XUNIT, XOUT = self._outputs[0]
+        muted = await self._xapx00.setMute(XOUT, group="O", isMuted=int(mute),
+                                           unitCode = XUNIT)
+        for XUNIT, XOUT, _group in self._channels[1:]:
+            muted = await self._xapx00.setMute(XOUT, group="O", isMuted=int(muted),
+                                               unitCode = XUNIT)
         self._isMuted = bool(muted)
 
     def get_mute_status(self):
-        XUNIT, XOUT = self.parse_output(self._outputs[0])
-        self._isMuted = bool(self._xapx00.getMute(XOUT, group="O", unitCode=XUNIT))
+        XUNIT, XOUT = self._outputs[0]
+        self._isMuted = bool(self._xapx00.cachedMute(XOUT, group="O", unitCode=XUNIT))
         return self._isMuted
 
+    @prioritized
+    async def async_fade(self, volume, duration):
+        """Fade to volume (0..1) over duration seconds"""
+        await async_fade_channels(self._xapx00, self._channels, volume, duration=duration)
+        self.get_volume_level()
+        if self.hass is not None:
+            self.async_write_ha_state()
+
+    @prioritized
+    async def async_ramp(self, volume, rate):
+        """Fade to volume (0..1) at rate dB per second"""
+        await async_fade_channels(self._xapx00, self._channels, volume, rate=rate)
+        self.get_volume_level()
+        if self.hass is not None:
+            self.async_write_ha_state()
+
+    def watched_keys(self):
+        """State model keys that this zone shows, to be told when they change outside HA"""
+        XUNIT, XOUT = self._outputs[0]
+        keys = [('gain', XUNIT, XOUT, 'O'), ('mute', XUNIT, XOUT, 'O')]
+        for crosspoints in self._routes.values():
+            keys += [('routing', xpt.unit, xpt.input, xpt.inGroup, xpt.output) for xpt in crosspoints]
+        return keys
+
+    def external_change(self):
+        """The outputs or routing changed outside HA, show the new state from the model"""
+        self.get_volume_level()
+        self.get_mute_status()
+        self._active_source = SRC_OFF
+        self.get_source()
+        if self._active_source != SRC_OFF:
+            self._poweroff_source = self._active_source
+        self._state = STATE_ON if self._active_source != SRC_OFF else STATE_OFF
+        if self.hass is not None:
+            self.async_write_ha_state()
+
     @property
     def source_list(self):
         """List of available input sources."""
-        return list(self._sources.keys())
+        return list(self._routes.keys()) + [SRC_OFF]
 
     @property
     def source(self):
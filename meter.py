@@ -0,0 +1,213 @@
+"""
+Signal level meters of the channels used by the sources and zones, decimated for the sensors showing them.
+
+XAPMeters reads the level meter of every channel in use with LVL, METER_SAMPLES times for each value it reports.  The
+channels of one group on one unit are read with a single "*" query when they are at least half the group, as its
+reply carries every channel of the group, and otherwise, or if the unit rejects "*", with one query each.  Each unit
+is read on its own, so units on separate links are read in parallel, and at background priority, so a queued reading
+is sent after every other queued command.  A command still waits for a reading already sent, so the readings claim
+their queries from the link budget of the connection's statistics, see stats.py, shared with host side fades, and the
+rate is lowered to the budget interval on a slow link or while fades are stepped.  The next reading is only queued
+once the last one is answered, so readings never pile up.  Levels a unit reports on its own are taken as readings
+too.
+
+Each channel keeps its readings in a ring buffer of RING_SIZE.  rate times a second, the readings since the last
+report are decimated to their peak and their RMS level in dB.  A channel's level is only reported, and the sensors
+showing it only written, when its RMS level moved by at least threshold dB since it was last reported or went above
+or below live_level, so HomeAssistant's recorder and event bus see a change when a source starts or stops playing
+instead of a stream of readings.
+"""
+
+import asyncio
+import logging
+import math
+from collections import deque
+
+from .transport import METER_RANGE, PRIORITY_BACKGROUND, XAPError, XAPRejected, request_priority
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_METER_RATE = 1.0        # levels reported per second and channel, 0 disables the meters
+DEFAULT_METER_THRESHOLD = 3.0   # dB a level has to move by to be reported again
+DEFAULT_LIVE_LEVEL = -50.0      # dB above which a channel carries a signal
+METER_SAMPLES = 4  # readings per reported level
+RING_SIZE = 32     # readings kept per channel
+
+
+class ChannelMeter:
+    """
+    Readings of one channel's level meter, decimated to peak and RMS levels
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.readings = deque(maxlen=size)
+        self.fresh = 0  # readings since the last decimation
+        self.peak = self.rms = METER_RANGE[0]
+        self.reported = None  # (peak, rms) last reported, None before the first report
+
+    def add(self, level):
+        self.readings.append(level)
+        self.fresh = min(self.fresh + 1, self.readings.maxlen)
+
+    def decimate(self):
+        """Set peak and rms from the readings since the last call, left as they were if there were none"""
+        if not self.fresh:
+            return
+        recent = list(self.readings)[-self.fresh:]
+        self.fresh = 0
+        self.peak = max(recent)
+        self.rms = 10 * math.log10(sum(10 ** (level / 10) for level in recent) / len(recent))
+
+
+class XAPMeters:
+    """
+    Level meters of a set of channels, read in the background and reported when their level changes
+    """
+
+    def __init__(self, xapconn, channels, rate=DEFAULT_METER_RATE, threshold=DEFAULT_METER_THRESHOLD,
+                 live_level=DEFAULT_LIVE_LEVEL):
+        """channels are (unitCode, channel, group), xapconn the XAPConnection or XAPLinks to read them on"""
+        self._xapconn = xapconn
+        self.rate = rate
+        self.threshold = threshold
+        self.live_level = live_level
+        self.meters = {tuple(channel): ChannelMeter() for channel in channels}
+        self._groups = {}  # unitCode: {group: [channel]}
+        for unitCode, channel, group in sorted(self.meters, key=str):
+            self._groups.setdefault(unitCode, {}).setdefault(group, []).append(channel)
+        self._single = set()  # (unitCode, group) whose channels are read one query each
+        for unitCode, groups in self._groups.items():
+            for group, group_channels in groups.items():
+                if len(group_channels) * 2 < len(xapconn.group_channels(group)):
+                    self._single.add((unitCode, group))
+        self._observers = []  # (set of channels, callback)
+        self.readings = 0
+        self.reports = 0  # channel levels reported
+        self._task = None
+
+    def start(self):
+        """Start reading the meters, if enabled"""
+        if self.rate <= 0 or not self.meters or self._task is not None:
+            return
+        self._claim()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        _LOGGER.debug("Metering {} channels, {} levels a second each".format(len(self.meters), self.rate))
+
+    async def stop(self):
+        """Stop reading the meters"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._xapconn.stats.release(self)
+
+    def add_observer(self, channels, callback):
+        """Call callback() whenever the level of one of channels is reported"""
+        self._observers.append((set(channels), callback))
+
+    def level(self, channels):
+        """(peak, rms) in dB last reported for the loudest of channels, None before anything was reported"""
+        reported = [self.meters[channel].reported for channel in channels
+                    if channel in self.meters and self.meters[channel].reported is not None]
+        if not reported:
+            return None
+        return max(peak for peak, _rms in reported), max(rms for _peak, rms in reported)
+
+    def live(self, channels):
+        """True if any of channels was last reported carrying a signal"""
+        level = self.level(channels)
+        return level is not None and level[1] >= self.live_level
+
+    def notified(self, note):
+        """Take a level a unit reported on its own (a transport.Notification) as a reading"""
+        if note.command != 'LVL':
+            return
+        meter = self.meters.get((note.unitCode,) + tuple(note.address[:2]))
+        if meter is not None:
+            try:
+                meter.add(float(note.value))
+            except ValueError:
+                _LOGGER.debug("Ignored notification {}".format(note))
+
+    def _claim(self):
+        """Claim the queries of a reading from the link budget"""
+        queries = sum(len(channels) if (unitCode, group) in self._single else 1
+                      for unitCode, groups in self._groups.items() for group, channels in groups.items())
+        self._xapconn.stats.claim(self, queries, 'LVL', self._groups)
+
+    def read_interval(self):
+        """Seconds between readings, 1 / (rate * METER_SAMPLES) or longer to keep the link budget"""
+        return max(1.0 / (self.rate * METER_SAMPLES), self._xapconn.stats.budget_interval())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        due = loop.time()
+        sample = 0
+        limited = False
+        while True:
+            with request_priority(PRIORITY_BACKGROUND):
+                await asyncio.gather(*[self._read_unit(unitCode, groups)
+                                       for unitCode, groups in self._groups.items()])
+            sample += 1
+            if sample % METER_SAMPLES == 0:
+                self._report()
+            interval = self.read_interval()
+            if limited != (interval > 1.0 / (self.rate * METER_SAMPLES)):
+                limited = not limited
+                if limited:
+                    _LOGGER.info("Metering {:.2f} levels a second instead of {}, to leave the link free".format(
+                        1.0 / (interval * METER_SAMPLES), self.rate))
+                else:
+                    _LOGGER.info("Metering {} levels a second again".format(self.rate))
+            due = max(due + interval, loop.time())  # readings slower than the rate delay the next, never bunch up
+            await asyncio.sleep(due - loop.time())
+
+    async def _read_unit(self, unitCode, groups):
+        """Read the meters of the channels in use on one unit, a group at a time"""
+        for group, channels in groups.items():
+            try:
+                if len(channels) > 1 and (unitCode, group) not in self._single:
+                    try:
+                        levels = await self._xapconn.getLevels(group, unitCode=unitCode)
+                    except XAPRejected as err:
+                        _LOGGER.info("Unit {} rejected reading all {} meters at once, reading them one by one: {}"
+                                     .format(unitCode, group, err))
+                        self._single.add((unitCode, group))
+                        self._claim()
+                        continue
+                else:
+                    levels = {}
+                    for channel in channels:
+                        levels[channel] = await self._xapconn.getLevel(channel, group, unitCode=unitCode)
+            except XAPError as err:
+                _LOGGER.debug("Reading the meters of unit {} group {} failed: {}".format(unitCode, group, err))
+                continue
+            for channel in channels:
+                if channel in levels:
+                    self.meters[(unitCode, channel, group)].add(levels[channel])
+                    self.readings += 1
+
+    def _report(self):
+        """Decimate the readings of every channel and tell the observers of the ones whose level changed"""
+        changed = set()
+        for channel, meter in self.meters.items():
+            meter.decimate()
+            if meter.reported is not None:
+                last = meter.reported[1]
+                if (abs(meter.rms - last) < self.threshold
+                        and (meter.rms >= self.live_level) == (last >= self.live_level)):
+                    continue
+            meter.reported = (round(meter.peak, 1), round(meter.rms, 1))
+            changed.add(channel)
+        if not changed:
+            return
+        self.reports += len(changed)
+        for channels, callback in self._observers:
+            if channels & changed:
+                try:
+                    callback()
+                except Exception:
+                    _LOGGER.exception("Error reporting levels of {}".format(sorted(channels & changed, key=str)))
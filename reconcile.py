@@ -0,0 +1,168 @@
+"""
+Background reconciler that notices changes made to the units outside Home Assistant.
+
+G-Ware, the front panel and other controllers can change gains, mutes and routing behind our back.  The reconciler
+sweeps every channel and crosspoint the configured zones and sources use, compares what it reads with the state
+model, updates the model and tells only the entities whose channels or crosspoints changed.  Changes the units
+report on their own reach the entities straight away, but not every change is reported, so the sweeps are still
+needed.  A sweep reads gain and mute per channel, whole matrix columns per output and the level of every crosspoint
+whose level the model holds, a few items at a time, so it costs about the same queries as the startup snapshot.
+Each unit is swept on its own, so units on separate links are swept in parallel.
+
+The time between sweeps adapts: it starts at min_interval, doubles after every sweep in which nothing changed and
+nothing was written, up to max_interval, and drops back to min_interval as soon as something is written or a change
+is found.  Polling yields to the commands of Home Assistant: its queries have background priority, a query is only
+sent when no interactive or automation command is queued and no write is pending in the scheduler, other background
+traffic such as meter readings aside, and a value read while a write was sent is thrown away, as the model is newer
+than it.
+
+When the entities were set up from the state saved before a restart, start(verify=True) sweeps once straight away,
+even if polling is disabled, so whatever changed while Home Assistant was down is corrected in the entities that
+show it.  verify() does the same after the link to the units was lost and opened again.
+"""
+
+import asyncio
+import logging
+
+from .state import group_columns
+from .transport import PRIORITY_BACKGROUND, request_priority
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_POLL_MIN_INTERVAL = 5.0   # seconds between sweeps right after activity
+DEFAULT_POLL_MAX_INTERVAL = 60.0  # seconds between sweeps when idle, 0 disables polling
+BATCH_SIZE = 8     # channels or columns read before pausing
+BATCH_PAUSE = 0.1  # seconds between batches, so the link is never saturated by a sweep
+IDLE_CHECK = 0.02  # seconds to wait before checking again whether the link is free
+TICK = 1.0         # seconds between checks for activity while waiting for the next sweep
+
+
+class XAPReconciler:
+    """
+    Periodic sweeps of the channels and crosspoints in use, pushing external changes to the entities
+    """
+
+    def __init__(self, xapstate, channels, crosspoints, min_interval=DEFAULT_POLL_MIN_INTERVAL,
+                 max_interval=DEFAULT_POLL_MAX_INTERVAL):
+        """channels and crosspoints are as for XAPState.snapshot"""
+        self._xapstate = xapstate
+        self._channels = sorted(set(channels), key=str)
+        self._columns = sorted(group_columns(crosspoints).items(), key=str)
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.interval = min_interval
+        self.sweeps = 0
+        self.changes = 0  # channels and crosspoints found changed outside HA
+        self._task = None
+        self._verifying = None  # task of a sweep started with verify()
+
+    def start(self, verify=False):
+        """Start sweeping, if enabled, and with verify sweep once right away to check a restored model"""
+        if (self.max_interval <= 0 and not verify) or self._task is not None:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run(verify))
+        if self.max_interval > 0:
+            _LOGGER.debug("Polling {} channels and {} matrix columns every {}..{}s".format(
+                len(self._channels), len(self._columns), self.min_interval, self.max_interval))
+
+    def verify(self):
+        """Sweep once right away, even if polling is disabled, to check the model after the link was down"""
+        if self._verifying is None or self._verifying.done():
+            self._verifying = asyncio.get_running_loop().create_task(self._verify())
+
+    async def stop(self):
+        """Stop sweeping"""
+        for task in (self._task, self._verifying):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._verifying = None
+
+    async def _run(self, verify=False):
+        if verify:
+            await self._verify()
+        if self.max_interval <= 0:
+            return
+        while True:
+            await self._wait(self.interval)
+            writes = self._xapstate.writes
+            try:
+                with request_priority(PRIORITY_BACKGROUND):
+                    changed = await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                _LOGGER.warning("Polling the units failed: {}".format(err))
+                changed = []
+            if changed or self._xapstate.writes != writes:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+
+    async def _verify(self):
+        """Check the restored model against the units"""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            with request_priority(PRIORITY_BACKGROUND):
+                changed = await self.sweep()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            _LOGGER.warning("Verifying the state model failed: {}".format(err))
+            return
+        _LOGGER.info("Verified the state model in {:.2f}s, {} gains, mutes, crosspoints or levels had changed"
+                     .format(loop.time() - start, len(changed)))
+
+    async def _wait(self, delay):
+        """Sleep delay seconds, cut short to min_interval if something is written meanwhile"""
+        loop = asyncio.get_running_loop()
+        writes = self._xapstate.writes
+        end = loop.time() + delay
+        while loop.time() < end:
+            await asyncio.sleep(min(TICK, end - loop.time()))
+            if self._xapstate.writes != writes:
+                writes = self._xapstate.writes
+                end = min(end, loop.time() + self.min_interval)
+
+    async def _idle(self):
+        """Wait until no interactive or automation command is queued on the link, background ones such as meter
+        readings don't hold a sweep up"""
+        while self._xapstate.urgent:
+            await asyncio.sleep(IDLE_CHECK)
+
+    async def sweep(self):
+        """Read every channel and crosspoint in use once, returns the keys that changed"""
+        units = {}  # unitCode: [(refresh method, arguments)]
+        for unitCode, channel, group in self._channels:
+            units.setdefault(unitCode, []).append((self._xapstate.refresh_channel, (channel, group, unitCode)))
+        for (unitCode, inGroup, outChannel), inChannels in self._columns:
+            units.setdefault(unitCode, []).append(
+                (self._xapstate.refresh_column, (outChannel, inChannels, inGroup, unitCode)))
+        for unitCode, unit in list(self._xapstate.units.items()):
+            # every level in the model, whether restored, read at startup or set since
+            for inChannel, inGroup, outChannel in sorted(unit.level, key=str):
+                units.setdefault(unitCode, []).append(
+                    (self._xapstate.refresh_level, (inChannel, outChannel, inGroup, unitCode)))
+        changed = [key for unit_changed in await asyncio.gather(*[self._sweep_unit(items) for items in units.values()])
+                   for key in unit_changed]
+        self.sweeps += 1
+        if changed:
+            self.changes += len(changed)
+            _LOGGER.info("Changed outside Home Assistant: {}".format(changed))
+            self._xapstate.changed(changed)
+        return changed
+
+    async def _sweep_unit(self, items):
+        """Read the channels and columns of one unit, a batch at a time, returns the keys that changed"""
+        changed = []
+        for start in range(0, len(items), BATCH_SIZE):
+            if start:
+                await asyncio.sleep(BATCH_PAUSE)
+            for refresh, args in items[start:start + BATCH_SIZE]:
+                await self._idle()
+                changed.extend(await refresh(*args))
+        return changed
@@ -0,0 +1,186 @@
+"""
+Routing of the configured sources and zones, compiled once when the config is loaded.
+
+Sources are listed as an input channel on unit 0, or as "<unit#>:<input#>:<bus letter>:<bus type>", zones as an output
+channel on unit 0, or as "<unit#>:<output#>".  Compiling the config parses every channel once, decides for each zone
+channel whether a source reaches it directly or through its expansion bus, and builds an immutable table of the
+crosspoints for every (zone, source) pair.  A source that can't reach every channel of a zone, such as a source on
+another unit without an expansion bus, is left out of that zone with a warning, instead of failing when it is
+selected; it is still offered to the zones it does reach.
+
+The channels listed for a source or zone are mapping slots: a channel can be listed more than once, such as a front
+speaker standing in for a missing center speaker, and each slot is paired with a slot of the other side for matrix
+routing.  Gains and mutes belong to the physical channels behind the slots, which input_channels and output_channels
+list once each, so each of them is written once however often it is listed.
+"""
+
+import logging
+from collections import namedtuple
+from types import MappingProxyType
+
+_LOGGER = logging.getLogger(__name__)
+
+MATRIX_GEOMETRY = {'XAP800': 12, 'XAP400': 8}  # number of inputs/outputs of each unit type
+LINE_INPUTS = 4  # the last 4 inputs of a unit are line inputs, the rest are mic inputs
+
+# one channel of a source: the input, and optionally the expansion bus it is also mapped to
+Input = namedtuple('Input', ['unit', 'channel', 'group', 'bus', 'busgroup'])
+
+# one channel of a zone
+Output = namedtuple('Output', ['unit', 'channel'])
+
+# one physical channel, the target of gain and mute commands
+Channel = namedtuple('Channel', ['unit', 'channel', 'group'])
+
+# one matrix connection, on is the value that turns it on
+Crosspoint = namedtuple('Crosspoint', ['unit', 'input', 'inGroup', 'output', 'on'])
+
+
+class RoutingError(Exception):
+    """The configured sources and zones can't be routed"""
+
+
+def parse_source(srcs):
+    "Split into input unit, input #, expansion bus, expansion bus group"
+    inputs = []
+    for src in srcs:
+        XUNIT, XBUS, XBUSGRP = 0, None, 'E'  # bus group defaults to E
+        if issubclass(type(src), int):
+            XCHAN = src
+        elif issubclass(type(src), str):
+            if ":" in src:
+                comps = src.split(":")
+                if len(comps) > 4:
+                    raise RoutingError('Invalid Input String {}'.format(src))
+                XUNIT, XCHAN = comps[0], comps[1]
+                if len(comps) > 2:
+                    XBUS = comps[2]
+                if len(comps) > 3:
+                    XBUSGRP = comps[3]
+            elif src.isdigit():
+                XCHAN = src
+            else:
+                raise RoutingError('Invalid Input String {}'.format(src))
+        else:
+            # shouldn't be able to get here
+            raise RoutingError('Invalid Source Input config format {}'.format(src))
+        try:
+            inputs.append(Input(int(XUNIT), int(XCHAN), 'I', XBUS, XBUSGRP))
+        except ValueError:
+            raise RoutingError('Invalid Input String {}'.format(src))
+    if not inputs:
+        raise RoutingError('Source has no inputs')
+    return tuple(inputs)
+
+
+def parse_output(output):
+    "Returns (unit,output) "
+    XUNIT = 0
+    if issubclass(type(output), int):
+        XOUT = output
+    elif issubclass(type(output), str):
+        if ":" in output:
+            XUNIT, XOUT = output.split(":", 1)
+        elif output.isdigit():
+            XOUT = output
+        else:
+            raise RoutingError('Invalid Output String {}'.format(output))
+    else:
+        # shouldn't be able to get here
+        raise RoutingError('Invalid Output config format {}'.format(output))
+    try:
+        return Output(int(XUNIT), int(XOUT))
+    except ValueError:
+        raise RoutingError('Invalid Output String {}'.format(output))
+
+
+def input_channels(inputs):
+    """Physical input channels of a source, each once, in the order first listed"""
+    return tuple(dict.fromkeys(Channel(inp.unit, inp.channel, inp.group) for inp in inputs))
+
+
+def output_channels(outputs):
+    """Physical output channels of a zone, each once, in the order first listed"""
+    return tuple(dict.fromkeys(Channel(XUNIT, XOUT, 'O') for XUNIT, XOUT in outputs))
+
+
+def source_channel(inputs, outUnit, srcNum=0):
+    """Input channel and group that carries source input srcNum to an output on outUnit"""
+    inp = inputs[srcNum % len(inputs)]  # wrap if request is greater than number of sources
+    if outUnit == inp.unit:
+        return inp.channel, inp.group
+    if inp.bus is None:
+        raise RoutingError("Different unit but No Expansion Bus Defined for input {}".format(inp))
+    return inp.bus, inp.busgroup
+
+
+class RoutingTable:
+    """
+    Parsed channels of every source and zone, and the crosspoints of every (zone, source) pair
+    """
+
+    def __init__(self, sources, zones, XAPType="XAP800"):
+        """sources and zones are the config dicts of name: list of channels"""
+        matrixGeo = MATRIX_GEOMETRY[XAPType]
+        self.inputs = MappingProxyType(
+            {name: parse_source(srcs) for name, srcs in sources.items()})
+        self.outputs = MappingProxyType(
+            {name: tuple(parse_output(output) for output in outputs) for name, outputs in zones.items()})
+        routes = {}
+        self.unreachable = {}  # (zone name, source name): why the source can't reach the zone
+        for zone_name, outputs in self.outputs.items():
+            if not outputs:
+                raise RoutingError('Zone {} has no outputs'.format(zone_name))
+            for source_name, inputs in self.inputs.items():
+                crosspoints = {}
+                for cnt, (XUNIT, XOUT) in enumerate(outputs):
+                    try:
+                        XIN, XINGRP = source_channel(inputs, XUNIT, cnt)
+                    except RoutingError as err:
+                        self.unreachable[(zone_name, source_name)] = "output {}:{}: {}".format(XUNIT, XOUT, err)
+                        _LOGGER.warning("Source {} can't reach zone {} output {}:{}, left out of the zone: {}".format(
+                            source_name, zone_name, XUNIT, XOUT, err))
+                        break
+                    # if a mike input on=3, if line on=1, last 4 inputs are line
+                    ON = 3 if (issubclass(type(XIN), int) and XIN <= (matrixGeo - LINE_INPUTS)) else 1
+                    xpt = Crosspoint(XUNIT, XIN, XINGRP, XOUT, ON)
+                    crosspoints[xpt] = None  # keeps slot order, each crosspoint once
+                else:
+                    routes[(zone_name, source_name)] = tuple(crosspoints)
+        self.routes = MappingProxyType(routes)
+
+    def zone_routes(self, zone_name):
+        """{source name: crosspoints} for one zone, of the sources that reach it"""
+        return MappingProxyType({source_name: self.routes[(zone_name, source_name)]
+                                 for source_name in self.inputs if (zone_name, source_name) in self.routes})
+
+    def units(self):
+        """Unit codes used by any source or zone, in order"""
+        return sorted(set(unitCode for unitCode, _channel, _group in self.channels()))
+
+    def channels(self):
+        """Every (unit, channel, group) used by a source or zone"""
+        channels = set()
+        for inputs in self.inputs.values():
+            channels.update(input_channels(inputs))
+        for outputs in self.outputs.values():
+            channels.update(output_channels(outputs))
+        return set(tuple(channel) for channel in channels)
+
+    def crosspoints(self):
+        """Every (unit, input, input group, output) a zone can route"""
+        return set((xpt.unit, xpt.input, xpt.inGroup, xpt.output)
+                   for crosspoints in self.routes.values() for xpt in crosspoints)
+
+    def channel_names(self):
+        """{(unit, channel, group): names of the zones and sources using the channel}"""
+        names = {}
+        for source_name, inputs in self.inputs.items():
+            for inp in inputs:
+                names.setdefault((inp.unit, inp.channel, inp.group), []).append(source_name)
+                if inp.bus is not None:
+                    names.setdefault((inp.unit, inp.bus, inp.busgroup), []).append(source_name)
+        for zone_name, outputs in self.outputs.items():
+            for XUNIT, XOUT in outputs:
+                names.setdefault((XUNIT, XOUT, 'O'), []).append(zone_name)
+        return {channel: sorted(set(used_by)) for channel, used_by in names.items()}
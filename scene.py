@@ -0,0 +1,85 @@
+"""
+Scenes: put several zones in a given source, volume and mute state with one batch of commands.
+
+Each zone describes the crosspoints, output gains and output mutes it needs changed.  The requests of all zones are
+merged by what they address, so an output or crosspoint shared by several zones is written once, and then sent as
+one ordered batch per connection:  outputs being muted are muted first, then crosspoints are switched off and on,
+gains are set, and outputs being unmuted are unmuted last, so nothing is heard until its routing and level are in
+place.  Writes the state model shows are already in effect are skipped by the model.
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import AsyncExitStack
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ScenePlan:
+    """
+    Merged commands for a set of zones that share one state model
+    """
+
+    def __init__(self):
+        self.routing = {}  # (unit, input, input group, output): routing value
+        self.gains = {}    # (unit, output): proportional gain
+        self.mutes = {}    # (unit, output): 1 muted, 0 not muted
+
+    def add(self, routing, gains, mutes):
+        """Merge the commands of one zone"""
+        for xpt, value in routing.items():
+            # a crosspoint one zone switches off and another switches on, stays on
+            self.routing[xpt] = max(value, self.routing.get(xpt, 0))
+        for output, gain in gains.items():
+            if output in self.gains and self.gains[output] != gain:
+                _LOGGER.debug("Scene sets output {} to both {} and {}, using {}".format(
+                    output, self.gains[output], gain, gain))
+            self.gains[output] = gain
+        for output, muted in mutes.items():
+            self.mutes[output] = int(muted)
+
+    def __len__(self):
+        return len(self.routing) + len(self.gains) + len(self.mutes)
+
+    def _phases(self, xapstate):
+        """The commands of each phase in order, a phase's coroutines only created once the phase before is done, so
+        a phase that fails leaves none of the later ones unawaited"""
+        yield [xapstate.setMute(XOUT, isMuted=1, group="O", unitCode=XUNIT)
+               for (XUNIT, XOUT), muted in self.mutes.items() if muted]
+        yield [xapstate.setMatrixRouting(XIN, XOUT, 0, inGroup=XINGRP, unitCode=XUNIT)
+               for (XUNIT, XIN, XINGRP, XOUT), value in self.routing.items() if not value]
+        yield [xapstate.setMatrixRouting(XIN, XOUT, value, inGroup=XINGRP, unitCode=XUNIT)
+               for (XUNIT, XIN, XINGRP, XOUT), value in self.routing.items() if value]
+        yield [xapstate.setPropGain(XOUT, gain, group="O", unitCode=XUNIT)
+               for (XUNIT, XOUT), gain in self.gains.items()]
+        yield [xapstate.setMute(XOUT, isMuted=0, group="O", unitCode=XUNIT)
+               for (XUNIT, XOUT), muted in self.mutes.items() if not muted]
+
+    async def async_execute(self, xapstate):
+        """Send the merged commands in order, each phase queued on the link at once"""
+        for phase in self._phases(xapstate):
+            await asyncio.gather(*phase)
+
+
+async def async_apply_scene(zone_settings):
+    """Apply a scene, zone_settings is a list of (zone, {'source':, 'volume':, 'mute':}) with optional keys
+
+    Zones are grouped by state model, so zones on different connections are set in parallel.  The routing_lock of
+    every zone is held from working out its commands until it is updated, always taken in the same order."""
+    start = time.monotonic()
+    async with AsyncExitStack() as stack:
+        for zone in sorted(set(zone for zone, _settings in zone_settings), key=lambda zone: (str(zone), id(zone))):
+            await stack.enter_async_context(zone.routing_lock)
+        plans = {}
+        for zone, settings in zone_settings:
+            plan = plans.setdefault(zone.xapstate, ScenePlan())
+            plan.add(*zone.scene_commands(**settings))
+        skipped = sum(xapstate.skipped for xapstate in plans)
+        await asyncio.gather(*[plan.async_execute(xapstate) for xapstate, plan in plans.items()])
+        for zone, settings in zone_settings:
+            zone.scene_applied(**settings)
+    skipped = sum(xapstate.skipped for xapstate in plans) - skipped
+    commands = sum(len(plan) for plan in plans.values())
+    _LOGGER.info("Scene for {} zones took {:.3f}s: {} commands planned, {} already in effect".format(
+        len(zone_settings), time.monotonic() - start, commands, skipped))
@@ -0,0 +1,130 @@
+"""
+Command scheduler that sits between the state model and the XAP connection.
+
+Dragging a volume slider produces many gain writes per second for the same channels.  Sending each of them would
+queue up commands on the serial link and the speakers would lag the slider.  The scheduler keeps at most one pending
+gain and one pending mute write per channel: a newer value replaces the pending one, and every caller waiting on the
+channel gets the result of the write that was actually sent.  Writes to a channel are spaced at least min_interval
+seconds apart, so the latest value reaches the device within min_interval plus one command time of arriving, no
+matter how fast values come in.
+
+A ramp is a gain write too: it shares the channel's pending write with setPropGain, so whichever came last is sent.
+
+Toggles and relative writes depend on the value before them and are never merged.  Everything else is passed
+straight to the connection.
+"""
+
+import asyncio
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MIN_INTERVAL = 0.05  # seconds between two writes to the same channel
+
+
+class XAPScheduler:
+    """
+    Coalesces and paces gain and mute writes per channel
+    """
+
+    def __init__(self, xapconn, min_interval=DEFAULT_MIN_INTERVAL):
+        self._xapx00 = xapconn
+        self.min_interval = min_interval
+        self.coalesced = 0  # number of writes replaced by a newer value before being sent
+        self._pending = {}  # key: [coroutine function to send, futures waiting on it]
+        self._locks = {}    # key: lock held while the write for that key is paced and sent
+        self._flushes = set()  # tasks sending pending writes, kept so they are not garbage collected
+        self._last = {}     # key: loop time the last write for that key completed
+
+    def __getattr__(self, name):
+        # everything that is not paced goes straight to the connection
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._xapx00, name)
+
+    @property
+    def busy(self):
+        """True while a write is pending here or any command is queued on the connection"""
+        return bool(self._pending) or self._xapx00.busy
+
+    @property
+    def urgent(self):
+        """True while a write is pending here or an interactive or automation command is queued on the connection"""
+        return bool(self._pending) or self._xapx00.urgent
+
+    async def _submit(self, key, send):
+        """Queue send as the latest write for key and wait for the write that supersedes or includes it"""
+        future = asyncio.get_running_loop().create_future()
+        if key in self._pending:
+            self._pending[key][0] = send
+            self._pending[key][1].append(future)
+            self.coalesced += 1
+        else:
+            self._pending[key] = [send, [future]]
+            task = asyncio.get_running_loop().create_task(self._flush(key))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+        return await future
+
+    async def close(self):
+        """Cancel the pending writes, their callers get CancelledError, the connection is left open"""
+        tasks = list(self._flushes)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _flush(self, key):
+        """Send the latest pending write for key once the channel is free and min_interval has passed"""
+        loop = asyncio.get_running_loop()
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        waiters = None
+        try:
+            async with lock:
+                delay = self._last.get(key, 0) + self.min_interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                send, waiters = self._pending.pop(key)
+                if len(waiters) > 1:
+                    _LOGGER.debug("Coalesced {} writes to {}".format(len(waiters), key))
+                try:
+                    result = await send()
+                except Exception as err:
+                    for future in waiters:
+                        if not future.done():
+                            future.set_exception(err)
+                else:
+                    for future in waiters:
+                        if not future.done():
+                            future.set_result(result)
+                finally:
+                    self._last[key] = loop.time()
+        finally:
+            # cancelled, at shutdown for one: the callers waiting on this write are cancelled too, instead of
+            # waiting forever, and a write not taken yet is dropped so the next one for key starts a new flush
+            if waiters is None:
+                waiters = self._pending.pop(key)[1]
+            for future in waiters:
+                if not future.done():
+                    future.cancel()
+
+    async def setPropGain(self, channel, gain, isAbsolute=1, group="I", unitCode=0):
+        """Set the gain of a channel (0..1), returns the gain set"""
+        if not isAbsolute:
+            return await self._xapx00.setPropGain(channel, gain, isAbsolute=0, group=group, unitCode=unitCode)
+        return await self._submit(
+            ('GAIN', unitCode, group, channel),
+            lambda: self._xapx00.setPropGain(channel, gain, isAbsolute=1, group=group, unitCode=unitCode))
+
+    async def setMute(self, channel, isMuted=1, group="I", unitCode=0):
+        """Set the mute status of a channel, isMuted=2 toggles, returns the mute status set"""
+        if int(isMuted) == 2:
+            return await self._xapx00.setMute(channel, isMuted=2, group=group, unitCode=unitCode)
+        return await self._submit(
+            ('MUTE', unitCode, group, channel),
+            lambda: self._xapx00.setMute(channel, isMuted=isMuted, group=group, unitCode=unitCode))
+
+    async def rampGain(self, channel, gain, rate, group="I", unitCode=0):
+        """Start ramping the gain of a channel to gain (0..1) at rate dB per second, returns the target gain"""
+        return await self._submit(
+            ('GAIN', unitCode, group, channel),
+            lambda: self._xapx00.rampGain(channel, gain, rate, group=group, unitCode=unitCode))
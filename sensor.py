@@ -0,0 +1,130 @@
+"""
+Diagnostic sensors showing the traffic on the serial link of each XAP unit, and level sensors of the sources and zones.
+
+The sensors are set up by the media_player platform through discovery, one set per unit it uses: the number of
+commands sent, their mean latency, the number that got no reply, and the number queued.  Attributes break these down
+by command type.  The values are read from the connection's statistics, so updating the sensors sends nothing to
+the units.
+
+With meter_rate set, each source and zone also gets a sensor of its signal level in dB, the RMS level of its loudest
+channel, with the peak level and whether it is live as attributes.  They are not polled: the meters write them when a
+level is reported, see meter.py.
+"""
+
+import logging
+from datetime import timedelta
+
+from homeassistant.components.sensor import SensorEntity, SensorStateClass
+from homeassistant.helpers.entity import EntityCategory
+
+from .media_player import DOMAIN, ATTR_CONNECTIONS
+from .routing import input_channels, output_channels
+
+_LOGGER = logging.getLogger(__name__)
+
+SCAN_INTERVAL = timedelta(seconds=30)
+
+# kind: (name suffix, unit of measurement, icon)
+SENSOR_KINDS = {
+    'commands': ('commands', 'commands', 'mdi:swap-horizontal'),
+    'latency': ('latency', 'ms', 'mdi:timer-outline'),
+    'timeouts': ('timeouts', 'commands', 'mdi:timer-alert-outline'),
+    'queue_depth': ('queue depth', 'commands', 'mdi:tray-full'),
+}
+
+
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    """Set up the sensors of a connection set up by the media_player platform"""
+    if discovery_info is None:
+        return
+    connection = hass.data[DOMAIN][ATTR_CONNECTIONS][discovery_info['path']]
+    async_add_entities([XAPStatSensor(connection, unitCode, kind)
+                        for unitCode in connection['units'] for kind in SENSOR_KINDS], True)
+    meters = connection['meters']
+    if meters is not None:
+        routing = connection['routing']
+        async_add_entities(
+            [XAPLevelSensor(meters, "Source: " + name, input_channels(inputs))
+             for name, inputs in routing.inputs.items()]
+            + [XAPLevelSensor(meters, "Zone: " + name, output_channels(outputs))
+               for name, outputs in routing.outputs.items()])
+
+
+class XAPStatSensor(SensorEntity):
+    """
+    One statistic of the commands sent to one unit
+    """
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+
+    def __init__(self, connection, unitCode, kind):
+        self._stats = connection['xapstate'].stats
+        self._unitCode = unitCode
+        self._kind = kind
+        suffix, unit, icon = SENSOR_KINDS[kind]
+        self._attr_name = "{} unit {} {}".format(connection['name'], unitCode, suffix)
+        self._attr_native_unit_of_measurement = unit
+        self._attr_icon = icon
+
+    async def async_update(self):
+        """Read the statistic, never touches the device, in the event loop that changes the statistics"""
+        total = self._stats.unit_total(self._unitCode)
+        commands = {command: stats for (unit, command), stats in self._stats.commands.items()
+                    if unit == self._unitCode}
+        if self._kind == 'commands':
+            self._attr_native_value = total.count
+            self._attr_extra_state_attributes = dict(
+                {command: stats.count for command, stats in commands.items()}, errors=total.errors,
+                notifications=self._stats.notifications[self._unitCode])
+        elif self._kind == 'latency':
+            summary = total.as_dict()
+            self._attr_native_value = summary['mean_ms']
+            self._attr_extra_state_attributes = {
+                command: round(stats.mean_latency * 1000, 2) for command, stats in commands.items()}
+            self._attr_extra_state_attributes.update(summary['histogram_ms'], p95_ms=summary['p95_ms'],
+                                                     max_ms=summary['max_ms'])
+        elif self._kind == 'timeouts':
+            self._attr_native_value = total.timeouts
+            self._attr_extra_state_attributes = {command: stats.timeouts for command, stats in commands.items()}
+        else:
+            self._attr_native_value = self._stats.queue_depth[self._unitCode]
+            self._attr_extra_state_attributes = {
+                command: depth for (unitCode, command), depth in sorted(self._stats.command_queue_depth.items())
+                if unitCode == self._unitCode}
+            self._attr_extra_state_attributes['max'] = self._stats.max_queue_depth[self._unitCode]
+
+
+class XAPLevelSensor(SensorEntity):
+    """
+    Signal level of a source or zone, the loudest of its channels
+    """
+
+    _attr_should_poll = False
+    _attr_state_class = SensorStateClass.MEASUREMENT
+    _attr_native_unit_of_measurement = 'dB'
+    _attr_icon = 'mdi:equalizer'
+
+    def __init__(self, meters, name, channels):
+        """name is the name of the source or zone media player, "Source: " or "Zone: " and the configured name"""
+        self._meters = meters
+        self._channels = [tuple(channel) for channel in channels]
+        self._attr_name = "{} level".format(name)
+
+    async def async_added_to_hass(self):
+        """Write the state whenever the meters report a level of the channels"""
+        self._meters.add_observer(self._channels, self.async_write_ha_state)
+
+    @property
+    def available(self):
+        """False until a level was reported"""
+        return self._meters.level(self._channels) is not None
+
+    @property
+    def native_value(self):
+        level = self._meters.level(self._channels)
+        return None if level is None else level[1]
+
+    @property
+    def extra_state_attributes(self):
+        level = self._meters.level(self._channels)
+        return {'peak': None if level is None else level[0], 'live': self._meters.live(self._channels)}
@@ -0,0 +1,393 @@
+"""
+Recording of the traffic on the links to the units, and replay of a recording in place of the units.
+
+A SessionRecorder attached to the connections writes every command sent, every reply, every line the units sent on
+their own, and each time a link is opened or lost, with the seconds since recording started, to a text log:
+
+    0.000 + /dev/ttyUSB0
+    0.002 > #50 VER
+    0.019 < #50 VER 1.0
+    12.417 ! #50 GAIN 1 O -20.00 A
+    30.101 - Connection to /dev/ttyUSB0 lost
+
+A log whose name ends in .gz is compressed.  Lines are kept in memory and written from an executor every
+FLUSH_INTERVAL seconds, so recording never blocks the event loop.
+
+A path of the form "replay://<log>" replays a log in place of a link to the units; "replay://<log>?speed=10" replays
+it ten times faster, and speed=0 without any delay, every event coming right after the commands recorded before
+it.  Each command is answered with the replies recorded for the same
+command, in the order they were recorded and after the delay they took.  A command that was not recorded is answered
+as closely as the log allows: a query with the last reply recorded for the same channel, a write by echoing it as the
+units do.  Anything else gets no reply.  Lines the units sent on their own are sent at the time they were recorded,
+and the link is closed where it was lost, so the reconnect happens as it did then.  Replaying one log against two
+versions of the platform puts both through identical traffic.
+
+Run on its own, it summarizes a log, or compares the command counts and latencies of two logs, as JSON:
+
+    python -m xap_controller.session summary session.log
+    python -m xap_controller.session compare before.log after.log
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import sys
+import time
+from collections import deque, namedtuple
+from urllib.parse import parse_qs
+
+from .transport import ADDRESS_ARGS, COMMAND_TIMEOUT, LINE_TIMEOUT, LINK_TYPES, TCP_PIPELINE, LinkType
+
+_LOGGER = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 5.0  # seconds between writes of the recorded lines to the log
+EXPIRY = COMMAND_TIMEOUT + 12 * LINE_TIMEOUT  # seconds after which a recorded command without reply got none
+
+# what the units answered to a recorded command: seconds until the first reply, and the reply lines
+Exchange = namedtuple('Exchange', ['delay', 'replies'])
+
+
+def open_log(filename, mode='rt'):
+    """Open a session log, compressed if its name ends in .gz"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode, encoding='ascii')
+    return open(filename, mode, encoding='ascii')
+
+
+def read_log(filename):
+    """Entries of a session log, as (seconds, kind, text)"""
+    entries = []
+    with open_log(filename) as log:
+        for line in log:
+            fields = line.rstrip('\n').split(' ', 2)
+            if len(fields) < 2 or line.startswith('#'):
+                continue
+            entries.append((float(fields[0]), fields[1], fields[2] if len(fields) > 2 else ''))
+    return entries
+
+
+def address(fields):
+    """Device, command and addressing arguments of a command or reply, replies are matched to commands on these"""
+    if len(fields) < 2:
+        return tuple(fields)
+    return tuple(fields[:2 + ADDRESS_ARGS.get(fields[1].upper(), 0)])
+
+
+class SessionRecorder:
+    """
+    Writes the lines given to record() to a session log
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lines = 0  # lines recorded
+        self._start = None
+        self._pending = []  # lines not written yet
+        self._file = None
+        self._flusher = None
+
+    async def open(self):
+        """Start a new log, replacing any earlier one with the same name"""
+        loop = asyncio.get_running_loop()
+        self._file = await loop.run_in_executor(None, open_log, self.filename, 'wt')
+        self._start = time.monotonic()
+        self._pending.append('# xap_controller session {}\n'.format(time.strftime('%Y-%m-%dT%H:%M:%S')))
+        self._flusher = loop.create_task(self._flush_every(FLUSH_INTERVAL))
+        _LOGGER.info("Recording the session to {}".format(self.filename))
+
+    def record(self, kind, text):
+        """Record a line, kind is > for a command, < for a reply, ! for a line sent unasked, + and - for a link
+        opened and lost"""
+        if self._start is None:
+            return
+        self._pending.append('{:.3f} {} {}\n'.format(time.monotonic() - self._start, kind, text))
+        self.lines += 1
+
+    async def _flush_every(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    async def flush(self):
+        """Write the lines recorded so far"""
+        if self._pending and self._file is not None:
+            lines, self._pending = self._pending, []
+            await asyncio.get_running_loop().run_in_executor(None, self._write, lines)
+
+    def _write(self, lines):
+        self._file.writelines(lines)
+        self._file.flush()
+
+    async def close(self):
+        """Write what is left and close the log"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+        if self._file is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._file.close)
+            self._file = None
+        self._start = None
+        _LOGGER.info("Recorded {} lines to {}".format(self.lines, self.filename))
+
+
+class _Sent:
+    """A recorded command, while its replies are collected"""
+
+    def __init__(self, seconds, text):
+        self.seconds = seconds
+        self.text = text
+        self.match = address(text.split())
+        self.replies = []
+        self.answered = None  # seconds of the first reply
+        self.complete = False
+
+    def takes(self, fields, seconds):
+        """True if a reply belongs to this command, as XAPConnection matches them"""
+        if self.complete or seconds - self.seconds > EXPIRY:
+            return False
+        if 'ERROR' in fields[0].upper():
+            return not self.replies  # the oldest command still waiting, unless it is a query with "*" answered
+        return len(fields) > len(self.match) and all(want in ('*', got) for want, got in zip(self.match, fields))
+
+    def add(self, fields, seconds, text):
+        if self.answered is None:
+            self.answered = seconds
+        self.replies.append(text)
+        # a query with "*" in place of a channel takes every line matching it, until the next command
+        self.complete = '*' not in self.match or 'ERROR' in fields[0].upper()
+
+
+class ReplaySession:
+    """
+    A recorded session, answering commands as the units did when it was recorded
+    """
+
+    def __init__(self, entries):
+        """entries are as from read_log"""
+        self.exchanges = {}  # command text: deque of Exchange, in the order recorded
+        self.last = {}       # address of a channel: Exchange last recorded with its value
+        self.delays = {}     # command name: seconds until the first reply, last recorded
+        self.events = []     # (seconds, kind, text, commands recorded before it) of the lines sent unasked (!) and
+                             # the links lost (-)
+        self.history = []    # (seconds, command text, Exchange or None if unanswered) of every recorded command
+        self.position = 0    # index in events of the next one to replay
+        self.started = None  # loop time the replay started
+        self.exact = 0       # commands answered with the replies recorded for them
+        self.approximate = 0  # commands answered from the same channel or by echoing
+        self.unanswered = 0
+        sent = []
+        waiting = []
+        for seconds, kind, text in entries:
+            if kind == '>':
+                command = _Sent(seconds, text)
+                for earlier in waiting:
+                    # the same command is only sent again once this one is done, and a query with "*" is sent on
+                    # its own, so it is done once the next command for the unit is sent
+                    if earlier.text == text or ('*' in earlier.match and earlier.match[0] == command.match[0]):
+                        earlier.complete = True
+                sent.append(command)
+                waiting.append(command)
+            elif kind == '<':
+                fields = text.split()
+                for command in waiting:
+                    if command.takes(fields, seconds):
+                        command.add(fields, seconds, text)
+                        break
+            elif kind in ('!', '-'):
+                self.events.append((seconds, kind, text, len(sent)))
+            waiting = [command for command in waiting if not command.complete and seconds - command.seconds <= EXPIRY]
+        for command in sent:
+            exchange = None
+            if command.replies:
+                exchange = Exchange(round(command.answered - command.seconds, 3), tuple(command.replies))
+                self.exchanges.setdefault(command.text, deque()).append(exchange)
+                if len(command.replies) == 1 and '*' not in command.match and 'ERROR' not in command.replies[0]:
+                    self.last[command.match] = exchange  # a write is answered with the value, as a query is
+                self.delays[command.match[1].upper()] = exchange.delay
+            self.history.append((command.seconds, command.text, exchange))
+
+    @property
+    def replayed(self):
+        """Commands answered so far, or not"""
+        return self.exact + self.approximate + self.unanswered
+
+    def answer(self, text):
+        """Exchange to answer a command with, or None if it gets no reply
+
+        The recorded exchanges of a command are used in order, and the last one again once they run out."""
+        recorded = self.exchanges.get(text)
+        if recorded:
+            self.exact += 1
+            return recorded.popleft() if len(recorded) > 1 else recorded[0]
+        fields = text.split()
+        match = address(fields)
+        if len(fields) == len(match) and match in self.last:  # a query, answered as the last one for the channel
+            self.approximate += 1
+            return self.last[match]
+        if len(fields) > len(match) and fields[1].upper() in ADDRESS_ARGS:  # a write, the units echo it
+            self.approximate += 1
+            return Exchange(self.delays.get(fields[1].upper(), 0.0), (text,))
+        self.unanswered += 1
+        return None
+
+    def summary(self):
+        """Count, errors, unanswered commands and reply latencies per command type, and totals, as a dict"""
+        commands = {}
+        for _seconds, text, exchange in self.history:
+            fields = text.split()
+            stats = commands.setdefault(fields[1].upper() if len(fields) > 1 else text, {
+                'count': 0, 'errors': 0, 'unanswered': 0, 'latencies': []})
+            stats['count'] += 1
+            if exchange is None:
+                stats['unanswered'] += 1
+            elif 'ERROR' in exchange.replies[0].split()[0].upper():
+                stats['errors'] += 1
+            else:
+                stats['latencies'].append(exchange.delay)
+        for stats in commands.values():
+            latencies = sorted(stats.pop('latencies'))
+            if latencies:
+                stats['latency_ms'] = {
+                    'mean': round(1000 * sum(latencies) / len(latencies), 1),
+                    'p50': round(1000 * latencies[len(latencies) // 2], 1),
+                    'p95': round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1),
+                    'max': round(1000 * latencies[-1], 1),
+                }
+        return {
+            'duration': round(max([self.history[-1][0] if self.history else 0.0]
+                                  + [event[0] for event in self.events[-1:]]), 3),
+            'commands': sum(stats['count'] for stats in commands.values()),
+            'notifications': sum(1 for event in self.events if event[1] == '!'),
+            'losses': sum(1 for event in self.events if event[1] == '-'),
+            'by_command': dict(sorted(commands.items())),
+        }
+
+
+class ReplayWriter:
+    """
+    Stands in for the StreamWriter of a link, answering what is written with a ReplaySession
+    """
+
+    def __init__(self, session, reader, speed):
+        self.session = session
+        self.speed = speed
+        self._reader = reader
+        self._loop = asyncio.get_running_loop()
+        self._last = 0.0  # loop time of the last reply scheduled, replies are sent in order
+        self._closed = False
+        self._written = asyncio.Event()  # set on every write, for the events replayed without delays
+        self._events = self._loop.create_task(self._play_events())
+
+    def write(self, data):
+        if self._closed:
+            raise RuntimeError('Replay closed')
+        for line in data.split(b'\r'):
+            text = line.decode('ascii', 'replace').strip()
+            if not text:
+                continue
+            exchange = self.session.answer(text)
+            if exchange is None:
+                pass
+            elif self.speed:
+                self._last = max(self._loop.time() + exchange.delay / self.speed, self._last)
+                self._loop.call_at(self._last, self._feed, exchange.replies)
+            else:
+                self._feed(exchange.replies)
+        self._written.set()
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+    def _feed(self, lines):
+        if not self._closed:
+            self._reader.feed_data(''.join(line + '\r\n' for line in lines).encode('ascii'))
+
+    async def _play_events(self):
+        """Send the lines the units sent on their own when they were sent, and end the link where it was lost"""
+        session = self.session
+        while session.position < len(session.events):
+            seconds, kind, text, before = session.events[session.position]
+            if self.speed:
+                await asyncio.sleep(session.started + seconds / self.speed - self._loop.time())
+            while not self.speed and session.replayed < before:
+                self._written.clear()
+                await self._written.wait()
+            session.position += 1
+            if kind == '!':
+                self._feed((text,))
+            else:
+                _LOGGER.info("Replaying the loss of the link: {}".format(text))
+                self._close()
+                return
+
+    def _close(self):
+        if not self._closed:
+            self._closed = True
+            self._reader.feed_eof()
+
+    def close(self):
+        self._close()
+        self._events.cancel()
+
+    def is_closing(self):
+        return self._closed
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+_sessions = {}  # log file: ReplaySession, kept so a reopened link goes on where the replay was
+
+
+async def open_replay(address, baud=None):
+    """Open a replay of the session log "<file>?speed=<factor>", returns (StreamReader, ReplayWriter)"""
+    filename, _sep, query = address.partition('?')
+    try:
+        speed = float(parse_qs(query).get('speed', ['1'])[0])
+    except ValueError:
+        raise ValueError('Invalid replay speed in {}'.format(address))
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(filename)
+    if session is None:
+        session = ReplaySession(await loop.run_in_executor(None, read_log, filename))
+        session.started = loop.time()
+        _sessions[filename] = session
+        _LOGGER.info("Replaying {} commands and {} events from {}".format(
+            len(session.history), len(session.events), filename))
+    reader = asyncio.StreamReader()
+    return reader, ReplayWriter(session, reader, speed)
+
+
+LINK_TYPES['replay'] = LinkType(open_replay, TCP_PIPELINE, False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize or compare recorded XAP sessions')
+    commands = parser.add_subparsers(dest='action', required=True)
+    commands.add_parser('summary', help='command counts and latencies of a session').add_argument('log')
+    compare = commands.add_parser('compare', help='command counts and latencies of two sessions side by side')
+    compare.add_argument('before')
+    compare.add_argument('after')
+    args = parser.parse_args()
+    if args.action == 'summary':
+        result = ReplaySession(read_log(args.log)).summary()
+    else:
+        before = ReplaySession(read_log(args.before)).summary()
+        after = ReplaySession(read_log(args.after)).summary()
+        result = {'before': before, 'after': after, 'commands': {
+            command: {'before': before['by_command'].get(command, {}).get('count', 0),
+                      'after': after['by_command'].get(command, {}).get('count', 0)}
+            for command in sorted(set(before['by_command']) | set(after['by_command']))}}
+    json.dump(result, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
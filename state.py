@@ -0,0 +1,543 @@
+"""
+In-memory model of the XAP units in the system.
+
+The model keeps the last known gain and mute of each channel and the routing, and where known the level, of each
+crosspoint, per unit.  It is filled once at platform startup by a snapshot that reads every channel and crosspoint
+the configured zones and sources use exactly once, so the number of serial transactions depends on the hardware
+channels in use and not on the number of entities built on top of them.  Where a zone output needs several
+crosspoints of the same input group, the whole matrix column for that output is read with a single query.  Units on
+separate links are read in parallel.  The getters mirror the XAPX00 query methods, so entities can read from the
+model the same way they would read from the device.  A value that is not in the model is read from the device once
+and then kept.  The cached* accessors only look at the model and never touch the device.
+
+Writes go through the model as well.  The setters mirror the XAPX00 ones, update the model once the device has
+confirmed the write, and skip the command entirely when the device is already in the requested state, or will be
+once the writes to the same channel still queued or in flight are done.  So a mute followed by an unmute before the
+mute is confirmed still sends the unmute.  setMatrixLevels sets a whole profile of crosspoint levels and only sends
+the ones that differ from the model.  A gain being ramped by the unit is modelled at its target; what the unit
+reports or is read from it while the ramp runs is ignored, as it is on its way there.
+
+The model can be saved with as_dict() and restored with load(), so entities can be set up from the state saved
+before a restart and verified against the device afterwards.  Crosspoint levels are only read for the crosspoints
+passed as levels, and from then on verified like the rest of the model.  Without a saved state, start_loading()
+reads every unit in the background instead of snapshot(), so entities can be set up straight away and each shown as
+soon as the units it uses are read.  A unit that can't be read is read again after LOAD_RETRY_DELAYS, so its entities
+are shown once it answers, whether or not the reconciler polls.
+
+Changes made outside HA reach the model either from the units themselves, as notifications, or from the background
+reconciler reading channels and matrix columns again.  Either way the model is updated and only the callbacks
+listening to the channels and crosspoints that changed are called.
+"""
+
+import asyncio
+import logging
+
+from .transport import RAMP_RATE_RANGE, XAPError, gain_to_prop, prop_to_gain
+
+_LOGGER = logging.getLogger(__name__)
+
+GAIN_TOLERANCE = 0.0005  # proportional gains closer than this are considered equal
+LEVEL_TOLERANCE = 0.005  # crosspoint levels in dB closer than this are considered equal
+LOAD_RETRY_DELAYS = (5.0, 300.0)  # seconds before reading a unit that could not be read again, and at most between
+
+
+def group_columns(crosspoints):
+    """Group (unitCode, inChannel, inGroup, outChannel) crosspoints by matrix column,
+    as {(unitCode, inGroup, outChannel): [inChannel, ...]}"""
+    columns = {}
+    for unitCode, inChannel, inGroup, outChannel in sorted(set(crosspoints), key=str):
+        columns.setdefault((unitCode, inGroup, outChannel), []).append(inChannel)
+    return columns
+
+
+def by_unit(channels, crosspoints):
+    """Split channels and crosspoints (as for XAPState.snapshot) by unit, as {unitCode: (channels, columns)} with the
+    crosspoints grouped as by group_columns"""
+    units = {}
+    for channel in sorted(set(channels), key=str):
+        units.setdefault(channel[0], ([], {}))[0].append(channel)
+    for column, inChannels in group_columns(crosspoints).items():
+        units.setdefault(column[0], ([], {}))[1][column] = inChannels
+    return {unitCode: units[unitCode] for unitCode in sorted(units)}
+
+
+class XAPUnitState:
+    """
+    Last known state of one XAP unit
+    """
+
+    def __init__(self, unitCode):
+        self.unitCode = unitCode
+        self.gain = {}     # (channel, group): proportional gain 0..1
+        self.mute = {}     # (channel, group): 1 muted, 0 not muted
+        self.routing = {}  # (inChannel, inGroup, outChannel): matrix routing value, 0 is off
+        self.level = {}    # (inChannel, inGroup, outChannel): crosspoint level
+
+    def __repr__(self):
+        return "XAPUnitState({}: {} gains, {} mutes, {} crosspoints, {} levels)".format(
+            self.unitCode, len(self.gain), len(self.mute), len(self.routing), len(self.level))
+
+
+class XAPState:
+    """
+    Model of all units reachable through one connection
+    """
+
+    def __init__(self, xapconn):
+        self._xapx00 = xapconn
+        self.units = {}
+        self.skipped = 0  # number of writes not sent because the device was already in that state
+        self.columns = True  # read whole matrix columns, cleared if the unit does not support it
+        self.writes = 0  # writes sent to the device, so values read while one was sent can be told apart
+        self._listeners = {}  # key of a channel or crosspoint: callbacks to call when it changes outside HA
+        self._observers = []  # callbacks to call whenever anything in the model changes
+        self._ramping = {}  # (unitCode, channel, group): loop time the unit's ramp of the gain ends
+        self._loading = {}  # unitCode: task reading the unit, see start_loading
+        self._inflight = {}  # key as for listen(), or ('level', ...): [value last requested, writes not confirmed]
+
+    def __getattr__(self, name):
+        # anything not modelled (matrixGeo, input_range, ...) comes from the connection
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._xapx00, name)
+
+    def unit(self, unitCode):
+        """Return the model of a unit, creating it if needed"""
+        unitCode = int(unitCode)
+        if unitCode not in self.units:
+            self.units[unitCode] = XAPUnitState(unitCode)
+        return self.units[unitCode]
+
+    async def snapshot(self, channels, crosspoints, levels=()):
+        """Read the state of the listed channels and crosspoints from the device, each one once
+
+        channels is an iterable of (unitCode, channel, group), crosspoints and levels iterables of
+        (unitCode, inChannel, inGroup, outChannel), levels the crosspoints whose level is read as well as their
+        routing.  Returns the number of queries sent.
+        """
+        # units on separate links are read in parallel, each unit's queries one after the other
+        queries = sum(await asyncio.gather(*[self._snapshot_unit(unitCode, unit_channels, unit_columns, levels)
+                                             for unitCode, (unit_channels, unit_columns)
+                                             in by_unit(channels, crosspoints).items()]))
+        _LOGGER.debug("Snapshot of units {} took {} queries".format(sorted(self.units), queries))
+        self._modified()
+        return queries
+
+    def start_loading(self, channels, crosspoints, levels=()):
+        """Read the channels, crosspoints and levels (as for snapshot) in the background, a task per unit, so
+        whatever uses a unit can wait for that unit alone with loaded()"""
+        loop = asyncio.get_running_loop()
+        for unitCode, (unit_channels, unit_columns) in by_unit(channels, crosspoints).items():
+            task = loop.create_task(self._load_unit(unitCode, unit_channels, unit_columns, levels))
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())  # raised to whoever waits
+            self._loading[unitCode] = task
+
+    async def _load_unit(self, unitCode, channels, columns, levels):
+        start = asyncio.get_running_loop().time()
+        delay = LOAD_RETRY_DELAYS[0]
+        while True:
+            try:
+                queries = await self._snapshot_unit(unitCode, channels, columns, levels)
+                break
+            except XAPError as err:
+                _LOGGER.error("Unable to read the state of unit {}, trying again in {:.0f}s: {}".format(
+                    unitCode, delay, err))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LOAD_RETRY_DELAYS[1])
+        _LOGGER.debug("Read unit {} with {} queries in {:.2f}s".format(
+            unitCode, queries, asyncio.get_running_loop().time() - start))
+        self._modified()
+
+    async def loaded(self, unitCodes):
+        """Wait until the units being read since start_loading() are read, however many attempts that takes"""
+        tasks = [self._loading[unitCode] for unitCode in set(unitCodes) if unitCode in self._loading]
+        if tasks:
+            await asyncio.gather(*[asyncio.shield(task) for task in tasks])
+
+    async def stop_loading(self):
+        """Stop reading the units still being read since start_loading()"""
+        tasks = [task for task in self._loading.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _snapshot_unit(self, unitCode, channels, columns, levels=()):
+        """Read the channels, matrix columns (as from group_columns) and the levels of the crosspoints in levels
+        of one unit, returns the queries sent"""
+        unit = self.unit(unitCode)
+        for _unitCode, channel, group in channels:
+            unit.gain[(channel, group)] = await self._xapx00.getPropGain(channel, group=group, unitCode=unitCode)
+            unit.mute[(channel, group)] = int(await self._xapx00.getMute(channel, group=group, unitCode=unitCode))
+        queries = 2 * len(channels)
+        for (_unitCode, inGroup, outChannel), inChannels in columns.items():
+            if self.columns and len(inChannels) > 1:
+                try:
+                    column = await self._xapx00.getMatrixColumn(outChannel, inGroup=inGroup, unitCode=unitCode)
+                except XAPError as err:
+                    _LOGGER.warning("Matrix column query not supported, reading single crosspoints: {}".format(err))
+                    self.columns = False
+                else:
+                    queries += 1
+                    for inChannel, routing in column.items():
+                        unit.routing[(inChannel, inGroup, outChannel)] = routing
+                    continue
+            for inChannel in inChannels:
+                unit.routing[(inChannel, inGroup, outChannel)] = int(
+                    await self._xapx00.getMatrixRouting(inChannel, outChannel, inGroup=inGroup, unitCode=unitCode))
+                queries += 1
+        for _unitCode, inChannel, inGroup, outChannel in sorted(set(xpt for xpt in levels if xpt[0] == unitCode),
+                                                               key=str):
+            unit.level[(inChannel, inGroup, outChannel)] = await self._xapx00.getMatrixLevel(
+                inChannel, outChannel, inGroup=inGroup, unitCode=unitCode)
+            queries += 1
+        return queries
+
+    def add_observer(self, callback):
+        """Call callback() after any change to the model, however it was made"""
+        self._observers.append(callback)
+
+    def _modified(self):
+        for callback in self._observers:
+            callback()
+
+    def as_dict(self):
+        """The model as JSON serializable data, to be restored with load()"""
+        return {
+            'XAPType': self.XAPType,
+            'units': {str(unitCode): {
+                'gain': [[channel, group, gain] for (channel, group), gain in unit.gain.items()],
+                'mute': [[channel, group, muted] for (channel, group), muted in unit.mute.items()],
+                'routing': [[inChannel, inGroup, outChannel, routed]
+                            for (inChannel, inGroup, outChannel), routed in unit.routing.items()],
+                'level': [[inChannel, inGroup, outChannel, level]
+                          for (inChannel, inGroup, outChannel), level in unit.level.items()],
+            } for unitCode, unit in self.units.items()},
+        }
+
+    def load(self, data, channels, crosspoints, levels=()):
+        """Restore the model saved with as_dict(), if it has every one of the channels, crosspoints and levels (as
+        for snapshot), returns True if it was restored"""
+        if not data or data.get('XAPType') != self.XAPType:
+            return False
+        units = {}
+        try:
+            for unitCode, saved in data['units'].items():
+                unit = units[int(unitCode)] = XAPUnitState(int(unitCode))
+                unit.gain = {(channel, group): float(gain) for channel, group, gain in saved['gain']}
+                unit.mute = {(channel, group): int(muted) for channel, group, muted in saved['mute']}
+                unit.routing = {(inChannel, inGroup, outChannel): int(routed)
+                                for inChannel, inGroup, outChannel, routed in saved['routing']}
+                unit.level = {(inChannel, inGroup, outChannel): float(level)
+                               for inChannel, inGroup, outChannel, level in saved['level']}
+        except (KeyError, TypeError, ValueError) as err:
+            _LOGGER.warning("Ignored saved state: {}".format(err))
+            return False
+        empty = XAPUnitState(None)
+        for unitCode, channel, group in channels:
+            unit = units.get(unitCode, empty)
+            if (channel, group) not in unit.gain or (channel, group) not in unit.mute:
+                return False
+        for unitCode, inChannel, inGroup, outChannel in crosspoints:
+            if (inChannel, inGroup, outChannel) not in units.get(unitCode, empty).routing:
+                return False
+        for unitCode, inChannel, inGroup, outChannel in levels:
+            if (inChannel, inGroup, outChannel) not in units.get(unitCode, empty).level:
+                return False
+        self.units = units
+        _LOGGER.debug("Restored saved state of units {}".format(sorted(units)))
+        return True
+
+    def listen(self, keys, callback):
+        """Call callback() when any of the keys changes outside HA, keys are ('gain' or 'mute', unitCode, channel,
+        group) and ('routing', unitCode, inChannel, inGroup, outChannel)"""
+        for key in keys:
+            self._listeners.setdefault(key, []).append(callback)
+
+    def changed(self, keys):
+        """Call the callbacks listening to any of the keys, each once"""
+        callbacks = []
+        for key in keys:
+            for callback in self._listeners.get(key, ()):
+                if callback not in callbacks:
+                    callbacks.append(callback)
+        for callback in callbacks:
+            callback()
+
+    def notified(self, note):
+        """Apply a change a unit reported on its own (a transport.Notification) and tell whoever shows it"""
+        unit = self.unit(note.unitCode)
+        changed = []
+        try:
+            if note.command == 'GAIN':
+                channel, group = note.address
+                if self.ramping(channel, group, note.unitCode):
+                    return
+                gain = gain_to_prop(note.value)
+                current = unit.gain.get((channel, group))
+                if current is None or abs(current - gain) >= GAIN_TOLERANCE:
+                    unit.gain[(channel, group)] = gain
+                    changed.append(('gain', note.unitCode, channel, group))
+            elif note.command == 'MUTE':
+                channel, group = note.address
+                if unit.mute.get((channel, group)) != int(note.value):
+                    unit.mute[(channel, group)] = int(note.value)
+                    changed.append(('mute', note.unitCode, channel, group))
+            elif note.command == 'MTRX':
+                inChannel, inGroup, outChannel, _outGroup = note.address
+                if unit.routing.get((inChannel, inGroup, outChannel)) != int(note.value):
+                    unit.routing[(inChannel, inGroup, outChannel)] = int(note.value)
+                    changed.append(('routing', note.unitCode, inChannel, inGroup, outChannel))
+            elif note.command == 'MTRXLVL':
+                inChannel, inGroup, outChannel, _outGroup = note.address
+                unit.level[(inChannel, inGroup, outChannel)] = float(note.value)
+        except ValueError:
+            _LOGGER.debug("Ignored notification {}".format(note))
+            return
+        self._modified()
+        if changed:
+            _LOGGER.debug("Changed outside Home Assistant: {}".format(changed))
+            self.changed(changed)
+
+    async def refresh_channel(self, channel, group="I", unitCode=0):
+        """Read the gain and mute of a channel again, update the model and return the keys that changed,
+        as ('gain' or 'mute', unitCode, channel, group)"""
+        unit = self.unit(unitCode)
+        writes = self.writes
+        gain = await self._xapx00.getPropGain(channel, group=group, unitCode=unitCode)
+        muted = int(await self._xapx00.getMute(channel, group=group, unitCode=unitCode))
+        if self.writes != writes or self._inflight:
+            return []  # written while reading, the model is newer than what was read
+        changed = []
+        current = unit.gain.get((channel, group))
+        if (current is None or abs(current - gain) >= GAIN_TOLERANCE) and not self.ramping(channel, group, unitCode):
+            unit.gain[(channel, group)] = gain
+            changed.append(('gain', unitCode, channel, group))
+        if unit.mute.get((channel, group)) != muted:
+            unit.mute[(channel, group)] = muted
+            changed.append(('mute', unitCode, channel, group))
+        if changed:
+            self._modified()
+        return changed
+
+    async def refresh_column(self, outChannel, inChannels, inGroup="I", unitCode=0):
+        """Read the routing of the listed inputs to an output again, update the model and return the keys that
+        changed, as ('routing', unitCode, inChannel, inGroup, outChannel)"""
+        unit = self.unit(unitCode)
+        writes = self.writes
+        column = None
+        if self.columns and len(inChannels) > 1:
+            try:
+                column = await self._xapx00.getMatrixColumn(outChannel, inGroup=inGroup, unitCode=unitCode)
+            except XAPError as err:
+                _LOGGER.warning("Matrix column query not supported, reading single crosspoints: {}".format(err))
+                self.columns = False
+        if column is None:
+            column = {}
+            for inChannel in inChannels:
+                column[inChannel] = int(await self._xapx00.getMatrixRouting(
+                    inChannel, outChannel, inGroup=inGroup, unitCode=unitCode))
+        if self.writes != writes or self._inflight:
+            return []
+        changed = []
+        for inChannel in inChannels:
+            routing = column.get(inChannel)
+            if routing is not None and unit.routing.get((inChannel, inGroup, outChannel)) != routing:
+                unit.routing[(inChannel, inGroup, outChannel)] = routing
+                changed.append(('routing', unitCode, inChannel, inGroup, outChannel))
+        if changed:
+            self._modified()
+        return changed
+
+    async def refresh_level(self, inChannel, outChannel, inGroup="I", unitCode=0):
+        """Read the level of a crosspoint again, update the model and return the keys that changed, as
+        ('level', unitCode, inChannel, inGroup, outChannel)"""
+        unit = self.unit(unitCode)
+        writes = self.writes
+        level = await self._xapx00.getMatrixLevel(inChannel, outChannel, inGroup=inGroup, unitCode=unitCode)
+        if self.writes != writes or self._inflight:
+            return []
+        current = unit.level.get((inChannel, inGroup, outChannel))
+        if current is not None and abs(current - level) < LEVEL_TOLERANCE:
+            return []
+        unit.level[(inChannel, inGroup, outChannel)] = level
+        self._modified()
+        return [('level', unitCode, inChannel, inGroup, outChannel)]
+
+    def cachedPropGain(self, channel, group="I", unitCode=0):
+        """Gain of a channel (0..1) in the model, None if unknown"""
+        return self.unit(unitCode).gain.get((channel, group))
+
+    def cachedMute(self, channel, group="I", unitCode=0):
+        """Mute status of a channel in the model, None if unknown"""
+        return self.unit(unitCode).mute.get((channel, group))
+
+    def cachedMatrixRouting(self, inChannel, outChannel, inGroup="I", unitCode=0):
+        """Routing value of a crosspoint in the model, None if unknown"""
+        return self.unit(unitCode).routing.get((inChannel, inGroup, outChannel))
+
+    async def getPropGain(self, channel, group="I", unitCode=0):
+        """Gain of a channel (0..1)"""
+        unit = self.unit(unitCode)
+        if (channel, group) not in unit.gain:
+            unit.gain[(channel, group)] = await self._xapx00.getPropGain(channel, group=group, unitCode=unitCode)
+        return unit.gain[(channel, group)]
+
+    async def getMute(self, channel, group="I", unitCode=0):
+        """Mute status of a channel, 1 if muted"""
+        unit = self.unit(unitCode)
+        if (channel, group) not in unit.mute:
+            unit.mute[(channel, group)] = int(await self._xapx00.getMute(channel, group=group, unitCode=unitCode))
+        return unit.mute[(channel, group)]
+
+    async def getMatrixRouting(self, inChannel, outChannel, inGroup="I", unitCode=0):
+        """Routing value of a crosspoint, 0 if off"""
+        unit = self.unit(unitCode)
+        if (inChannel, inGroup, outChannel) not in unit.routing:
+            unit.routing[(inChannel, inGroup, outChannel)] = int(await self._xapx00.getMatrixRouting(
+                inChannel, outChannel, inGroup=inGroup, unitCode=unitCode))
+        return unit.routing[(inChannel, inGroup, outChannel)]
+
+    async def getMatrixLevel(self, inChannel, outChannel, inGroup="I", unitCode=0):
+        """Level of a crosspoint"""
+        unit = self.unit(unitCode)
+        if (inChannel, inGroup, outChannel) not in unit.level:
+            unit.level[(inChannel, inGroup, outChannel)] = await self._xapx00.getMatrixLevel(
+                inChannel, outChannel, inGroup=inGroup, unitCode=unitCode)
+        return unit.level[(inChannel, inGroup, outChannel)]
+
+    def _skip(self, command, *args):
+        self.skipped += 1
+        _LOGGER.debug("Skipped {}{}, device already in that state".format(command, args))
+
+    def _expected(self, key, confirmed):
+        """Value a key will have once the writes to it not yet confirmed are done, confirmed if there are none,
+        None if that is not known"""
+        return self._inflight[key][0] if key in self._inflight else confirmed
+
+    async def _write(self, key, value, send):
+        """Await send(), with value, None if not known in advance, expected for key until it is confirmed"""
+        inflight = self._inflight.setdefault(key, [value, 0])
+        inflight[0] = value
+        inflight[1] += 1
+        self.writes += 1
+        try:
+            return await send
+        finally:
+            inflight[1] -= 1
+            if not inflight[1]:
+                del self._inflight[key]
+
+    async def setPropGain(self, channel, gain, isAbsolute=1, group="I", unitCode=0):
+        """Set the gain of a channel (0..1), returns the gain set"""
+        unit = self.unit(unitCode)
+        key = ('gain', int(unitCode), channel, group)
+        current = self._expected(key, unit.gain.get((channel, group)))
+        if isAbsolute and current is not None and abs(current - gain) < GAIN_TOLERANCE:
+            self._skip("setPropGain", channel, gain, group, unitCode)
+            return current
+        gain = await self._write(key, gain if isAbsolute else None, self._xapx00.setPropGain(
+            channel, gain, isAbsolute=isAbsolute, group=group, unitCode=unitCode))
+        self._ramping.pop((int(unitCode), channel, group), None)  # a gain write ends a ramp
+        unit.gain[(channel, group)] = gain
+        self._modified()
+        return gain
+
+    async def rampGain(self, channel, gain, rate, group="I", unitCode=0):
+        """Have the unit ramp the gain of a channel to gain (0..1) at rate dB per second, returns the target gain,
+        raises transport.XAPUnsupported if the unit can't ramp"""
+        unit = self.unit(unitCode)
+        key = ('gain', int(unitCode), channel, group)
+        current = self._expected(key, unit.gain.get((channel, group)))
+        if current is not None and abs(current - gain) < GAIN_TOLERANCE:
+            self._skip("rampGain", channel, gain, group, unitCode)
+            return current
+        gain = await self._write(key, gain, self._xapx00.rampGain(channel, gain, rate, group=group, unitCode=unitCode))
+        if current is not None:
+            rate = min(max(rate, RAMP_RATE_RANGE[0]), RAMP_RATE_RANGE[1])
+            seconds = abs(prop_to_gain(gain) - prop_to_gain(current)) / rate
+            self._ramping[(int(unitCode), channel, group)] = asyncio.get_running_loop().time() + seconds
+        unit.gain[(channel, group)] = gain
+        self._modified()
+        return gain
+
+    def ramping(self, channel, group="I", unitCode=0):
+        """True while the unit is ramping the gain of a channel"""
+        end = self._ramping.get((int(unitCode), channel, group))
+        if end is None:
+            return False
+        if asyncio.get_running_loop().time() < end:
+            return True
+        del self._ramping[(int(unitCode), channel, group)]
+        return False
+
+    async def setMute(self, channel, isMuted=1, group="I", unitCode=0):
+        """Set the mute status of a channel, isMuted=2 toggles, returns the mute status set"""
+        unit = self.unit(unitCode)
+        key = ('mute', int(unitCode), channel, group)
+        current = self._expected(key, unit.mute.get((channel, group)))
+        isMuted = int(isMuted)
+        if isMuted == 2 and current is not None:
+            isMuted = 0 if current else 1
+        if isMuted == current:
+            self._skip("setMute", channel, isMuted, group, unitCode)
+            return current
+        muted = int(await self._write(key, None if isMuted == 2 else isMuted, self._xapx00.setMute(
+            channel, group=group, isMuted=isMuted, unitCode=unitCode)))
+        unit.mute[(channel, group)] = muted
+        self._modified()
+        return muted
+
+    async def setMatrixRouting(self, inChannel, outChannel, state=1, inGroup="I", unitCode=0):
+        """Set the routing of a crosspoint, state=2 toggles, returns the routing set"""
+        unit = self.unit(unitCode)
+        key = ('routing', int(unitCode), inChannel, inGroup, outChannel)
+        current = self._expected(key, unit.routing.get((inChannel, inGroup, outChannel)))
+        if state == 2 and current is not None:
+            state = 0 if current else 1
+        if state == current:
+            self._skip("setMatrixRouting", inChannel, outChannel, state, inGroup, unitCode)
+            return current
+        routed = await self._write(key, None if state == 2 else state, self._xapx00.setMatrixRouting(
+            inChannel, outChannel, state, inGroup=inGroup, unitCode=unitCode))
+        unit.routing[(inChannel, inGroup, outChannel)] = state if routed is None else int(routed)
+        self._modified()
+        return unit.routing[(inChannel, inGroup, outChannel)]
+
+    async def setMatrixLevel(self, inChannel, outChannel, level=0, isAbsolute=1, inGroup="I", unitCode=0):
+        """Set the level of a crosspoint, returns the level set"""
+        unit = self.unit(unitCode)
+        key = ('level', int(unitCode), inChannel, inGroup, outChannel)
+        current = self._expected(key, unit.level.get((inChannel, inGroup, outChannel)))
+        if isAbsolute and current is not None and abs(current - level) < LEVEL_TOLERANCE:
+            self._skip("setMatrixLevel", inChannel, outChannel, level, inGroup, unitCode)
+            return current
+        return await self._sendMatrixLevel(inChannel, outChannel, level, isAbsolute, inGroup, unitCode)
+
+    async def _sendMatrixLevel(self, inChannel, outChannel, level, isAbsolute, inGroup, unitCode):
+        unit = self.unit(unitCode)
+        key = ('level', int(unitCode), inChannel, inGroup, outChannel)
+        newlevel = await self._write(key, level if isAbsolute else None, self._xapx00.setMatrixLevel(
+            inChannel, outChannel, level, isAbsolute=isAbsolute, inGroup=inGroup, unitCode=unitCode))
+        unit.level[(inChannel, inGroup, outChannel)] = level if newlevel is None else newlevel
+        self._modified()
+        return unit.level[(inChannel, inGroup, outChannel)]
+
+    async def setMatrixLevels(self, levels, force=False):
+        """Set the level of several crosspoints, levels is {(unitCode, inChannel, inGroup, outChannel): dB}
+
+        Only the crosspoints the model does not show at that level, or about to be, are sent, or all of them with
+        force, all queued at once, so they are sent back to back and units on separate links in parallel.  Returns
+        the number of commands sent."""
+        changes = {}
+        for (unitCode, inChannel, inGroup, outChannel), level in levels.items():
+            current = self._expected(('level', int(unitCode), inChannel, inGroup, outChannel),
+                                     self.unit(unitCode).level.get((inChannel, inGroup, outChannel)))
+            if force or current is None or abs(current - level) >= LEVEL_TOLERANCE:
+                changes[(unitCode, inChannel, inGroup, outChannel)] = level
+        self.skipped += len(levels) - len(changes)
+        await asyncio.gather(*[
+            self._sendMatrixLevel(inChannel, outChannel, level, 1, inGroup, unitCode)
+            for (unitCode, inChannel, inGroup, outChannel), level in changes.items()])
+        _LOGGER.debug("Set {} crosspoint levels, {} already at their level".format(
+            len(changes), len(levels) - len(changes)))
+        return len(changes)
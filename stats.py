@@ -0,0 +1,209 @@
+"""
+Traffic and latency statistics of the serial link.
+
+Every command sent through an XAPConnection is recorded per unit and command type (GAIN, MUTE, MTRX, ...): the number
+sent, the number that failed or got no reply, and a histogram of the time from being queued to being answered, which
+includes the time spent waiting behind other commands.  The number of commands queued for each unit, and for each
+command type on it, is tracked as well, with the highest seen, and every command is also counted by the channel or
+crosspoint it addresses, so the zones and sources that load the link the most can be found.  Changes the units report
+on their own are counted too.
+
+The statistics are shown by the diagnostic sensors, and dumped as a whole by the dump_diagnostics service.
+
+The measured latencies also set the link budget.  Background work that sends commands in rounds, such as host side
+fades, claims a share of the link with the commands it sends per round, and every claimant spaces its rounds by
+budget_interval(), so all of them together take at most LINK_SHARE of the link time, whatever mix of them runs.
+"""
+
+import time
+from collections import Counter
+
+# upper bounds of the latency histogram buckets in seconds, the last one catches everything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, float('inf'))
+TOP_CHANNELS = 20  # channels listed in the diagnostics dump
+LINK_SHARE = 0.25  # most of the link time the claimants of the link budget may take, together
+DEFAULT_LATENCY = 0.03  # seconds a command is assumed to take before any of its type was measured
+
+
+class CommandStats:
+    """
+    Counts and latency histogram of one command type on one unit
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def record(self, latency, error=False, timeout=False):
+        self.count += 1
+        self.errors += int(error)
+        self.timeouts += int(timeout)
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        for idx, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[idx] += 1
+                break
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / self.count if self.count else 0.0
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the given percentile, at most the slowest, None if nothing was recorded"""
+        if not self.count:
+            return None
+        rank = pct / 100 * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_latency)
+        return self.max_latency
+
+    def merge(self, other):
+        """Add the counts of another CommandStats, to sum over command types"""
+        self.count += other.count
+        self.errors += other.errors
+        self.timeouts += other.timeouts
+        self.total_latency += other.total_latency
+        self.max_latency = max(self.max_latency, other.max_latency)
+        self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, other.buckets)]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'mean_ms': round(self.mean_latency * 1000, 2),
+            'max_ms': round(self.max_latency * 1000, 2),
+            'p50_ms': _ms(self.percentile(50)),
+            'p95_ms': _ms(self.percentile(95)),
+            'histogram_ms': {('<={}'.format(_ms(bound)) if bound != float('inf') else 'more'): count
+                             for bound, count in zip(LATENCY_BUCKETS, self.buckets)},
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class XAPStats:
+    """
+    Statistics of all commands sent on one connection
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.commands = {}              # (unitCode, command): CommandStats
+        self.channels = Counter()       # (unitCode, command, addressing arguments): commands sent
+        self.queue_depth = Counter()    # unitCode: commands queued or waiting for a reply
+        self.max_queue_depth = Counter()
+        self.command_queue_depth = Counter()  # (unitCode, command): commands queued or waiting for a reply
+        self.max_command_queue_depth = Counter()
+        self.notifications = Counter()  # unitCode: changes the unit reported on its own
+        self._claims = {}  # claimant of the link budget: (commands per round, command type, unit codes or None)
+
+    def queued(self, unitCode, command):
+        """A command for the unit was queued"""
+        self.queue_depth[unitCode] += 1
+        self.max_queue_depth[unitCode] = max(self.max_queue_depth[unitCode], self.queue_depth[unitCode])
+        key = (unitCode, command)
+        self.command_queue_depth[key] += 1
+        self.max_command_queue_depth[key] = max(self.max_command_queue_depth[key], self.command_queue_depth[key])
+
+    def unqueued(self, unitCode, command):
+        """A command queued with queued() was dropped unsent, as nobody waits for it or a newer one replaced it"""
+        self.queue_depth[unitCode] -= 1
+        self.command_queue_depth[(unitCode, command)] -= 1
+
+    def record(self, unitCode, command, address, latency, error=False, timeout=False):
+        """A command queued with queued() was answered, failed or timed out after latency seconds"""
+        self.queue_depth[unitCode] -= 1
+        self.command_queue_depth[(unitCode, command)] -= 1
+        self.commands.setdefault((unitCode, command), CommandStats()).record(latency, error, timeout)
+        self.channels[(unitCode, command, address)] += 1
+
+    def notified(self, unitCode):
+        """The unit reported a change on its own"""
+        self.notifications[unitCode] += 1
+
+    def latency(self, command, unitCodes=None):
+        """Mean latency of a command type on the slowest of the units, all by default, DEFAULT_LATENCY if none of
+        them was sent one yet"""
+        latencies = [stats.mean_latency for (unitCode, cmd), stats in self.commands.items()
+                     if cmd == command and stats.count and (unitCodes is None or unitCode in unitCodes)]
+        return max(latencies) if latencies else DEFAULT_LATENCY
+
+    def claim(self, claimant, commands, command, unitCodes=None):
+        """Draw on the link budget, claimant sending rounds of commands of a command type to the units, all by
+        default, spaced by budget_interval(); claiming again replaces the claim"""
+        self._claims[claimant] = (commands, command, None if unitCodes is None else frozenset(unitCodes))
+
+    def release(self, claimant):
+        """Stop drawing on the link budget"""
+        self._claims.pop(claimant, None)
+
+    def budget_interval(self):
+        """Seconds between the rounds of every claimant, so all the claimants together take at most LINK_SHARE of
+        the link time"""
+        return sum(commands * self.latency(command, unitCodes)
+                   for commands, command, unitCodes in self._claims.values()) / LINK_SHARE
+
+    def units(self):
+        """Unit codes that were sent commands or reported changes, in order"""
+        return sorted(set(unitCode for unitCode, _command in self.commands) | set(self.notifications))
+
+    def unit_total(self, unitCode=None):
+        """CommandStats summed over the command types of a unit, or of all units"""
+        total = CommandStats()
+        for (unit, _command), stats in self.commands.items():
+            if unitCode is None or unit == unitCode:
+                total.merge(stats)
+        return total
+
+    def as_dict(self, channel_names=None):
+        """Everything recorded, channel_names maps (unitCode, channel, group) to the zones and sources using it"""
+        channel_names = channel_names or {}
+        units = {}
+        for unitCode in self.units():
+            units[unitCode] = {
+                'total': self.unit_total(unitCode).as_dict(),
+                'queue_depth': self.queue_depth[unitCode],
+                'max_queue_depth': self.max_queue_depth[unitCode],
+                'notifications': self.notifications[unitCode],
+                'commands': {command: dict(stats.as_dict(),
+                                           queue_depth=self.command_queue_depth[(unit, command)],
+                                           max_queue_depth=self.max_command_queue_depth[(unit, command)])
+                             for (unit, command), stats in sorted(self.commands.items()) if unit == unitCode},
+            }
+        busiest = []
+        for (unitCode, command, address), count in self.channels.most_common(TOP_CHANNELS):
+            busiest.append({
+                'unit': unitCode,
+                'command': command,
+                'address': " ".join(address),
+                'count': count,
+                'used_by': channel_names.get(_addressed_channel(unitCode, command, address), []),
+            })
+        return {
+            'seconds': round(time.time() - self.started),
+            'total': self.unit_total().as_dict(),
+            'units': units,
+            'busiest_channels': busiest,
+        }
+
+
+def _addressed_channel(unitCode, command, address):
+    """(unitCode, channel, group) a command addresses, the output for a crosspoint"""
+    if command in ('MTRX', 'MTRXLVL') and len(address) == 4:
+        channel, group = address[2], address[3]
+    elif len(address) >= 2:
+        channel, group = address[0], address[1]
+    else:
+        return None
+    return (unitCode, int(channel) if channel.isdigit() else channel, group)
@@ -0,0 +1,60 @@
+"""
+Fades against the emulator: one RAMP per channel where the unit ramps, host side steps where it rejects RAMP.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from .. import fade
+from ..emulator import XAPEmulator
+from ..routing import Channel
+from ..scheduler import XAPScheduler
+from ..state import XAPState
+from ..transport import XAPConnection, gain_to_prop
+
+CHANNELS = [Channel(0, 1, 'O'), Channel(0, 2, 'O')]
+
+
+@asynccontextmanager
+async def emulated(ramps=True):
+    """A state model of emulated unit 0, with outputs 1 and 2 read"""
+    emulator = XAPEmulator(units=(0,), latency=0.002, ramps=ramps)
+    conn = XAPConnection(await emulator.start())
+    await conn.connect()
+    xapstate = XAPState(XAPScheduler(conn, 0.01))
+    await xapstate.snapshot([tuple(channel) for channel in CHANNELS], [])
+    emulator.commands.clear()
+    try:
+        yield emulator, xapstate
+    finally:
+        await conn.close()
+        await emulator.stop()
+
+
+def test_unit_ramps_each_channel_with_one_command():
+    async def main():
+        async with emulated() as (emulator, xapstate):
+            ramped = await fade.async_fade_channels(xapstate, CHANNELS, 0.5, duration=2)
+            return ramped, dict(emulator.commands), xapstate.cachedPropGain(1, group="O")
+    ramped, commands, modelled = asyncio.run(main())
+    assert (ramped, commands) == (2, {'RAMP': 2})
+    assert abs(modelled - 0.5) < 0.01  # modelled at the target while the unit ramps
+
+
+def test_rejected_ramp_falls_back_to_host_side_steps(monkeypatch):
+    monkeypatch.setattr(fade, 'MIN_STEP_INTERVAL', 0.05)
+
+    async def main():
+        async with emulated(ramps=False) as (emulator, xapstate):
+            ramped = await fade.async_fade_channels(xapstate, CHANNELS, 0.5, duration=0.3)
+            first = dict(emulator.commands)
+            emulator.commands.clear()
+            await fade.async_fade_channels(xapstate, CHANNELS, 0.6, duration=0.1)
+            gains = [gain_to_prop(emulator.units[0].gain[(channel.channel, 'O')]) for channel in CHANNELS]
+            return ramped, first, dict(emulator.commands), gains, xapstate.stats.budget_interval()
+    ramped, first, second, gains, budget = asyncio.run(main())
+    assert ramped == 0
+    assert first['RAMP'] == 2 and first['GAIN'] >= 4  # each channel tried once, then stepped, a write per channel
+    assert 'RAMP' not in second  # remembered as not ramping
+    assert all(abs(gain - 0.6) < 0.01 for gain in gains)
+    assert budget == 0  # the fades gave their claim on the link back
@@ -0,0 +1,70 @@
+"""
+Level meters against the emulator: readings decimated to reported levels, "*" queries for well used groups, and the
+meters' share of the link budget.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from .. import meter
+from ..emulator import XAPEmulator
+from ..transport import XAPConnection
+
+
+@asynccontextmanager
+async def emulated():
+    """A connection to emulated unit 0"""
+    emulator = XAPEmulator(units=(0,), latency=0.001)
+    conn = XAPConnection(await emulator.start())
+    await conn.connect()
+    emulator.commands.clear()
+    try:
+        yield emulator, conn
+    finally:
+        await conn.close()
+        await emulator.stop()
+
+
+def test_levels_are_reported_to_observers():
+    async def main():
+        async with emulated() as (emulator, conn):
+            emulator.set_signal(0, 1, 'I', -20)
+            meters = meter.XAPMeters(conn, [(0, 1, 'I'), (0, 2, 'I')], rate=10)
+            reported = []
+            meters.add_observer([(0, 1, 'I')], lambda: reported.append(meters.level([(0, 1, 'I')])))
+            meters.start()
+            await asyncio.sleep(0.3)
+            await meters.stop()
+            return reported, meters.live([(0, 1, 'I')]), meters.live([(0, 2, 'I')])
+    reported, live, silent = asyncio.run(main())
+    assert reported and abs(reported[0][1] - -20) < 0.1
+    assert (live, silent) == (True, False)
+
+
+def test_half_used_group_is_read_with_one_query_and_sparse_group_by_channel():
+    async def main():
+        async with emulated() as (emulator, conn):
+            outputs = conn.group_channels('O')
+            inputs = conn.group_channels('I')
+            channels = [(0, channel, 'O') for channel in outputs[:(len(outputs) + 1) // 2]] + [(0, inputs[0], 'I')]
+            meters = meter.XAPMeters(conn, channels)
+            await meters._read_unit(0, meters._groups[0])
+            queried = [text.split('LVL')[1].split()[0] for text in emulator.received if 'LVL' in text]
+            return queried, meters.readings, len(channels)
+    queried, readings, expected = asyncio.run(main())
+    assert sorted(queried) == sorted(['*', '1'])
+    assert readings == expected
+
+
+def test_readings_claim_the_link_budget_until_stopped():
+    async def main():
+        async with emulated() as (_emulator, conn):
+            meters = meter.XAPMeters(conn, [(0, 1, 'I'), (0, 2, 'I'), (0, 3, 'I')], rate=0.1)
+            idle = conn.stats.budget_interval()
+            meters.start()
+            claimed = conn.stats.budget_interval()
+            await meters.stop()
+            return idle, claimed, conn.stats.budget_interval()
+    idle, claimed, released = asyncio.run(main())
+    assert idle == released == 0
+    assert claimed > 0
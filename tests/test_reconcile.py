@@ -0,0 +1,73 @@
+"""
+Reconciler and background loading against the emulator: changes made behind our back reach the model and only the
+listeners of what changed, and a unit that could not be read at startup is read again until it answers.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from .. import state
+from ..emulator import XAPEmulator
+from ..reconcile import XAPReconciler
+from ..scheduler import XAPScheduler
+from ..state import XAPState
+from ..transport import XAPConnection, XAPError
+
+CHANNELS = [(0, 1, 'O'), (0, 2, 'O')]
+CROSSPOINTS = [(0, 9, 'I', 1), (0, 10, 'I', 1)]
+
+
+@asynccontextmanager
+async def emulated():
+    """A state model of emulated unit 0, which does not report changes on its own"""
+    emulator = XAPEmulator(units=(0,), latency=0.001, echo=False)
+    conn = XAPConnection(await emulator.start())
+    await conn.connect()
+    xapstate = XAPState(XAPScheduler(conn, 0.01))
+    try:
+        yield emulator, xapstate
+    finally:
+        await xapstate.stop_loading()
+        await conn.close()
+        await emulator.stop()
+
+
+def test_sweep_finds_external_changes_and_tells_their_listeners():
+    async def main():
+        async with emulated() as (emulator, xapstate):
+            await xapstate.snapshot(CHANNELS, CROSSPOINTS)
+            reconciler = XAPReconciler(xapstate, CHANNELS, CROSSPOINTS)
+            told = []
+            xapstate.listen([('mute', 0, 1, 'O')], lambda: told.append('output 1'))
+            xapstate.listen([('mute', 0, 2, 'O')], lambda: told.append('output 2'))
+            xapstate.listen([('routing', 0, 10, 'I', 1)], lambda: told.append('crosspoint'))
+            emulator.change("#50 MUTE 1 O 1")
+            emulator.change("#50 MTRX 10 I 1 O 1")
+            changed = await reconciler.sweep()
+            again = await reconciler.sweep()
+            return (sorted(changed, key=str), again, told, xapstate.cachedMute(1, group="O"),
+                    xapstate.cachedMatrixRouting(10, 1))
+    changed, again, told, muted, routed = asyncio.run(main())
+    assert changed == [('mute', 0, 1, 'O'), ('routing', 0, 10, 'I', 1)]
+    assert (again, sorted(told), muted, routed) == ([], ['crosspoint', 'output 1'], 1, 1)
+
+
+def test_unit_not_read_at_startup_is_read_again(monkeypatch):
+    monkeypatch.setattr(state, 'LOAD_RETRY_DELAYS', (0.01, 0.02))
+    snapshot_unit = XAPState._snapshot_unit
+    attempts = []
+
+    async def failing_twice(self, *args, **kwargs):
+        attempts.append(args[0])
+        if len(attempts) <= 2:
+            raise XAPError("No reply")
+        return await snapshot_unit(self, *args, **kwargs)
+    monkeypatch.setattr(XAPState, '_snapshot_unit', failing_twice)
+
+    async def main():
+        async with emulated() as (_emulator, xapstate):
+            xapstate.start_loading(CHANNELS, CROSSPOINTS)
+            await asyncio.wait_for(xapstate.loaded([0]), 1)
+            return xapstate.cachedMute(1, group="O")
+    assert asyncio.run(main()) == 0
+    assert attempts == [0, 0, 0]
@@ -0,0 +1,50 @@
+"""
+RoutingTable: which sources reach which zones, and through which crosspoints.
+"""
+
+import pytest
+
+from ..routing import Crosspoint, RoutingError, RoutingTable
+
+
+def test_source_on_the_zone_unit_is_routed_directly():
+    routing = RoutingTable({'TV': [9, 10]}, {'Kitchen': [1, 2]})
+    assert routing.routes[('Kitchen', 'TV')] == (Crosspoint(0, 9, 'I', 1, 1), Crosspoint(0, 10, 'I', 2, 1))
+
+
+def test_source_on_another_unit_is_routed_through_its_bus():
+    routing = RoutingTable({'TV': ['0:9:O:E']}, {'Office': ['1:3']})
+    assert routing.routes[('Office', 'TV')] == (Crosspoint(1, 'O', 'E', 3, 1),)
+
+
+def test_unreachable_source_is_left_out_of_that_zone_only():
+    # the README basic configuration: WorkRoom is on unit 2, the sources on unit 0 have no bus
+    routing = RoutingTable({'Home Audio': [9], 'Family TV Audio': [11]},
+                           {'Office': [1], 'Kitchen': [3], 'WorkRoom': ['2:1']})
+    assert dict(routing.zone_routes('WorkRoom')) == {}
+    assert set(routing.zone_routes('Office')) == {'Home Audio', 'Family TV Audio'}
+    assert set(routing.unreachable) == {('WorkRoom', 'Home Audio'), ('WorkRoom', 'Family TV Audio')}
+    assert {unit for unit, _input, _inGroup, _output in routing.crosspoints()} == {0}
+
+
+def test_source_missing_one_zone_channel_is_not_offered():
+    # the second slot of the zone is on unit 1, which only the bus reaches
+    routing = RoutingTable({'Local': [9], 'Bussed': ['0:10:P:E']}, {'Split': ['0:1', '1:2']})
+    assert set(routing.zone_routes('Split')) == {'Bussed'}
+
+
+def test_mic_inputs_are_switched_on_as_mic():
+    routing = RoutingTable({'Mic': [1], 'Line': [12]}, {'Hall': [1]})
+    assert routing.routes[('Hall', 'Mic')][0].on == 3
+    assert routing.routes[('Hall', 'Line')][0].on == 1
+
+
+@pytest.mark.parametrize('sources, zones', [
+    ({'Bad': ['x']}, {'Zone': [1]}),
+    ({'Bad': ['0:1:O:E:1']}, {'Zone': [1]}),
+    ({'TV': [9]}, {'Bad': ['one']}),
+    ({'TV': [9]}, {'Empty': []}),
+])
+def test_invalid_channels_are_rejected(sources, zones):
+    with pytest.raises(RoutingError):
+        RoutingTable(sources, zones)
@@ -0,0 +1,106 @@
+"""
+Scenes: the requests of several zones merged per address, sent in phases against the emulator, and zone locks taken
+in one order.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from ..emulator import XAPEmulator
+from ..scene import ScenePlan, async_apply_scene
+from ..scheduler import XAPScheduler
+from ..state import XAPState
+from ..transport import XAPConnection
+
+
+@asynccontextmanager
+async def emulated():
+    """A state model of emulated unit 0, output 1 unmuted, output 2 muted and crosspoint 10 to 2 on"""
+    emulator = XAPEmulator(units=(0,), latency=0.001)
+    conn = XAPConnection(await emulator.start())
+    await conn.connect()
+    xapstate = XAPState(XAPScheduler(conn, 0.01))
+    await xapstate.snapshot([(0, 1, 'O'), (0, 2, 'O')], [(0, 9, 'I', 1), (0, 10, 'I', 2)])
+    await xapstate.setMute(2, 1, group="O")
+    await xapstate.setMatrixRouting(10, 2, 1)
+    emulator.received.clear()
+    try:
+        yield emulator, xapstate
+    finally:
+        await conn.close()
+        await emulator.stop()
+
+
+def test_crosspoint_switched_on_by_one_zone_and_off_by_another_stays_on():
+    plan = ScenePlan()
+    plan.add({(0, 9, 'I', 1): 1}, {(0, 1): 0.5}, {(0, 1): False})
+    plan.add({(0, 9, 'I', 1): 0, (0, 10, 'I', 1): 0}, {(0, 1): 0.7}, {(0, 1): True})
+    assert plan.routing == {(0, 9, 'I', 1): 1, (0, 10, 'I', 1): 0}
+    assert (plan.gains, plan.mutes, len(plan)) == ({(0, 1): 0.7}, {(0, 1): 1}, 4)
+
+
+def test_phases_mute_then_route_then_set_gains_then_unmute():
+    async def main():
+        async with emulated() as (emulator, xapstate):
+            plan = ScenePlan()
+            plan.add({(0, 9, 'I', 1): 1, (0, 10, 'I', 2): 0}, {(0, 2): 0.5}, {(0, 1): True, (0, 2): False})
+            await plan.async_execute(xapstate)
+            return [text.split()[1:] for text in emulator.received]
+    sent = asyncio.run(main())
+    assert [fields[0] for fields in sent] == ['MUTE', 'MTRX', 'MTRX', 'GAIN', 'MUTE']
+    assert (sent[0][1], sent[1][1:4], sent[2][1:4], sent[4][1]) == ('1', ['10', 'I', '2'], ['9', 'I', '1'], '2')
+
+
+class RecordingLock:
+    """An asyncio.Lock noting the order it is taken in"""
+
+    def __init__(self, name, taken):
+        self._lock = asyncio.Lock()
+        self._name = name
+        self._taken = taken
+
+    async def __aenter__(self):
+        await self._lock.acquire()
+        self._taken.append(self._name)
+        await asyncio.sleep(0)  # let a scene taking the locks in another order run into them
+
+    async def __aexit__(self, *exc_info):
+        self._lock.release()
+
+
+class FakeState:
+    """A state model nothing is written to"""
+    skipped = 0
+
+
+class FakeZone:
+    """A zone with no commands, recording the scenes applied to it"""
+
+    def __init__(self, name, taken, xapstate):
+        self.name = name
+        self.routing_lock = RecordingLock(name, taken)
+        self.xapstate = xapstate
+        self.applied = []
+
+    def __str__(self):
+        return self.name
+
+    def scene_commands(self, **settings):
+        return {}, {}, {}
+
+    def scene_applied(self, **settings):
+        self.applied.append(settings)
+
+
+def test_scenes_naming_zones_in_any_order_take_their_locks_in_one_order():
+    async def main():
+        taken = []
+        xapstate = FakeState()
+        kitchen, office = FakeZone('Kitchen', taken, xapstate), FakeZone('Office', taken, xapstate)
+        await asyncio.wait_for(asyncio.gather(
+            async_apply_scene([(office, {'volume': 0.5}), (kitchen, {'volume': 0.5})]),
+            async_apply_scene([(kitchen, {'mute': True}), (office, {'mute': True})])), 1)
+        return taken, len(kitchen.applied), len(office.applied)
+    taken, kitchen, office = asyncio.run(main())
+    assert taken == ['Kitchen', 'Office', 'Kitchen', 'Office']
+    assert (kitchen, office) == (2, 2)
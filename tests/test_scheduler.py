@@ -0,0 +1,65 @@
+"""
+XAPScheduler: gain and mute writes coalesced per channel and paced, against the emulator.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from ..emulator import XAPEmulator
+from ..scheduler import XAPScheduler
+from ..transport import XAPConnection
+
+
+@asynccontextmanager
+async def emulated(min_interval=0.05, latency=0.005):
+    """A scheduler on a connection to emulated unit 0"""
+    emulator = XAPEmulator(units=(0,), latency=latency)
+    conn = XAPConnection(await emulator.start())
+    await conn.connect()
+    scheduler = XAPScheduler(conn, min_interval)
+    try:
+        yield emulator, scheduler
+    finally:
+        await scheduler.close()
+        await conn.close()
+        await emulator.stop()
+
+
+def test_writes_while_one_is_paced_coalesce_to_the_last():
+    async def main():
+        async with emulated() as (emulator, scheduler):
+            await scheduler.setMute(1, 1, group="O")  # the next write to the channel waits min_interval
+            results = await asyncio.gather(*[scheduler.setPropGain(1, gain, group="O")
+                                             for gain in (0.2, 0.4, 0.6, 0.8)])
+            results += await asyncio.gather(*[scheduler.setMute(1, muted, group="O") for muted in (0, 1, 0)])
+            return emulator.commands, scheduler.coalesced, results, emulator.units[0].mute[(1, 'O')]
+    commands, coalesced, results, muted = asyncio.run(main())
+    assert (commands['GAIN'], commands['MUTE'], coalesced, muted) == (1, 2, 5, 0)
+    assert len(set(results[:4])) == 1 and abs(results[0] - 0.8) < 0.01  # every caller gets the value sent
+    assert results[4:] == [0, 0, 0]
+
+
+def test_writes_to_a_channel_are_spaced_by_min_interval():
+    async def main():
+        async with emulated(min_interval=0.1) as (_emulator, scheduler):
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            await scheduler.setMute(1, 1, group="O")
+            await scheduler.setMute(1, 0, group="O")
+            await scheduler.setMute(2, 1, group="O")  # another channel is not held up
+            return loop.time() - start
+    assert 0.1 <= asyncio.run(main()) < 0.2
+
+
+def test_close_cancels_pending_writes():
+    async def main():
+        async with emulated(min_interval=1.0) as (emulator, scheduler):
+            await scheduler.setMute(1, 1, group="O")
+            waiting = asyncio.ensure_future(scheduler.setMute(1, 0, group="O"))
+            await asyncio.sleep(0.01)
+            await scheduler.close()
+            try:
+                await waiting
+            except asyncio.CancelledError:
+                return emulator.commands['MUTE'], scheduler.busy
+    assert asyncio.run(main()) == (1, False)
@@ -0,0 +1,57 @@
+"""
+Sessions: a session recorded against the emulator and replayed in its place puts the state model in the state it
+ended in when recorded.
+"""
+
+import asyncio
+
+from .. import session
+from ..emulator import XAPEmulator
+from ..scheduler import XAPScheduler
+from ..state import XAPState
+from ..transport import XAPConnection
+
+CHANNELS = [(0, 1, 'O'), (0, 2, 'O')]
+CROSSPOINTS = [(0, 9, 'I', 1), (0, 10, 'I', 1)]
+
+
+async def drive(conn, emulator=None):
+    """Read the units, make some writes and, when recording, a change on the front panel, returns the model"""
+    await conn.connect()
+    xapstate = XAPState(XAPScheduler(conn, 0.01))
+    conn.add_listener(xapstate.notified)
+    await xapstate.snapshot(CHANNELS, CROSSPOINTS)
+    await xapstate.setMute(1, 1, group="O")
+    await xapstate.setPropGain(2, 0.25, group="O")
+    await xapstate.setMatrixRouting(9, 1, 1)
+    if emulator is not None:
+        emulator.change("#50 MUTE 2 O 1")
+    await asyncio.sleep(0.05)  # for the change to arrive
+    await conn.close()
+    return xapstate.as_dict()
+
+
+def test_replay_reproduces_the_recorded_end_state(tmp_path):
+    log = str(tmp_path / 'session.log.gz')
+
+    async def record():
+        emulator = XAPEmulator(units=(0,), latency=0.001)
+        conn = XAPConnection(await emulator.start())
+        recorder = session.SessionRecorder(log)
+        await recorder.open()
+        conn.recorder = recorder
+        try:
+            return await drive(conn, emulator)
+        finally:
+            await recorder.close()
+            await emulator.stop()
+
+    async def replay():
+        return await drive(XAPConnection('replay://{}?speed=0'.format(log)))
+
+    recorded = asyncio.run(record())
+    replayed = asyncio.run(replay())
+    assert replayed == recorded
+    assert sorted(recorded['units']['0']['mute']) == [[1, 'O', 1], [2, 'O', 1]]  # the change on the panel too
+    kinds = [kind for _seconds, kind, _text in session.read_log(log)]
+    assert kinds.count('!') == 1 and '>' in kinds and '<' in kinds
@@ -0,0 +1,99 @@
+"""
+XAPState against the emulator: writes the model shows are already in effect are skipped, and only those.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from ..emulator import XAPEmulator
+from ..scheduler import XAPScheduler
+from ..state import XAPState
+from ..transport import XAPConnection
+
+
+@asynccontextmanager
+async def emulated(latency=0.005):
+    """A state model of emulated unit 0, with outputs 1 and 2 and crosspoint 9 to 1 read"""
+    emulator = XAPEmulator(units=(0,), latency=latency)
+    conn = XAPConnection(await emulator.start())
+    await conn.connect()
+    xapstate = XAPState(XAPScheduler(conn))
+    await xapstate.snapshot([(0, 1, 'O'), (0, 2, 'O')], [(0, 9, 'I', 1)], levels=[(0, 9, 'I', 1)])
+    emulator.commands.clear()
+    try:
+        yield emulator, xapstate
+    finally:
+        await conn.close()
+        await emulator.stop()
+
+
+def test_write_matching_the_model_is_skipped():
+    async def main():
+        async with emulated() as (emulator, xapstate):
+            await xapstate.setMute(1, 0, group="O")
+            await xapstate.setMatrixRouting(9, 1, 0)
+            await xapstate.setMatrixLevel(9, 1, 0.0)
+            return dict(emulator.commands), xapstate.skipped
+    assert asyncio.run(main()) == ({}, 3)
+
+
+def test_write_differing_from_the_model_is_sent_once():
+    async def main():
+        async with emulated() as (emulator, xapstate):
+            await xapstate.setMute(1, 1, group="O")
+            await xapstate.setMute(1, 1, group="O")
+            return dict(emulator.commands), xapstate.cachedMute(1, group="O"), emulator.units[0].mute[(1, 'O')]
+    assert asyncio.run(main()) == ({'MUTE': 1}, 1, 1)
+
+
+def test_unmute_right_after_a_mute_is_still_sent():
+    async def main():
+        async with emulated() as (emulator, xapstate):
+            mute = asyncio.ensure_future(xapstate.setMute(1, 1, group="O"))
+            await asyncio.sleep(0.002)  # the mute is sent but not confirmed yet
+            unmute = asyncio.ensure_future(xapstate.setMute(1, 0, group="O"))
+            await asyncio.gather(mute, unmute)
+            return emulator.units[0].mute[(1, 'O')], xapstate.cachedMute(1, group="O"), xapstate.skipped
+    assert asyncio.run(main()) == (0, 0, 0)
+
+
+def test_write_matching_one_in_flight_is_skipped():
+    async def main():
+        async with emulated() as (emulator, xapstate):
+            first = asyncio.ensure_future(xapstate.setMute(2, 1, group="O"))
+            await asyncio.sleep(0.002)
+            await asyncio.gather(first, xapstate.setMute(2, 1, group="O"))
+            return dict(emulator.commands), xapstate.skipped
+    assert asyncio.run(main()) == ({'MUTE': 1}, 1)
+
+
+def test_toggle_is_never_skipped():
+    async def main():
+        async with emulated() as (emulator, xapstate):
+            await xapstate.setMute(1, 2, group="O")
+            await xapstate.setMute(1, 2, group="O")
+            return emulator.commands['MUTE'], xapstate.cachedMute(1, group="O")
+    assert asyncio.run(main()) == (2, 0)
+
+
+def test_level_profile_only_sends_what_differs_unless_forced():
+    async def main():
+        async with emulated() as (emulator, xapstate):
+            levels = {(0, 9, 'I', 1): -6.0}
+            sent = [await xapstate.setMatrixLevels(levels), await xapstate.setMatrixLevels(levels),
+                    await xapstate.setMatrixLevels(levels, force=True)]
+            return sent, emulator.commands['MTRXLVL'], emulator.units[0].level[(9, 'I', 1)]
+    assert asyncio.run(main()) == ([1, 0, 1], 2, -6.0)
+
+
+def test_change_outside_is_found_by_refreshing():
+    async def main():
+        async with emulated() as (emulator, xapstate):
+            emulator.units[0].mute[(2, 'O')] = 1
+            emulator.units[0].level[(9, 'I', 1)] = -3.0
+            changed = await xapstate.refresh_channel(2, group="O") + await xapstate.refresh_level(9, 1)
+            await xapstate.setMute(2, 1, group="O")
+            return changed, dict(emulator.commands)
+    changed, commands = asyncio.run(main())
+    assert changed == [('mute', 0, 2, 'O'), ('level', 0, 9, 'I', 1)]
+    assert commands == {'GAIN': 1, 'MUTE': 1, 'MTRXLVL': 1}
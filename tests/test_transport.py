@@ -0,0 +1,125 @@
+"""
+XAPConnection against the emulator: line splitting, merging of queued work, and reopening a lost link.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from .. import transport
+from ..emulator import XAPEmulator
+from ..transport import (PRIORITY_AUTOMATION, PRIORITY_INTERACTIVE, LineParser, XAPConnection, XAPError,
+                         request_priority)
+
+
+@asynccontextmanager
+async def emulated(latency=0.02, tcp=False, **kwargs):
+    """An emulated unit 0 and a connection to it, each command taking latency seconds"""
+    emulator = XAPEmulator(units=(0,), latency=latency, **kwargs)
+    path = await (emulator.start_tcp() if tcp else emulator.start())
+    conn = XAPConnection(path)
+    await conn.connect()
+    try:
+        yield emulator, conn
+    finally:
+        await conn.close()
+        await emulator.stop()
+
+
+def test_line_parser_splits_lines_across_chunks():
+    parser = LineParser()
+    assert parser.feed(b'#50 GAIN 1 O -10.00 A\r\n#50 MU') == [b'#50 GAIN 1 O -10.00 A']
+    assert parser.feed(b'TE 1 O 1') == []
+    assert parser.feed(b'\r\n\r\n#50 MTRX 1 I 1 O 1\r') == [b'#50 MUTE 1 O 1', b'#50 MTRX 1 I 1 O 1']
+    assert parser.feed(b'\n') == []
+
+
+def test_line_parser_handles_one_byte_at_a_time():
+    parser = LineParser()
+    lines = []
+    for byte in b'#50 VER\r\n#50 MUTE 2 O 0\r\n':
+        lines += parser.feed(bytes([byte]))
+    assert lines == [b'#50 VER', b'#50 MUTE 2 O 0']
+
+
+def test_identical_queries_share_one_command():
+    async def main():
+        async with emulated() as (emulator, conn):
+            busy = asyncio.ensure_future(conn.getPropGain(1, group="O"))  # on the wire, the rest stay queued
+            await asyncio.sleep(0)
+            results = await asyncio.gather(conn.getMute(2, group="O"), conn.getMute(2, group="O"), busy)
+            return emulator.commands['MUTE'], conn.shared, results[:2]
+    sent, shared, results = asyncio.run(main())
+    assert (sent, shared, results) == (1, 1, [0, 0])
+
+
+def test_queued_write_is_replaced_by_a_newer_one():
+    async def main():
+        async with emulated() as (emulator, conn):
+            busy = asyncio.ensure_future(conn.getPropGain(1, group="O"))
+            await asyncio.sleep(0)
+            results = await asyncio.gather(conn.setMute(2, 1, group="O"), conn.setMute(2, 0, group="O"), busy)
+            return emulator.commands['MUTE'], conn.replaced, results[:2], emulator.units[0].mute.get((2, 'O'))
+    sent, replaced, results, muted = asyncio.run(main())
+    assert (sent, replaced, results, muted) == (1, 1, [0, 0], 0)
+
+
+def test_more_urgent_write_replaces_a_queued_one():
+    async def main():
+        async with emulated() as (emulator, conn):
+            busy = asyncio.ensure_future(conn.getPropGain(1, group="O"))
+            await asyncio.sleep(0)
+            with request_priority(PRIORITY_AUTOMATION):
+                automation = asyncio.ensure_future(conn.setMute(2, 1, group="O"))
+            await asyncio.sleep(0)
+            with request_priority(PRIORITY_INTERACTIVE):
+                interactive = asyncio.ensure_future(conn.setMute(2, 0, group="O"))
+            results = await asyncio.gather(automation, interactive, busy)
+            return emulator.commands['MUTE'], results[:2], emulator.received[-1]
+    sent, results, last = asyncio.run(main())
+    assert (sent, results, last) == (1, [0, 0], '#50 MUTE 2 O 0')
+
+
+def test_toggles_are_never_merged():
+    async def main():
+        async with emulated() as (emulator, conn):
+            busy = asyncio.ensure_future(conn.getPropGain(1, group="O"))
+            await asyncio.sleep(0)
+            results = await asyncio.gather(conn.setMute(2, 2, group="O"), conn.setMute(2, 2, group="O"), busy)
+            return emulator.commands['MUTE'], results[:2]
+    assert asyncio.run(main()) == (2, [1, 0])
+
+
+def test_cancelled_caller_drops_its_queued_command():
+    async def main():
+        async with emulated() as (emulator, conn):
+            busy = asyncio.ensure_future(conn.getPropGain(1, group="O"))
+            await asyncio.sleep(0)
+            dropped = asyncio.ensure_future(conn.setMute(2, 1, group="O"))
+            await asyncio.sleep(0)
+            dropped.cancel()
+            await busy
+            await conn.getMute(3, group="O")
+            return emulator.received
+    assert '#50 MUTE 2 O 1' not in asyncio.run(main())
+
+
+def test_link_is_reopened_after_it_is_lost(monkeypatch):
+    monkeypatch.setattr(transport, 'RECONNECT_DELAYS', (0.01, 0.05))
+
+    async def main():
+        async with emulated(latency=0.001, tcp=True) as (emulator, conn):
+            reconnected = asyncio.Event()
+            conn.add_reconnect_listener(reconnected.set)
+            await conn.setMute(1, 1, group="O")
+            emulator.drop()
+            await asyncio.sleep(0.005)
+            failed = None
+            try:
+                await conn.getMute(1, group="O")
+            except XAPError as err:
+                failed = err
+            await asyncio.wait_for(reconnected.wait(), 2)
+            return failed, conn.connected, conn.reconnects, await conn.getMute(1, group="O")
+    failed, connected, reconnects, muted = asyncio.run(main())
+    assert isinstance(failed, XAPError)
+    assert (connected, reconnects, muted) == (True, 1, 1)
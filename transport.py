@@ -0,0 +1,910 @@
+"""
+Asyncio implementation of the ClearOne XAP serial protocol.
+
+Commands are ASCII lines of the form "#<device type><unit> <command> <arguments>" terminated by a carriage return.
+The unit answers with a line that repeats the device, command and addressing arguments followed by the value, for
+example "#50 GAIN 1 O -10.00 A".  All units in a system share the serial link, so every command for every unit goes
+through one XAPConnection.
+
+The serial port is opened non-blocking and driven by asyncio, so no executor threads are held while waiting on the
+device.  The link can also be a TCP connection to a serial-over-IP gateway such as ser2net, given as a path of the
+form "tcp://host:port"; other kinds of link can be added to LINK_TYPES.  An owner task writes the queued commands;
+callers get a future they can await.  On a serial port it writes one command at a time.  On a network link, where the
+round trip to the gateway costs more than the command, up to TCP_PIPELINE commands for different channels are written
+at once.  A receiver task reads everything the units send as it arrives and splits it into lines without searching
+any byte twice.  A line addressed like a command in flight is its reply; any other line in the same format is a
+change a unit reported on its own, such as one made by another controller, and is passed to the listeners as a
+Notification.  XAPConnection provides coroutine versions of the XAPX00 methods used by the platform (getPropGain,
+setMute, setMatrixRouting, ...), gains are converted to and from the proportional 0..1 range used for volume.
+
+Commands are queued in three priority classes, interactive, automation and background, and the most urgent is always
+sent next, so a button press waits for at most the command already on the wire.  The class of a command is taken
+from request_priority, set by whoever starts the work.  Each class has a bounded queue and a deadline after which a
+queued command is dropped instead of sent late.  Work made stale while queued is not sent: a query identical to a
+queued one shares its reply, an absolute write replaces a queued write to the same channel, and a command nobody
+waits for any more is skipped.
+
+Units that support it ramp a gain to a target themselves at a given rate with RAMP, so a fade is one command per
+channel.  A unit that answers RAMP with an error is remembered as not supporting it, and rampGain raises
+XAPUnsupported for it from then on without asking again.
+
+The count, outcome and latency of every command are recorded per unit and command type in XAPConnection.stats.
+Every line sent and received can also be written to a session log by a session.SessionRecorder, to be replayed.
+
+The link is kept open.  When it is lost, because the port or socket is closed, or on a network link because several
+commands in a row got no reply, the commands in flight fail, and the link is opened again in the background, waiting
+longer after each failed attempt.  Commands fail straight away while it is down.  Once it is back, the reconnect
+listeners are called, so whatever changed meanwhile can be read again.
+
+A query can use "*" in place of a channel to read a whole row or column of the matrix, or the level meters of a
+whole group, at once; the unit then answers with one line per channel.
+
+Where units have a port each, XAPLinks gives every unit code its own XAPConnection and sends each command on the
+link of the unit it is for.  The links have their own queues and owner tasks, so commands for different units are
+sent in parallel.
+"""
+
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import count
+from string import ascii_uppercase
+
+import asyncio
+import logging
+import os
+import re
+import socket
+import termios
+import tty
+
+from .routing import MATRIX_GEOMETRY
+from .stats import XAPStats
+
+_LOGGER = logging.getLogger(__name__)
+
+DEVICE_TYPE = {'XAP800': '5', 'XAP400': '4'}  # device type digit of the command prefix
+GAIN_RANGE = (-65.0, 20.0)  # dB range of the GAIN command, mapped to 0..1
+RAMP_RATE_RANGE = (0.1, 50.0)  # dB per second range of the RAMP command
+MATRIX_LEVEL_RANGE = (-60.0, 12.0)  # dB range of the MTRXLVL command
+METER_RANGE = (-80.0, 20.0)  # dB range of the LVL level meters, the low end is silence
+METER_TYPE = 'A'  # level meter read by LVL, the signal level after the channel's gain
+COMMAND_TIMEOUT = 1.0  # seconds to wait for a reply
+LINE_TIMEOUT = 0.1  # extra seconds to wait for each additional line of a multi line reply
+DEFAULT_BAUD = 38400
+READ_SIZE = 1024
+LINE_END = re.compile(rb'[\r\n]+')
+TCP_PIPELINE = 8  # commands written at once on a network link
+CONNECT_TIMEOUT = 5.0  # seconds to wait for a gateway to accept a connection
+KEEPALIVE = 10  # seconds a network link is silent before TCP keepalive probes check it is still there
+DEAD_TIMEOUTS = 3  # unanswered commands in a row after which a network link is taken as lost
+RECONNECT_DELAYS = (1.0, 60.0)  # seconds before the first attempt to reopen a lost link, and at most between them
+
+# priority classes of commands, lower is served first
+PRIORITY_INTERACTIVE = 0  # a user pressing something
+PRIORITY_AUTOMATION = 1   # automations, scenes, startup
+PRIORITY_BACKGROUND = 2   # polling
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_AUTOMATION: 'automation',
+                  PRIORITY_BACKGROUND: 'background'}
+QUEUE_LIMITS = {PRIORITY_INTERACTIVE: 64, PRIORITY_AUTOMATION: 512, PRIORITY_BACKGROUND: 64}
+DEADLINES = {PRIORITY_INTERACTIVE: 2.0, PRIORITY_AUTOMATION: 10.0, PRIORITY_BACKGROUND: 30.0}  # seconds in queue
+
+# priority of the commands sent by the current task, see request_priority
+command_priority = ContextVar('command_priority', default=PRIORITY_AUTOMATION)
+
+# number of arguments after the command that address the channel, replies are matched on these
+ADDRESS_ARGS = {'GAIN': 2, 'MUTE': 2, 'MTRX': 4, 'MTRXLVL': 4, 'RAMP': 2, 'LVL': 3}
+
+# channels of each matrix input group
+INPUT_GROUP_CHANNELS = {
+    'E': tuple(ascii_uppercase[ascii_uppercase.find('O'):]),  # expansion bus O..Z
+    'P': tuple(ascii_uppercase[:8]),                          # processing A..H
+}
+
+
+@contextmanager
+def request_priority(priority):
+    """Send the commands of the enclosed block, and of tasks it starts, with the given priority"""
+    token = command_priority.set(priority)
+    try:
+        yield
+    finally:
+        command_priority.reset(token)
+
+
+def parse_channel(channel):
+    """Channel field of a reply, numbered channels as int, lettered ones as str"""
+    return int(channel) if channel.isdigit() else channel
+
+
+# a change a unit reported on its own, address holds the channel fields as in the command
+Notification = namedtuple('Notification', ['unitCode', 'command', 'address', 'value'])
+
+
+class XAPError(Exception):
+    """The unit rejected a command"""
+
+
+class XAPTimeout(XAPError):
+    """The unit did not answer a command in time"""
+
+
+class XAPRejected(XAPError):
+    """The unit answered a command with an error"""
+
+
+class XAPUnsupported(XAPRejected):
+    """The unit does not support the command"""
+
+
+class XAPQueueFull(XAPError):
+    """Too many commands of one priority are waiting to be sent"""
+
+
+def gain_to_prop(db):
+    """dB gain to proportional 0..1"""
+    low, high = GAIN_RANGE
+    return min(max((float(db) - low) / (high - low), 0.0), 1.0)
+
+
+def prop_to_gain(prop):
+    """Proportional 0..1 to dB gain, rounded to the 0.01 dB resolution of the unit"""
+    low, high = GAIN_RANGE
+    return round(low + min(max(float(prop), 0.0), 1.0) * (high - low), 2)
+
+
+async def open_serial(path, baud=DEFAULT_BAUD):
+    """Open a serial port in raw, non-blocking mode, returns (StreamReader, StreamWriter)"""
+    speed = getattr(termios, 'B{}'.format(baud), None)
+    if speed is None:
+        raise ValueError('Unsupported baud rate {}'.format(baud))
+    fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        tty.setraw(fd)
+        attrs = termios.tcgetattr(fd)
+        attrs[4] = attrs[5] = speed
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    except termios.error:
+        os.close(fd)
+        raise
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', buffering=0))
+    wtransport, wprotocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, os.fdopen(os.dup(fd), 'wb', buffering=0))
+    return reader, asyncio.StreamWriter(wtransport, wprotocol, reader, loop)
+
+
+async def open_tcp(address, baud=None):
+    """Open a TCP connection to a serial-over-IP gateway at "host:port", returns (StreamReader, StreamWriter)
+
+    The baud rate is that of the gateway's serial port and is set there."""
+    host, _sep, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError('Invalid address {}, expected host:port'.format(address))
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host.strip('[]'), int(port)),
+                                                CONNECT_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise OSError('Timed out connecting to {}'.format(address))
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', KEEPALIVE), ('TCP_KEEPINTVL', KEEPALIVE), ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, option):  # not on every platform
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    return reader, writer
+
+
+# a kind of link: opener(address, baud) is a coroutine returning (StreamReader, StreamWriter), pipeline the number of
+# commands written at once, and network is True if several unanswered commands in a row mean the link is lost
+LinkType = namedtuple('LinkType', ['opener', 'pipeline', 'network'])
+
+# scheme of a path: its kind of link, a path without a scheme is a serial port
+LINK_TYPES = {
+    'serial': LinkType(open_serial, 1, False),
+    'tcp': LinkType(open_tcp, TCP_PIPELINE, True),
+}
+
+
+def parse_path(path):
+    """(LinkType, address) of a path, "tcp://host:port" for a gateway, "/dev/ttyUSB0" for a serial port"""
+    scheme, sep, address = path.partition('://')
+    if not sep:
+        return LINK_TYPES['serial'], path
+    if scheme.lower() not in LINK_TYPES:
+        raise ValueError('Unsupported link {}, expected one of {}'.format(path, sorted(LINK_TYPES)))
+    return LINK_TYPES[scheme.lower()], address
+
+
+class LineParser:
+    """
+    Splits the byte stream from the units into lines, as it arrives
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0  # bytes of the buffer already searched for a line end
+
+    def feed(self, data):
+        """Add received bytes, returns the complete lines they finish, without their line ends
+
+        Only the new bytes are searched, a partial line is kept until its end arrives."""
+        self._buffer.extend(data)
+        lines = []
+        start = 0
+        pos = self._scanned
+        while True:
+            end = LINE_END.search(self._buffer, pos)
+            if end is None:
+                break
+            if end.start() > start:
+                lines.append(bytes(self._buffer[start:end.start()]))
+            start = pos = end.end()
+        del self._buffer[:start]
+        self._scanned = len(self._buffer)
+        return lines
+
+
+class Request:
+    """
+    A command waiting to be sent, shared by every caller waiting on its reply
+    """
+
+    def __init__(self, unitCode, command, line, match, lines, priority, deadline, queued, future):
+        self.unitCode = unitCode
+        self.command = command
+        self.line = line
+        self.match = match
+        self.lines = lines
+        self.priority = priority
+        self.deadline = deadline  # loop time after which it is dropped instead of sent
+        self.queued = queued  # loop time it was queued
+        self.future = future
+        self.waiters = 0
+        self.sent = False
+        self.replaced_by = None  # a more urgent write to the same channel, that completes this one
+
+    @property
+    def key(self):
+        """What the command addresses, writes to the same key replace each other"""
+        return (self.unitCode, tuple(self.match[1:]))
+
+    @property
+    def query(self):
+        return len(self.line.split()) <= len(self.match)
+
+    @property
+    def replaceable(self):
+        """True for an absolute write, which a newer write to the same channel makes pointless"""
+        if self.query:
+            return False
+        fields = self.line.split()
+        if self.command in ('GAIN', 'MTRXLVL', 'RAMP'):
+            return fields[-1] != b'R'
+        return fields[-1] != b'2'  # toggles depend on the value before them
+
+
+class XAPConnection:
+    """
+    Serial or network link to one or more daisy chained XAP units
+    """
+
+    def __init__(self, path, baud=DEFAULT_BAUD, XAPType="XAP800", timeout=COMMAND_TIMEOUT, stats=None):
+        """stats is the XAPStats to record in, shared by links to different units of one system"""
+        self.path = path
+        self.baud = baud
+        self.XAPType = XAPType
+        self.timeout = timeout
+        self.stereo = 0
+        self.matrixGeo = MATRIX_GEOMETRY[XAPType]
+        self.input_range = range(1, self.matrixGeo + 1)
+        self.output_range = range(1, self.matrixGeo + 1)
+        self._device = DEVICE_TYPE[XAPType]
+        self._queue = asyncio.PriorityQueue()  # (priority, sequence, Request)
+        self._sequence = count()  # keeps the queue first in first out within a priority
+        self._queued = Counter()  # priority: requests queued
+        self._pending = {}  # key: Request queued and not yet sent, for queries to share and writes to replace
+        self.replaced = 0  # writes replaced by a newer one before being sent
+        self.shared = 0  # queries answered by an identical one already queued
+        self.link = None  # LinkType of the path, set when connecting
+        self.reconnects = 0  # times the link was opened again after being lost
+        self._reader = None
+        self._writer = None
+        self._owner = None  # the task that owns the port and sends the commands
+        self._receiver = None  # the task that reads everything the units send
+        self._reconnector = None  # the task opening the link again after it was lost
+        self._inflight = []  # (match, lines, replies so far, future) of each command waiting for its reply, in order
+        self._lost = None  # error the connection was lost with
+        self._unanswered = 0  # commands in a row that got no reply
+        self._reconnect_delay = RECONNECT_DELAYS[0]  # grows until a command is answered after reconnecting
+        self._listeners = []
+        self._reconnect_listeners = []
+        self.recorder = None  # session.SessionRecorder given every line sent and received, if recording
+        self.ramps = {}  # unitCode: False once the unit rejected RAMP
+        self.stats = XAPStats() if stats is None else stats
+
+    def __repr__(self):
+        return "XAPConnection({} {})".format(self.XAPType, self.path)
+
+    async def connect(self):
+        """Open the port and start the tasks that own it"""
+        await self._open()
+        self._owner = asyncio.get_running_loop().create_task(self._run())
+        _LOGGER.debug("Connected to {} at {} baud".format(self.path, self.baud))
+
+    async def _open(self):
+        """Open the link and start reading from it"""
+        self.link, address = parse_path(self.path)
+        self._reader, self._writer = await self.link.opener(address, self.baud)
+        self._lost = None
+        self._unanswered = 0
+        self._receiver = asyncio.get_running_loop().create_task(self._receive())
+        self._record('+', self.path)
+
+    def _connection_lost(self, error):
+        """Fail the commands in flight, close the link and start opening it again"""
+        if self._lost is not None:
+            return
+        self._lost = error
+        _LOGGER.error(str(error))
+        self._record('-', str(error))
+        for _match, _lines, _replies, reply in self._inflight:
+            if not reply.done():
+                reply.set_exception(error)
+        if self._receiver is not None and self._receiver is not asyncio.current_task():
+            self._receiver.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        self._reconnector = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        """Open the link again, waiting longer after each failed attempt, and tell the reconnect listeners"""
+        while True:
+            await asyncio.sleep(self._reconnect_delay)
+            self._reconnect_delay = min(self._reconnect_delay * 2, RECONNECT_DELAYS[1])
+            try:
+                await self._open()
+            except OSError as err:
+                _LOGGER.warning("Reconnecting to {} failed, next attempt in {:.0f}s: {}".format(
+                    self.path, self._reconnect_delay, err))
+                continue
+            break
+        self.reconnects += 1
+        self._reconnector = None
+        _LOGGER.info("Reconnected to {}".format(self.path))
+        for callback in self._reconnect_listeners:
+            try:
+                callback()
+            except Exception:
+                _LOGGER.exception("Error handling reconnect to {}".format(self.path))
+
+    async def close(self):
+        """Stop the tasks, fail queued commands and close the port"""
+        for task in (self._reconnector, self._owner, self._receiver):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._owner = self._receiver = self._reconnector = None
+        while not self._queue.empty():
+            _priority, _seq, request = self._queue.get_nowait()
+            self._finish(request, error=XAPError('Connection closed'))
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def add_listener(self, callback):
+        """Call callback(Notification) for every message a unit sends that is not a reply to our commands"""
+        self._listeners.append(callback)
+
+    def add_reconnect_listener(self, callback):
+        """Call callback() every time the link is open again after being lost"""
+        self._reconnect_listeners.append(callback)
+
+    @property
+    def connected(self):
+        """False while the link is lost and being opened again"""
+        return self._owner is not None and self._lost is None
+
+    @property
+    def busy(self):
+        """True while any command is queued or waiting for its reply"""
+        return any(self.stats.queue_depth.values())
+
+    @property
+    def urgent(self):
+        """True while an interactive or automation command is queued or waiting for its reply, background ones
+        don't count"""
+        return bool(self._queued[PRIORITY_INTERACTIVE] or self._queued[PRIORITY_AUTOMATION])
+
+    async def command(self, unitCode, command, *args, lines=1, priority=None, deadline=None):
+        """Send a command to a unit and return the reply fields that follow the addressing arguments
+
+        For a query expecting several reply lines, returns a list with the fields after the command of each line.
+        priority defaults to that set with request_priority, deadline to the DEADLINES of the priority; a command
+        still queued deadline seconds after being sent fails with XAPTimeout.  A query identical to one already
+        queued shares its reply, an absolute write replaces a queued write to the same channel of equal or lower
+        priority, and both callers get the reply of the one sent."""
+        if self._owner is None:
+            raise XAPError('Not connected to {}'.format(self.path))
+        if priority is None:
+            priority = command_priority.get()
+        prefix = "#{}{}".format(self._device, int(unitCode))
+        fields = [prefix, command] + [str(arg) for arg in args]
+        match = fields[:2 + ADDRESS_ARGS.get(command, 0)]
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        request = Request(int(unitCode), command, (" ".join(fields) + "\r").encode('ascii'), match, lines, priority,
+                          now + (DEADLINES[priority] if deadline is None else deadline), now, loop.create_future())
+        request = self._enqueue(request)
+        request.waiters += 1
+        try:
+            replies = await asyncio.shield(request.future)
+        except asyncio.CancelledError:
+            self._abandon(request)
+            raise
+        if lines == 1:
+            return replies[0][len(match):]
+        return [reply[2:] for reply in replies]
+
+    @staticmethod
+    def _abandon(request):
+        """A caller waiting on request was cancelled, drop the request if nobody else waits for it"""
+        while request.replaced_by is not None:
+            request = request.replaced_by
+        request.waiters -= 1
+        if not request.waiters and not request.sent and not request.future.done():
+            request.future.cancel()  # the owner skips it
+        elif not request.waiters:
+            # sent already, nobody will look at how it ends
+            request.future.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+    def _enqueue(self, request):
+        """Queue a request, or return the queued one it is merged with"""
+        pending = self._pending.get(request.key)
+        if pending is not None and not pending.future.done() and pending.priority <= request.priority:
+            if (pending.lines == request.lines and pending.line == request.line
+                    and (request.query or request.replaceable)):
+                # toggles and relative writes are sent as often as they are asked for
+                self.shared += 1
+                return pending
+            if pending.replaceable and request.replaceable:
+                # the queued write goes out with the newer value, keeping its place in the queue
+                pending.line = request.line
+                pending.deadline = max(pending.deadline, request.deadline)
+                self.replaced += 1
+                return pending
+        if self._queued[request.priority] >= QUEUE_LIMITS[request.priority]:
+            raise XAPQueueFull('{} {} commands queued on {}'.format(
+                self._queued[request.priority], PRIORITY_NAMES[request.priority], self.path))
+        if pending is not None and not pending.future.done() and pending.replaceable and request.replaceable:
+            # a more urgent write to the same channel, the queued one is pointless and gets its reply
+            request.future.add_done_callback(lambda done, pending=pending: self._chain(done, pending))
+            request.waiters += pending.waiters
+            pending.replaced_by = request  # skipped when it comes up
+            self.replaced += 1
+        self._pending[request.key] = request
+        self._queued[request.priority] += 1
+        self.stats.queued(request.unitCode, request.command)
+        self._queue.put_nowait((request.priority, next(self._sequence), request))
+        return request
+
+    @staticmethod
+    def _chain(done, request):
+        """Give a replaced request the outcome of the request that replaced it"""
+        if request.future.done():
+            return
+        if done.cancelled():
+            request.future.cancel()
+        elif done.exception() is not None:
+            request.future.set_exception(done.exception())
+        else:
+            request.future.set_result(done.result())
+
+    def _dequeued(self, request):
+        if self._pending.get(request.key) is request:
+            del self._pending[request.key]
+        self._queued[request.priority] -= 1
+
+    def _finish(self, request, result=None, error=None):
+        """Complete a dequeued request and record it"""
+        self._dequeued(request)
+        loop = asyncio.get_running_loop()
+        self.stats.record(request.unitCode, request.command, tuple(request.match[2:]), loop.time() - request.queued,
+                          error=error is not None, timeout=isinstance(error, XAPTimeout))
+        if request.future.done():
+            return
+        if error is not None:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(result)
+
+    async def _run(self):
+        """Owner task: send the most urgent queued commands, a batch of up to link.pipeline at a time, and wait for
+        the receiver to hand them their replies"""
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self._queue.get()
+            batch = []
+            while entry is not None:
+                request = entry[2]
+                if self._sendable(request, loop):
+                    if batch and not self._joins(batch, request):
+                        self._queue.put_nowait(entry)  # first of the next batch
+                        break
+                    batch.append(request)
+                entry = None
+                if len(batch) < self.link.pipeline and not self._queue.empty():
+                    entry = self._queue.get_nowait()
+            if batch:
+                await self._send(batch, loop)
+
+    def _sendable(self, request, loop):
+        """True if a request taken from the queue is to be sent, otherwise it is completed or dropped"""
+        if request.future.done() or request.replaced_by is not None:  # callers gave up, or replaced
+            self._dequeued(request)
+            self.stats.unqueued(request.unitCode, request.command)
+            return False
+        if self._lost is not None:
+            self._finish(request, error=self._lost)
+            return False
+        if loop.time() > request.deadline:
+            _LOGGER.warning("Dropped {} from {}, queued for {:.1f}s".format(
+                request.line, self.path, loop.time() - request.queued))
+            self._finish(request, error=XAPTimeout('Not sent in time: {}'.format(request.line.decode().strip())))
+            return False
+        return True
+
+    @staticmethod
+    def _joins(batch, request):
+        """True if request can be written with batch, only single line replies to different channels are pipelined,
+        so every reply can be told apart"""
+        return request.lines == 1 and batch[0].lines == 1 and all(sent.key != request.key for sent in batch)
+
+    async def _send(self, batch, loop):
+        """Write a batch of requests at once and complete each with its reply"""
+        for request in batch:
+            request.sent = True
+            if self._pending.get(request.key) is request:
+                del self._pending[request.key]  # being sent, later commands to the channel queue behind it
+        self._inflight = [(request.match, request.lines, [], loop.create_future()) for request in batch]
+        replies = [reply for _match, _lines, _replies, reply in self._inflight]
+        try:
+            self._writer.write(b"".join(request.line for request in batch))
+            for request in batch:
+                self._record('>', request.line.decode('ascii').strip())
+            await self._writer.drain()
+            await asyncio.wait(replies, timeout=self.timeout + LINE_TIMEOUT * (
+                sum(request.lines for request in batch) - 1))
+        except asyncio.CancelledError:
+            for request in batch:
+                self._finish(request, error=XAPError('Connection closed'))
+            raise
+        except (OSError, RuntimeError) as err:  # written after the link was closed
+            self._connection_lost(XAPError('Connection to {} lost: {}'.format(self.path, err)))
+        finally:
+            self._inflight = []
+        for request, reply in zip(batch, replies):
+            if not reply.done():
+                _LOGGER.warning("No reply from {} to {}".format(self.path, request.line))
+                self._finish(request, error=XAPTimeout('No reply to {}'.format(request.line.decode().strip())))
+                self._unanswered += 1
+            elif reply.exception() is not None:
+                self._finish(request, error=reply.exception())
+            else:
+                self._finish(request, reply.result())
+                self._unanswered = 0
+                self._reconnect_delay = RECONNECT_DELAYS[0]
+        if self.link.network and self._unanswered >= DEAD_TIMEOUTS:
+            self._connection_lost(XAPError('Connection to {} lost, {} commands in a row got no reply'.format(
+                self.path, self._unanswered)))
+
+    async def _receive(self):
+        """Receiver task: parse everything the units send as it arrives"""
+        parser = LineParser()
+        while True:
+            try:
+                data = await self._reader.read(READ_SIZE)
+            except OSError as err:
+                data, reason = b"", err
+            else:
+                reason = None
+            if not data:
+                self._connection_lost(XAPError('Connection to {} lost{}'.format(
+                    self.path, '' if reason is None else ': {}'.format(reason))))
+                return
+            for raw in parser.feed(data):
+                self._received(raw.decode('ascii', 'replace').split())
+
+    def _received(self, fields):
+        """Hand a line to the command in flight waiting for it, or to the listeners if it is not a reply,
+        "*" in the match of a command matches any field"""
+        if not fields or fields[0].startswith('OK'):
+            return
+        error = 'ERROR' in fields[0].upper()
+        for match, lines, replies, reply in self._inflight:
+            if reply.done():
+                continue
+            if error:
+                # the units answer in order, so it is the oldest command still waiting that failed
+                self._record('<', " ".join(fields))
+                reply.set_exception(XAPRejected(" ".join(fields)))
+                return
+            if len(fields) > len(match) and all(want in ('*', got) for want, got in zip(match, fields)):
+                self._record('<', " ".join(fields))
+                replies.append(fields)
+                if len(replies) >= lines:
+                    reply.set_result(replies)
+                return
+        self._record('!', " ".join(fields))
+        self._notify(fields)
+
+    def _record(self, kind, text):
+        """Pass a line sent (>), a reply (<), a line the units sent on their own (!), or the link being opened (+)
+        or lost (-) to the recorder"""
+        if self.recorder is not None:
+            self.recorder.record(kind, text)
+
+    def _notify(self, fields):
+        """Pass a change reported by a unit on its own to the listeners"""
+        prefix = fields[0]
+        command = fields[1].upper() if len(fields) > 1 else None
+        nargs = ADDRESS_ARGS.get(command)
+        if (nargs is None or len(fields) < 3 + nargs or not prefix.startswith('#' + self._device)
+                or not prefix[2:].isdigit()):
+            _LOGGER.debug("Ignored line from {}: {}".format(self.path, fields))
+            return
+        note = Notification(int(prefix[2:]), command, tuple(parse_channel(field) for field in fields[2:2 + nargs]),
+                            fields[2 + nargs])
+        _LOGGER.debug("Notification from {}: {}".format(self.path, note))
+        self.stats.notified(note.unitCode)
+        for callback in self._listeners:
+            try:
+                callback(note)
+            except Exception:
+                _LOGGER.exception("Error handling {}".format(note))
+
+    async def test_connection(self, unitCode=0):
+        """True if the unit answers a version query"""
+        try:
+            await self.command(unitCode, 'VER')
+        except XAPError:
+            return False
+        return True
+
+    def _stereo(self, channel):
+        """Channels an action applies to, the channel and the next one in stereo mode"""
+        if not self.stereo:
+            return (channel,)
+        if isinstance(channel, int):
+            return (channel, channel + 1)
+        return (channel, chr(ord(channel) + 1))  # expansion and processing channels are letters
+
+    async def getPropGain(self, channel, group="I", unitCode=0):
+        """Gain of a channel (0..1)"""
+        reply = await self.command(unitCode, 'GAIN', channel, group)
+        return gain_to_prop(reply[0])
+
+    async def setPropGain(self, channel, gain, isAbsolute=1, group="I", unitCode=0):
+        """Set the gain of a channel (0..1), relative gains are in dB, returns the gain set"""
+        if isAbsolute:
+            value, mode = prop_to_gain(gain), 'A'
+        else:
+            value, mode = round(float(gain), 2), 'R'
+        for chan in self._stereo(channel):
+            reply = await self.command(unitCode, 'GAIN', chan, group, value, mode)
+        return gain_to_prop(reply[0])
+
+    async def rampGain(self, channel, gain, rate, group="I", unitCode=0):
+        """Start ramping the gain of a channel to gain (0..1) at rate dB per second, returns the target gain once the
+        unit has accepted the ramp, raises XAPUnsupported if the unit can't ramp"""
+        if self.ramps.get(int(unitCode)) is False:
+            raise XAPUnsupported('Unit {} does not support RAMP'.format(unitCode))
+        rate = round(min(max(float(rate), RAMP_RATE_RANGE[0]), RAMP_RATE_RANGE[1]), 2)
+        try:
+            for chan in self._stereo(channel):
+                reply = await self.command(unitCode, 'RAMP', chan, group, rate, prop_to_gain(gain))
+        except XAPRejected as err:
+            if self.ramps.get(int(unitCode)) is not False:
+                _LOGGER.info("Unit {} on {} does not support RAMP: {}".format(unitCode, self.path, err))
+            self.ramps[int(unitCode)] = False
+            raise XAPUnsupported(str(err))
+        self.ramps[int(unitCode)] = True
+        return gain_to_prop(reply[-1])
+
+    async def getMute(self, channel, group="I", unitCode=0):
+        """Mute status of a channel, 1 if muted"""
+        reply = await self.command(unitCode, 'MUTE', channel, group)
+        return int(reply[0])
+
+    async def setMute(self, channel, isMuted=1, group="I", unitCode=0):
+        """Set the mute status of a channel, isMuted=2 toggles, returns the mute status set"""
+        for chan in self._stereo(channel):
+            reply = await self.command(unitCode, 'MUTE', chan, group, int(isMuted))
+        return int(reply[0])
+
+    async def getMatrixRouting(self, inChannel, outChannel, inGroup="I", outGroup="O", unitCode=0):
+        """Routing value of a crosspoint, 0 if off"""
+        reply = await self.command(unitCode, 'MTRX', inChannel, inGroup, outChannel, outGroup)
+        return int(reply[0])
+
+    async def setMatrixRouting(self, inChannel, outChannel, state=1, inGroup="I", outGroup="O", unitCode=0):
+        """Set the routing of a crosspoint, returns the routing set"""
+        for inChan, outChan in zip(self._stereo(inChannel), self._stereo(outChannel)):
+            reply = await self.command(unitCode, 'MTRX', inChan, inGroup, outChan, outGroup, state)
+        return int(reply[0])
+
+    async def getMatrixLevel(self, inChannel, outChannel, inGroup="I", outGroup="O", unitCode=0):
+        """Level of a crosspoint in dB"""
+        reply = await self.command(unitCode, 'MTRXLVL', inChannel, inGroup, outChannel, outGroup)
+        return float(reply[0])
+
+    async def setMatrixLevel(self, inChannel, outChannel, level=0, isAbsolute=1, inGroup="I", outGroup="O",
+                             unitCode=0):
+        """Set the level of a crosspoint in dB, returns the level set"""
+        mode = 'A' if isAbsolute else 'R'
+        level = round(float(level), 2)  # the resolution of the unit
+        for inChan, outChan in zip(self._stereo(inChannel), self._stereo(outChannel)):
+            reply = await self.command(unitCode, 'MTRXLVL', inChan, inGroup, outChan, outGroup, level, mode)
+        return float(reply[0])
+
+    def group_channels(self, group):
+        """Channels of a group, as answered by a "*" query"""
+        if group == "I":
+            return self.input_range
+        if group == "O":
+            return self.output_range
+        return INPUT_GROUP_CHANNELS[group]
+
+    async def getMatrixColumn(self, outChannel, inGroup="I", outGroup="O", unitCode=0):
+        """Routing of every input of a group to one output, as {input channel: routing value}, in one query"""
+        channels = self.group_channels(inGroup)
+        replies = await self.command(unitCode, 'MTRX', '*', inGroup, outChannel, outGroup, lines=len(channels))
+        return {parse_channel(reply[0]): int(reply[4]) for reply in replies}
+
+    async def getLevel(self, channel, group="I", unitCode=0):
+        """Signal level of a channel in dB, as its level meter shows it"""
+        reply = await self.command(unitCode, 'LVL', channel, group, METER_TYPE)
+        return float(reply[0])
+
+    async def getLevels(self, group="I", unitCode=0):
+        """Signal level of every channel of a group in dB, as {channel: level}, in one query"""
+        channels = self.group_channels(group)
+        replies = await self.command(unitCode, 'LVL', '*', group, METER_TYPE, lines=len(channels))
+        return {parse_channel(reply[0]): float(reply[3]) for reply in replies}
+
+
+# XAPConnection methods that address one unit, sent on that unit's link
+UNIT_METHODS = frozenset(['command', 'test_connection', 'getPropGain', 'setPropGain', 'rampGain', 'getMute',
+                          'setMute', 'getMatrixRouting', 'setMatrixRouting', 'getMatrixLevel', 'setMatrixLevel',
+                          'getMatrixColumn', 'getLevel', 'getLevels'])
+
+
+class XAPLinks:
+    """
+    Links to the units of one system, each unit on the link given for it or on the default link
+    """
+
+    def __init__(self, path, links=None, baud=DEFAULT_BAUD, XAPType="XAP800", timeout=COMMAND_TIMEOUT):
+        """path is the default link, links maps unit codes to the path of their own link, units given the same path
+        share one link"""
+        self.stats = XAPStats()
+        self._connections = {path: XAPConnection(path, baud, XAPType, timeout, stats=self.stats)}
+        self._units = {}  # unitCode: XAPConnection, the default link for units not in it
+        for unitCode, unit_path in (links or {}).items():
+            if unit_path not in self._connections:
+                self._connections[unit_path] = XAPConnection(unit_path, baud, XAPType, timeout, stats=self.stats)
+            self._units[int(unitCode)] = self._connections[unit_path]
+        self._default = self._connections[path]
+
+    def __repr__(self):
+        return "XAPLinks({})".format(", ".join(conn.path for conn in self._connections.values()))
+
+    def __getattr__(self, name):
+        if name in UNIT_METHODS:
+            # positional unitCode for command and test_connection, keyword for the rest, as XAPConnection takes it
+            def method(*args, **kwargs):
+                if name in ('command', 'test_connection'):
+                    unitCode = args[0] if args else kwargs.get('unitCode', 0)
+                else:
+                    unitCode = kwargs.get('unitCode', 0)
+                return getattr(self.link(unitCode), name)(*args, **kwargs)
+            return method
+        # the same on every link (XAPType, matrixGeo, input_range, ...) comes from the default one
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._default, name)
+
+    def link(self, unitCode):
+        """XAPConnection the commands for a unit are sent on"""
+        return self._units.get(int(unitCode), self._default)
+
+    def links(self, unitCodes):
+        """{path: unit codes} of the links used by the given units"""
+        links = {}
+        for unitCode in unitCodes:
+            links.setdefault(self.link(unitCode).path, []).append(unitCode)
+        return links
+
+    @property
+    def connections(self):
+        """Every XAPConnection, one per link"""
+        return list(self._connections.values())
+
+    @property
+    def stereo(self):
+        return self._default.stereo
+
+    @stereo.setter
+    def stereo(self, stereo):
+        for conn in self.connections:
+            conn.stereo = stereo
+
+    @property
+    def recorder(self):
+        return self._default.recorder
+
+    @recorder.setter
+    def recorder(self, recorder):
+        for conn in self.connections:
+            conn.recorder = recorder
+
+    @property
+    def busy(self):
+        """True while any command is queued or waiting for its reply, on any link"""
+        return any(conn.busy for conn in self.connections)
+
+    @property
+    def urgent(self):
+        """True while an interactive or automation command is queued or waiting for its reply, on any link"""
+        return any(conn.urgent for conn in self.connections)
+
+    @property
+    def connected(self):
+        """False while any link is lost and being opened again"""
+        return all(conn.connected for conn in self.connections)
+
+    @property
+    def reconnects(self):
+        return sum(conn.reconnects for conn in self.connections)
+
+    @property
+    def replaced(self):
+        return sum(conn.replaced for conn in self.connections)
+
+    @property
+    def shared(self):
+        return sum(conn.shared for conn in self.connections)
+
+    async def connect(self):
+        """Open every link, closing those already open if one fails"""
+        results = await asyncio.gather(*[conn.connect() for conn in self.connections], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            await self.close()
+            raise errors[0]
+
+    async def close(self):
+        await asyncio.gather(*[conn.close() for conn in self.connections])
+
+    def add_listener(self, callback):
+        """Call callback(Notification) for every message a unit sends on any link that is not a reply"""
+        for conn in self.connections:
+            conn.add_listener(callback)
+
+    def add_reconnect_listener(self, callback):
+        """Call callback() every time a link is open again after being lost"""
+        for conn in self.connections:
+            conn.add_reconnect_listener(callback)
+
+    async def test_links(self, unitCodes):
+        """Paths of the links on which the first of their units among unitCodes does not answer, links are tested
+        in parallel"""
+        links = self.links(unitCodes)
+        answered = await asyncio.gather(*[self.link(units[0]).test_connection(units[0]) for units in links.values()])
+        return [path for path, ok in zip(links, answered) if not ok]